@@ -1,3 +1,5 @@
+import os
+import sys
 import pylab as pl
 import numpy as np
 import json
@@ -8,19 +10,10 @@ from astropy import log
 from astropy.table import Table
 from pathlib import Path
 
-
-# copy-pasted from parse_contdotdat
-def parse_contdotdat(filepath):
-
-    selections = []
-
-    with open(filepath, 'r') as fh:
-        for line in fh:
-            if "LSRK" in line:
-                selections.append(line.split()[0])
-
-
-    return ";".join(selections)
+# one directory up is "reduction"; parse_contdotdat does not need CASA
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'reduction'))
+from parse_contdotdat import parse_contdotdat, frequency_intervals
 
 lines_to_overplot = {
     "n2hp": "93.173700GHz",
@@ -181,14 +174,9 @@ for fignum,band in enumerate((3,6)):
                 # 1 = continuum frequencies
                 frqmask[fieldnum*nconfigs + configid, covered_freqs] = 2
 
-                for frqline in contdat.split(";"):
-                    fsplit = frqline.split("~")
-                    f2 = u.Quantity(fsplit[1])
-                    f1 = u.Quantity(float(fsplit[0]), f2.unit)
-
+                for f1, f2 in frequency_intervals(contdat) * u.Hz:
                     if f1 == f2:
                         continue
-                    assert f1 < f2
 
                     sel = (frqarr > f1) & (frqarr < f2)
                     frqmask[fieldnum*nconfigs + configid, sel] = 1
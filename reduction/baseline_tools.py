@@ -0,0 +1,129 @@
+"""
+Baseline lengths from the baselines that are actually present in a
+measurement set.
+
+Computing the distance between every pair of rows of the ANTENNA table is
+wrong for concatenated MSes: an MS combining, e.g., the TM1 and TM2
+configurations lists antenna pads that never observed together, so the
+all-pairs maximum can be much longer than any real baseline.  The functions
+here use the (ANTENNA1, ANTENNA2) pairs recorded in the main table instead, so
+the cost is proportional to the number of baselines rather than to nant**2
+x 3 temporary arrays.
+"""
+import numpy as np
+
+
+def present_baselines(vis, msmd=None, tb=None, chunksize=10000000):
+    """
+    Find the cross-correlation baselines that have data in an MS
+
+    Parameters
+    ----------
+    vis : str
+        The measurement set
+    msmd : msmetadata tool or None
+        If given (and closed), ``msmd.baselines()`` is used
+    tb : table tool or None
+        If given, and msmd is not or does not support ``baselines``, the
+        ANTENNA1 and ANTENNA2 columns of the main table are read in chunks of
+        ``chunksize`` rows
+
+    Returns
+    -------
+    ant1, ant2 : np.ndarray
+        The antenna indices of each baseline, with ant1 < ant2
+    """
+    if msmd is not None:
+        msmd.open(vis)
+        try:
+            present = np.asarray(msmd.baselines(), dtype='bool')
+        except AttributeError:
+            present = None
+        finally:
+            msmd.close()
+        if present is not None:
+            ant1, ant2 = np.where(np.triu(present | present.T, k=1))
+            return ant1, ant2
+
+    if tb is None:
+        raise ValueError("Either an msmd tool supporting baselines() or a "
+                         "tb tool is required")
+
+    pairs = np.zeros([0, 2], dtype='int')
+    tb.open(vis)
+    try:
+        nrows = tb.nrows()
+        for startrow in range(0, nrows, chunksize):
+            nrow = min(chunksize, nrows - startrow)
+            ant1 = tb.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+            ant2 = tb.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+            chunk = np.array([np.minimum(ant1, ant2), np.maximum(ant1, ant2)]).T
+            chunk = chunk[chunk[:,0] != chunk[:,1]]
+            pairs = np.unique(np.concatenate([pairs, chunk]), axis=0)
+    finally:
+        tb.close()
+
+    return pairs[:,0], pairs[:,1]
+
+
+def baseline_lengths(positions, ant1, ant2):
+    """
+    The lengths (in the units of ``positions``) of the baselines between
+    antennae ``ant1`` and ``ant2``.  ``positions`` has shape (3, nant), as
+    read from the POSITION column of the ANTENNA table.
+    """
+    positions = np.asarray(positions)
+    return (((positions[:,ant1] - positions[:,ant2])**2).sum(axis=0))**0.5
+
+
+def _select(ant1, ant2, antsel):
+    ant1, ant2 = np.asarray(ant1, dtype='int'), np.asarray(ant2, dtype='int')
+    if antsel is None:
+        return ant1, ant2
+    antsel = np.asarray(antsel, dtype='bool')
+    keep = antsel[ant1] & antsel[ant2]
+    return ant1[keep], ant2[keep]
+
+
+def max_baseline(positions, ant1, ant2, antsel=None):
+    """
+    The longest baseline between antennae ``ant1`` and ``ant2``, using only
+    the baselines for which both antennae are selected by the boolean array
+    ``antsel`` (e.g., ``diameters == 7``).  Returns 0 if there are none.
+    """
+    ant1, ant2 = _select(ant1, ant2, antsel)
+    if len(ant1) == 0:
+        return 0.
+    return float(baseline_lengths(positions, ant1, ant2).max())
+
+
+def baseline_percentile(positions, ant1, ant2, percentile, antsel=None):
+    """
+    A percentile (0-100) of the baseline lengths between antennae ``ant1``
+    and ``ant2``; see ``max_baseline``.  Returns 0 if there are no baselines.
+    """
+    ant1, ant2 = _select(ant1, ant2, antsel)
+    if len(ant1) == 0:
+        return 0.
+    return float(np.percentile(baseline_lengths(positions, ant1, ant2),
+                               percentile))
+
+
+def max_pairwise_distance(positions, antsel=None, chunksize=64):
+    """
+    The largest distance between any two antennae, whether or not they form
+    a baseline in the data.  This is only meant as a fallback for MSes with
+    no data in the main table.  The distances are computed ``chunksize``
+    antennae at a time, so the memory use is linear in nant.
+    """
+    positions = np.asarray(positions)
+    if antsel is not None:
+        positions = positions[:, np.asarray(antsel, dtype='bool')]
+    nant = positions.shape[1]
+    result = 0.
+    for start in range(0, nant, chunksize):
+        chunk = positions[:, start:start+chunksize]
+        dists = (((chunk[:,:,None] - positions[:,None,:])**2).sum(axis=0))**0.5
+        if dists.size:
+            result = max(result, float(dists.max()))
+    return result
@@ -0,0 +1,251 @@
+"""
+Compare the ways ``populate_model_column`` can provide the model for a
+self-calibration gaincal (see the MODEL POPULATION section and
+SELFCAL_MODEL_STORAGE in ``continuum_imaging_selfcal.py``).
+
+For each method and model storage mode, the model of an existing
+self-calibration image is written into a scratch copy of the selfcal MS and
+gaincal is run with the parameters of a self-calibration iteration.  The wall
+time and I/O of the model population and of gaincal, the size of the MS, and
+the gain solutions are recorded.  The solutions of each run are compared to
+those of the first one.  The image products are copied to the scratch
+directory first because the 'tclean' method overwrites the residual.
+
+Run from the directory containing the selfcal MS (the one
+``continuum_imaging_selfcal.py`` is run from), setting these environmental
+variables:
+    SELFCAL_MS=<ms>
+        The selfcal MS, e.g. W51-E_B3_uid___A001_X1296_X10b_continuum_merged_12M_selfcal.ms
+    SELFCAL_IMAGE=<prefix>
+        The image whose .model.tt0 and .model.tt1 are used, e.g.
+        imaging_results/W51-E_B3_uid___A001_X1296_X10b_continuum_merged_12M_robust0_selfcal2
+    PARS_KEY=<key>
+        The key of the imaging and selfcal parameters, e.g. W51-E_B3_12M_robust0
+    SELFCAL_ITER=<number>
+        The iteration whose parameters are used for the model and for gaincal.
+        Default 1.
+    METHODS=<list>
+        Comma-separated methods to compare.  Default tclean,predict,ft
+    MODEL_STORAGES=<list>
+        Comma-separated model storage modes (modelcolumn, virtual) to run each
+        method with.  Default modelcolumn
+    BENCHMARK_DIR=<directory>
+        The scratch directory.  Default model_population_benchmark
+
+The results are written to ``<BENCHMARK_DIR>/model_population_benchmark.json``.
+"""
+import os
+import sys
+import copy
+import json
+import glob
+import time
+import shutil
+
+import numpy as np
+
+if os.getenv('ALMAIMF_ROOTDIR') is not None:
+    sys.path.append(os.getenv('ALMAIMF_ROOTDIR'))
+
+from metadata_tools import (logprint, determine_phasecenter, determine_imsize,
+                            populate_model_column, model_population_methods,
+                            reset_model_storage, model_storage_modes)
+from utils import directory_size, process_io_bytes, io_bytes_since
+from imaging_parameters import imaging_parameters, selfcal_pars
+
+try:
+    from taskinit import tbtool
+    from tasks import gaincal
+except ImportError:
+    from casatools import table as tbtool
+    from casatasks import gaincal
+tb = tbtool()
+
+
+def read_gain_solutions(caltable):
+    """
+    Read the complex gains and flags of a gaincal table
+
+    Returns
+    -------
+    solutions : dict
+        'cparam' and 'flag' with shape (npol, nchan, nrow), and 'antenna',
+        'time', and 'spw' with shape (nrow,)
+    """
+    tb.open(caltable)
+    solutions = {'cparam': tb.getcol('CPARAM'),
+                 'flag': tb.getcol('FLAG'),
+                 'antenna': tb.getcol('ANTENNA1'),
+                 'time': tb.getcol('TIME'),
+                 'spw': tb.getcol('SPECTRAL_WINDOW_ID'),
+                }
+    tb.close()
+    return solutions
+
+
+def compare_solutions(reference, solutions):
+    """
+    Compare gain solutions to a reference set of solutions made with the same
+    gaincal parameters
+
+    Returns
+    -------
+    comparison : dict
+        The number of solutions unflagged in both, the number flagged in only
+        one of them, the median and maximum absolute phase difference
+        (degrees), and the median and maximum fractional amplitude difference
+    """
+    keys = lambda sol: list(zip(sol['antenna'], sol['time'], sol['spw']))
+    if keys(reference) != keys(solutions):
+        raise ValueError("The solutions do not have the same antennae, times,"
+                         " and spectral windows; they cannot be compared.")
+
+    good_ref = ~reference['flag']
+    good = ~solutions['flag']
+    both = good_ref & good
+    comparison = {'n_compared': int(both.sum()),
+                  'n_flag_mismatch': int((good_ref != good).sum()),
+                 }
+    if both.any():
+        ratio = solutions['cparam'][both] / reference['cparam'][both]
+        dphase = np.abs(np.angle(ratio, deg=True))
+        damp = np.abs(np.abs(ratio) - 1)
+        comparison.update({'median_dphase_deg': float(np.median(dphase)),
+                           'max_dphase_deg': float(dphase.max()),
+                           'median_damp_frac': float(np.median(damp)),
+                           'max_damp_frac': float(damp.max()),
+                          })
+    return comparison
+
+
+selfcal_ms = os.getenv('SELFCAL_MS')
+imname = os.getenv('SELFCAL_IMAGE')
+pars_key = os.getenv('PARS_KEY')
+if None in (selfcal_ms, imname, pars_key):
+    raise ValueError("SELFCAL_MS, SELFCAL_IMAGE, and PARS_KEY must be set")
+selfcaliter = int(os.getenv('SELFCAL_ITER') or 1)
+methods = (os.getenv('METHODS') or ",".join(model_population_methods)).split(",")
+for method in methods:
+    if method not in model_population_methods:
+        raise ValueError("Unknown method {0}".format(method))
+storages = (os.getenv('MODEL_STORAGES') or 'modelcolumn').split(",")
+for storage in storages:
+    if storage not in model_storage_modes:
+        raise ValueError("Unknown model storage {0}".format(storage))
+benchmark_dir = os.getenv('BENCHMARK_DIR') or 'model_population_benchmark'
+
+field = pars_key.split("_")[0]
+if os.getenv('FIELD_ID') and '_' in os.getenv('FIELD_ID'):
+    field = os.getenv('FIELD_ID')
+
+# resolve the iteration-specific parameters the same way
+# continuum_imaging_selfcal does
+impars = copy.copy(imaging_parameters[pars_key])
+impars.pop('model_population', None)
+impars.pop('maskname', None)
+for key, val in list(impars.items()):
+    if isinstance(val, dict) and selfcaliter in val:
+        impars[key] = val[selfcaliter]
+    elif isinstance(val, dict):
+        del impars[key]
+gaincalpars = selfcal_pars[pars_key][selfcaliter]
+
+# the image size and cell are set the same way as in continuum_imaging_selfcal
+arrayname = pars_key.split("_")[2]
+coosys, racen, deccen = determine_phasecenter(ms=selfcal_ms, field=field)
+phasecenter = "{0} {1}deg {2}deg".format(coosys, racen, deccen)
+dra, ddec, pixscale = determine_imsize(ms=selfcal_ms, field=field,
+                                       phasecenter=(racen, deccen),
+                                       exclude_7m=arrayname == '12M',
+                                       only_7m=arrayname == '7M',
+                                       spw='all',
+                                       pixfraction_of_fwhm=1/8. if arrayname == '7M' else 1/4.)
+if 'imsize' not in impars:
+    impars['imsize'] = [dra, ddec]
+if 'cell' not in impars:
+    impars['cell'] = ['{0:0.2f}arcsec'.format(pixscale)] * 2
+
+if not os.path.exists(benchmark_dir):
+    os.mkdir(benchmark_dir)
+scratch_ms = os.path.join(benchmark_dir, os.path.basename(selfcal_ms))
+if not os.path.exists(scratch_ms):
+    logprint("Copying {0} to {1}".format(selfcal_ms, scratch_ms),
+             origin='benchmark_model_population')
+    shutil.copytree(selfcal_ms, scratch_ms)
+
+runs = [(method, storage) for storage in storages for method in methods]
+results = {}
+for method, storage in runs:
+    run = "{0}_{1}".format(method, storage)
+
+    # a fresh copy of the image products for each run
+    scratch_imname = os.path.join(benchmark_dir,
+                                  os.path.basename(imname) + "_" + run)
+    for fn in glob.glob(scratch_imname+".*"):
+        if os.path.isdir(fn):
+            shutil.rmtree(fn)
+        else:
+            os.remove(fn)
+    for fn in glob.glob(imname+".*"):
+        target = scratch_imname + fn[len(imname):]
+        if os.path.isdir(fn):
+            shutil.copytree(fn, target)
+        else:
+            shutil.copy(fn, target)
+
+    reset_model_storage(scratch_ms, storage)
+
+    logprint("Populating the model with method={0}, storage={1}"
+             .format(method, storage),
+             origin='benchmark_model_population')
+    io_start = process_io_bytes()
+    walltime = populate_model_column(scratch_imname, scratch_ms, field,
+                                     copy.copy(impars), phasecenter,
+                                     maskname='', antennae='', method=method,
+                                     storage=storage)
+    populate_io = io_bytes_since(io_start)
+    ms_size = directory_size(scratch_ms)
+
+    caltable = os.path.join(benchmark_dir, "{0}.cal".format(run))
+    if os.path.exists(caltable):
+        shutil.rmtree(caltable)
+    io_start = process_io_bytes()
+    t0 = time.time()
+    gaincal(vis=scratch_ms, caltable=caltable, **gaincalpars)
+    gaincal_walltime = time.time() - t0
+
+    results[run] = {'method': method,
+                    'storage': storage,
+                    'populate_walltime': walltime,
+                    'populate_io': populate_io,
+                    'ms_size': ms_size,
+                    'gaincal_walltime': gaincal_walltime,
+                    'gaincal_io': io_bytes_since(io_start),
+                    'caltable': caltable,
+                   }
+
+names = ["{0}_{1}".format(method, storage) for method, storage in runs]
+reference = read_gain_solutions(results[names[0]]['caltable'])
+for run in names:
+    results[run]['comparison_to'] = names[0]
+    results[run].update(compare_solutions(reference,
+                                          read_gain_solutions(results[run]['caltable'])))
+
+logprint("Model population benchmark for {0} iteration {1} (solutions "
+         "compared to {2}):".format(imname, selfcaliter, names[0]),
+         origin='benchmark_model_population')
+for run in names:
+    res = results[run]
+    logprint("    {0:20s} populate {1:8.1f}s  gaincal {2:8.1f}s  "
+             "written {3} bytes  MS size {4} bytes  "
+             "median/max dphase {5}/{6} deg  flag mismatches {7}"
+             .format(run, res['populate_walltime'],
+                     res['gaincal_walltime'],
+                     res['populate_io'].get('write_bytes'),
+                     res['ms_size'],
+                     res.get('median_dphase_deg'), res.get('max_dphase_deg'),
+                     res['n_flag_mismatch']),
+             origin='benchmark_model_population')
+
+with open(os.path.join(benchmark_dir, 'model_population_benchmark.json'), 'w') as fh:
+    json.dump(results, fh, indent=1, sort_keys=True)
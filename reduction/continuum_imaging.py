@@ -17,6 +17,14 @@ You can set the following environmental variables for this script:
         Metadata will still be collected for *all* available MSes.
     BAND_TO_IMAGE=B3 or B6
         If this parameter is set, only image the selected band.
+    ROBUST_NPROC=<number>
+        If greater than 1, the dirty images of the three robust values are made
+        concurrently in this many processes, each with its own CASA log
+        (<image name>.casa.log).  The masked cleans that follow depend on
+        masks made from the dirty images and are still run one at a time.
+    ROBUST_MEMORY_GB=<number>
+        The memory (GB) available to the concurrent dirty images.  Defaults to
+        the physical memory of the machine.
 
 The environmental variable ``ALMAIMF_ROOTDIR`` should be set to the directory
 containing this file.
@@ -27,6 +35,12 @@ Additional Notes
 USE_SELFCAL_MS is an environmental variable you can set if you want the imaging
 to be done using the selfcal.ms file instead of the default continuum MS file.
 It is primarily for debug purposes and you shouldn't need it.
+
+The phase center and image size of each MS are stored in
+``geometry_cache.json`` in the working directory (see
+``metadata_tools.determine_imsize``) and are reused by all of the imaging
+scripts until the MS is replaced.  Delete that file to force them to be
+recomputed.
 """
 
 import os, sys, argparse
@@ -59,10 +73,13 @@ else:
 almaimf_rootdir = os.getenv('ALMAIMF_ROOTDIR')
 
 from getversion import git_date, git_version
-from metadata_tools import determine_imsize, determine_phasecenter, logprint
+from metadata_tools import (determine_imsize, determine_phasecenter, logprint,
+                            run_tclean, tclean_task, init_tclean_worker)
+from task_graph import make_task, run_tasks, total_memory_gb
+from selfcal_tools import estimate_selfcal_memory
 from make_custom_mask import make_custom_mask
 from imaging_parameters import imaging_parameters
-from tasks import tclean, exportfits, plotms, split
+from tasks import exportfits, plotms, split
 from taskinit import msmdtool, iatool
 import copy
 from utils import validate_mask_path
@@ -102,6 +119,9 @@ if 'only_7m' not in locals():
     else:
         only_7m = False
 
+robust_nproc = int(os.getenv('ROBUST_NPROC') or 1)
+robust_memory_budget = float(os.getenv('ROBUST_MEMORY_GB') or total_memory_gb())
+
 
 # load the list of continuum MSes from a file
 # (this file has one continuum MS full path, e.g. /path/to/file.ms, per line)
@@ -117,6 +137,58 @@ if os.getenv('DO_BSENS') is not None and os.getenv('DO_BSENS').lower() != 'false
                        for x in continuum_mses]
 
 
+def robust_impars(field, band, arrayname, robust):
+    """
+    A copy of the imaging parameters for one robust value
+    """
+    impars = copy.copy(imaging_parameters["{0}_{1}_{2}_robust{3}"
+                                          .format(field, band, arrayname,
+                                                  robust)])
+    # only used by the self-calibration
+    impars.pop('model_population', None)
+    return impars
+
+
+def dirty_tclean_kwargs(imname, impars, vis, field, phasecenter, cell, imsize,
+                        antenna):
+    """
+    The tclean arguments of the dirty image ``imname`` made with ``impars``
+    (without its mask, and with niter=0)
+    """
+    dirty_impars = copy.copy(impars)
+    dirty_impars.pop('maskname', None)
+    dirty_impars['niter'] = 0
+    return dict(vis=vis,
+                field=field.encode(),
+                imagename=imname,
+                phasecenter=phasecenter,
+                outframe='LSRK',
+                veltype='radio',
+                usemask='pb',
+                interactive=False,
+                cell=cell,
+                imsize=imsize,
+                antenna=antenna,
+                pbcor=True,
+                **dirty_impars
+               )
+
+
+def set_dirty_history(imname, impars):
+    """
+    Record the imaging parameters and the pipeline version in the residual of
+    the dirty image ``imname``
+    """
+    ia.open(imname+".residual.tt0")
+    ia.sethistory(origin='almaimf_cont_imaging',
+                  history=["{0}: {1}".format(key, val) for key, val in
+                           impars.items()])
+    ia.sethistory(origin='almaimf_cont_imaging',
+                  history=["git_version: {0}".format(git_version),
+                           "git_date: {0}".format(git_date)])
+    ia.close()
+
+
 for continuum_ms in continuum_mses:
 
     # strip off .cal.ms
@@ -213,49 +285,54 @@ for continuum_ms in continuum_mses:
 
     contimagename = os.path.join(imaging_root, basename) + "_" + arrayname + suffix
 
+    if robust_nproc > 1:
+        # the dirty images do not depend on the masks, so make them for all
+        # robust values at once; the loop below then finds them on disk
+        dirty_tasks = []
+        dirty_history = {}
+        for robust in (0, 2, -2):
+            impars = robust_impars(field, band, arrayname, robust)
+            imname = contimagename+"_robust{0}_dirty".format(robust)
+            if os.path.exists(imname+".image.tt0"):
+                continue
+            logprint("Dirty imaging file {0}".format(imname),
+                     origin='almaimf_cont_imaging')
+            tclean_kwargs = dirty_tclean_kwargs(imname, impars, continuum_ms,
+                                                field, phasecenter, cellsize,
+                                                imsize, antennae)
+            dirty_tasks.append(make_task(imname, tclean_task,
+                                         args=(imname+".casa.log", tclean_kwargs),
+                                         kwargs=dict(check=False,
+                                                     origin='almaimf_cont_imaging'),
+                                         memory=estimate_selfcal_memory(imsize)))
+            dirty_history[imname] = impars
+        if dirty_tasks:
+            dirty_results = run_tasks(dirty_tasks, nproc=robust_nproc,
+                                      memory_budget=robust_memory_budget,
+                                      initializer=init_tclean_worker,
+                                      raise_on_failure=False)
+            for imname, impars in dirty_history.items():
+                if dirty_results[imname]['status'] == 'done':
+                    set_dirty_history(imname, impars)
 
 
     for robust in (0, 2, -2):
 
-        impars = imaging_parameters["{0}_{1}_{2}_robust{3}".format(field, band,
-                                                                   arrayname,
-                                                                   robust)]
-        impars = copy.copy(impars)
-        dirty_impars = copy.copy(impars)
-        dirty_impars['niter'] = 0
-        if 'maskname' in dirty_impars:
-            maskname = validate_mask_path(dirty_impars['maskname'][0],
+        impars = robust_impars(field, band, arrayname, robust)
+        if 'maskname' in impars:
+            maskname = validate_mask_path(impars['maskname'][0],
                                           os.getenv('ALMAIMF_ROOTDIR'))
-            del dirty_impars['maskname']
 
         imname = contimagename+"_robust{0}_dirty".format(robust)
 
         if not os.path.exists(imname+".image.tt0"):
             logprint("Dirty imaging file {0}".format(imname),
                      origin='almaimf_cont_imaging')
-            tclean(vis=continuum_ms,
-                   field=field.encode(),
-                   imagename=imname,
-                   phasecenter=phasecenter,
-                   outframe='LSRK',
-                   veltype='radio',
-                   usemask='pb',
-                   interactive=False,
-                   cell=cellsize,
-                   imsize=imsize,
-                   antenna=antennae,
-                   pbcor=True,
-                   **dirty_impars
-                  )
-
-            ia.open(imname+".residual.tt0")
-            ia.sethistory(origin='almaimf_cont_imaging',
-                          history=["{0}: {1}".format(key, val) for key, val in
-                                   impars.items()])
-            ia.sethistory(origin='almaimf_cont_imaging',
-                          history=["git_version: {0}".format(git_version),
-                                   "git_date: {0}".format(git_date)])
-            ia.close()
+            run_tclean(check=False, origin='almaimf_cont_imaging',
+                       **dirty_tclean_kwargs(imname, impars, continuum_ms,
+                                             field, phasecenter, cellsize,
+                                             imsize, antennae))
+            set_dirty_history(imname, impars)
 
         try:
             if 'maskname' in locals() and os.path.exists(maskname):
@@ -281,9 +358,9 @@ for continuum_ms in continuum_mses:
                 logprint("Exception: {0}".format(str(ex)))
                 logprint("Because no region file was found to create a mask, only "
                          "the dirty image was made for {0}".format(imname))
-                if 'maskname' in dirty_impars:
+                if 'maskname' in impars:
                     logprint("However, mask {0} was found in image parameters.  "
-                             "Check that it exists".format(dirty_impars['maskname']))
+                             "Check that it exists".format(impars['maskname']))
                 continue
                 #raise ValueError("Make the region file first!")
 
@@ -308,20 +385,22 @@ for continuum_ms in continuum_mses:
         if not os.path.exists(imname+".image.tt0"):
             logprint("Cleaning file {0}".format(imname),
                      origin='almaimf_cont_imaging')
-            tclean(vis=continuum_ms,
-                   field=field.encode(),
-                   imagename=imname,
-                   phasecenter=phasecenter,
-                   outframe='LSRK',
-                   veltype='radio',
-                   usemask='user',
-                   interactive=False,
-                   cell=cellsize,
-                   imsize=imsize,
-                   antenna=antennae,
-                   pbcor=True,
-                   **impars_thisiter
-                  )
+            run_tclean(vis=continuum_ms,
+                       field=field.encode(),
+                       imagename=imname,
+                       phasecenter=phasecenter,
+                       outframe='LSRK',
+                       veltype='radio',
+                       usemask='user',
+                       interactive=False,
+                       cell=cellsize,
+                       imsize=imsize,
+                       antenna=antennae,
+                       pbcor=True,
+                       check=False,
+                       origin='almaimf_cont_imaging',
+                       **impars_thisiter
+                      )
             ia.open(imname+".image.tt0")
             ia.sethistory(origin='almaimf_cont_imaging',
                           history=["{0}: {1}".format(key, val) for key, val in
@@ -386,20 +465,22 @@ for continuum_ms in continuum_mses:
         if not os.path.exists(imname+".image.tt0"):
             logprint("re-Cleaning file {0}".format(imname),
                      origin='almaimf_cont_imaging')
-            tclean(vis=continuum_ms,
-                   field=field.encode(),
-                   imagename=imname,
-                   phasecenter=phasecenter,
-                   outframe='LSRK',
-                   veltype='radio',
-                   usemask='user',
-                   interactive=False,
-                   cell=cellsize,
-                   imsize=imsize,
-                   antenna=antennae,
-                   pbcor=True,
-                   **impars_thisiter
-                  )
+            run_tclean(vis=continuum_ms,
+                       field=field.encode(),
+                       imagename=imname,
+                       phasecenter=phasecenter,
+                       outframe='LSRK',
+                       veltype='radio',
+                       usemask='user',
+                       interactive=False,
+                       cell=cellsize,
+                       imsize=imsize,
+                       antenna=antennae,
+                       pbcor=True,
+                       check=False,
+                       origin='almaimf_cont_imaging',
+                       **impars_thisiter
+                      )
             ia.open(imname+".image.tt0")
             ia.sethistory(origin='almaimf_cont_imaging',
                           history=["{0}: {1}".format(key, val) for key, val in
@@ -21,6 +21,46 @@ You can set the following environmental variables for this script:
         If this parameter is set, only image the selected band.
     DO_BSENS=<boolean>
         Do bsens?  If not, do cleanest.  Default is cleanest
+    SELFCAL_MODEL_STORAGE=modelcolumn or virtual
+        How the model used by gaincal is stored.  'modelcolumn' (the default)
+        writes a MODEL_DATA column to the selfcal MS; 'virtual' stores only a
+        reference to the model images, which gaincal evaluates on the fly, and
+        deletes the MODEL_DATA column.  The wall time, I/O, and MS size of each
+        iteration are recorded in the manifest (see Restarting) so the two can
+        be compared.
+    ROBUST_NPROC=<number>
+        The number of final (robust 0, -2, 2) images made at once, each in its
+        own process with its own CASA log (<image name>.casa.log).  Default 1.
+    ROBUST_MEMORY_GB=<number>
+        The memory (GB) available to the concurrent final images (see
+        ``selfcal_tools.estimate_selfcal_memory``).  Defaults to the physical
+        memory of the machine.
+    SELFCAL_REUSE_PSF=<boolean>
+        Reuse the PSF of the previous iteration when the PSF-determining
+        imaging parameters (imsize, cell, weighting, robust, gridder, etc.;
+        see ``metadata_tools.psf_parameter_keys``) are unchanged.  The
+        self-calibration solutions are applied with calwt=False and
+        applymode='calonly', so they change neither the weights nor the flags
+        and the PSF of each iteration is the same as that of the last.  The
+        PSF time saved is recorded in the manifest (see Restarting).  Default
+        True.
+    SELFCAL_TIMEAVERAGE=<boolean>
+        Also average the selfcal MS in time when it is split.  The time bin is
+        the largest whole number of integrations that keeps the time-average
+        smearing at the longest baseline within the limit (see
+        ``smearing_tools``) and leaves at least two averaged integrations in
+        the shortest solint of the selfcal parameters.  No averaging is done
+        if any solint is 'int'.  Changing this setting remakes the selfcal MS.
+        Default False.
+    SELFCAL_WARM_START=<boolean>
+        Start each selfcal iteration's clean from the model (and, if the mask
+        is unchanged, the clean mask) of the previous iteration, copied into
+        the new image, instead of passing the previous model as a startmodel.
+        The first major cycle then computes the residual of the newly
+        calibrated data minus the previous model, and the mask (including any
+        auto-masking state) is not remade.  The number of iterations and major
+        cycles, the final peak residual, and the wall time of each iteration
+        are recorded in the manifest either way.  Default False.
 
 The environmental variable ``ALMAIMF_ROOTDIR`` should be set to the directory
 containing this file.
@@ -73,6 +113,21 @@ or if you want to totally start over:
     # and remove the .cal files in the parent directory
     rm -r W51-E_B3_*cal
 
+Removing files is usually not needed any more: each stage (split, dirty and
+pre-selfcal imaging, the gaincal and clean of each iteration, the final images,
+and the post-selfcal dirty image) is recorded in
+``<prefix>_selfcal_manifest.json`` together with a hash of its inputs (imaging
+and self-calibration parameters, mask contents, and the stage before it).  If
+the parameters of a stage change, that stage and all of the stages after it are
+re-run and their old products removed; earlier stages are kept.  Products
+left by a run of an older version of the script, which made no manifest, are
+adopted as they are.  Deleting the manifest has the same effect, so to force a
+stage to be redone, remove its products as described above.
+
+The phase center and image size are reused from ``geometry_cache.json`` (shared
+with ``continuum_imaging.py`` and ``line_imaging.py``) unless the selfcal MS is
+re-split.
+
 MASKING
 =======
 There are two ways to specify masks:
@@ -80,11 +135,26 @@ There are two ways to specify masks:
     them with a flux level, as described in https://github.com/ALMA-IMF/notebooks/blob/master/SelfCal_Instructions_Examination.ipynb
     (2) specify 'maskname' in the imaging parameters, e.g.:
    'maskname': {0: 'clean_mask1.crtf', 1: 'clean_mask2.crtf', 2: 'clean_mask3.crtf', 3: 'clean_mask4.crtf'},
+
+MODEL POPULATION
+================
+Before each gaincal, the model column must hold the model of the previous
+clean.  The cleans write it themselves, but after a restart it has to be
+recreated.  Set ``'model_population'`` in the imaging parameters to choose how:
+    'tclean' (default): a zero-iteration tclean that also recomputes the
+    residual
+    'predict': a tclean that only predicts the existing model images, without
+    computing the residual
+    'ft': ``ft`` of the model images (single pointings only; mosaics use
+    'predict')
+``benchmark_model_population.py`` compares the wall time and the resulting
+gaincal solutions of these methods.
 """
 
 import os
 import copy
 import sys
+import time
 import shutil
 import glob
 
@@ -111,17 +181,28 @@ else:
     sys.path.append(os.getenv('ALMAIMF_ROOTDIR'))
 almaimf_rootdir = os.getenv('ALMAIMF_ROOTDIR')
 
-import numpy as np
-
 from getversion import git_date, git_version
 from metadata_tools import (determine_imsize, determine_phasecenter, logprint,
-                            check_model_is_populated, test_tclean_success,
-                            populate_model_column)
+                            check_model_is_populated, run_tclean,
+                            populate_model_column, model_is_populated,
+                            reset_model_storage, model_storage_modes,
+                            tclean_task, init_tclean_worker, psf_is_reusable,
+                            copy_psf_products, model_is_reusable,
+                            copy_image_products)
 from make_custom_mask import make_custom_mask
 from imaging_parameters import imaging_parameters, selfcal_pars
 from selfcal_heuristics import goodenough_field_solutions
-
-from tasks import tclean, plotms, split
+from selfcal_manifest import (load_manifest, stage_hash, stage_is_current,
+                              record_stage, invalidate_stage, stage_token,
+                              path_signature, remove_image_products)
+from utils import (ms_geometry_mtime, directory_size, process_io_bytes,
+                   io_bytes_since)
+from task_graph import make_task, run_tasks, total_memory_gb
+from selfcal_tools import estimate_selfcal_memory
+from smearing_tools import (averaging_limits, solint_averaging_limit,
+                            time_averaging_bin)
+
+from tasks import plotms, split
 
 from clearcal_cli import clearcal_cli as clearcal
 from gaincal_cli import gaincal_cli as gaincal
@@ -196,6 +277,18 @@ if len(continuum_mses) == 0:
 
 dryrun = bool(os.getenv('DRYRUN') or (dryrun if 'dryrun' in locals() else False))
 
+robust_nproc = int(os.getenv('ROBUST_NPROC') or 1)
+robust_memory_budget = float(os.getenv('ROBUST_MEMORY_GB') or total_memory_gb())
+
+reuse_psf = (os.getenv('SELFCAL_REUSE_PSF') or 'true').lower() != 'false'
+warm_start = (os.getenv('SELFCAL_WARM_START') or 'false').lower() == 'true'
+selfcal_timeaverage = (os.getenv('SELFCAL_TIMEAVERAGE') or 'false').lower() == 'true'
+
+model_storage = os.getenv('SELFCAL_MODEL_STORAGE') or 'modelcolumn'
+if model_storage not in model_storage_modes:
+    raise ValueError("SELFCAL_MODEL_STORAGE must be one of {0}"
+                     .format(model_storage_modes))
+
 if 'do_bsens' in locals():
     os.environ['DO_BSENS'] = str(do_bsens)
 if os.getenv('DO_BSENS') is not None and os.getenv('DO_BSENS').lower() != 'false':
@@ -266,34 +359,63 @@ for continuum_ms in continuum_mses:
         selfcal_ms = basename+"_"+arrayname+"_selfcal_bsens.ms"
     else:
         selfcal_ms = basename+"_"+arrayname+"_selfcal.ms"
-    if not os.path.exists(selfcal_ms):
 
-        logprint("Did not find selfcal ms.  Creating new one: "
+    contimagename = os.path.join(imaging_root, basename) + "_" + arrayname
+    if do_bsens:
+        # just a sanity check
+        assert 'bsens' in contimagename
+
+    # the record of which stages are complete and what their inputs were
+    manifest_fn = contimagename + "_selfcal_manifest.json"
+    manifest = load_manifest(manifest_fn)
+
+    # only do robust = 0
+    robust = 0
+
+    pars_key = "{0}_{1}_{2}_robust{3}".format(field, band, arrayname, robust)
+    if do_bsens and (pars_key+"_bsens") in selfcal_pars:
+        selfcalpars = selfcal_pars[pars_key+"_bsens"]
+    else:
+        selfcalpars = selfcal_pars[pars_key]
+    solints = [selfcalpars[key]['solint'] for key in sorted(selfcalpars)]
+
+    split_hash = stage_hash(None, os.path.abspath(continuum_ms),
+                            ms_geometry_mtime(continuum_ms), field, antennae)
+    if selfcal_timeaverage:
+        # the time bin depends on the solints
+        split_hash = stage_hash(split_hash, 'timeaverage', solints)
+    if not stage_is_current(manifest, manifest_fn, 'split', split_hash,
+                            [selfcal_ms]):
+
+        logprint("Did not find an up-to-date selfcal ms.  Creating new one: "
                  "{0}".format(selfcal_ms), origin='contim_selfcal')
+        if os.path.exists(selfcal_ms):
+            rmtables(selfcal_ms)
 
         msmd.open(continuum_ms)
         fdm_spws = msmd.spwsforfield(field)
         assert len(fdm_spws) > 0
-        bws = msmd.bandwidths()[fdm_spws]
         spwstr = ",".join(map(str, fdm_spws))
-        freqs = [msmd.reffreq(spw)['m0']['value'] for spw in fdm_spws]
-        chwids = [np.mean(msmd.chanwidths(spw)) for spw in fdm_spws]
-
-        # using Roberto's numbers
-        # https://science.nrao.edu/facilities/vla/docs/manuals/oss2016A/performance/fov/bw-smearing
-        Synth_HPBW = 0.3 # Smallest synth HPBW among target sample in arcsec
-        #PB_HPBW = 21. * (300. / minfrq) # PB HPBW at lowest band freq (arcsec)
-        #targetwidth = 0.25 * (Synth_HPBW / PB_HPBW) * minfrq # 98% BW smearing criterion
-
-        width = [int(np.abs(0.25 * (Synth_HPBW / (21. * (300e9 / frq))) * frq / chwid))
-                 for frq, chwid in zip(freqs, chwids)]
-        # do not allow downsampling below 1/2 original width because that drops
-        # edge channels sometimes
-        width = [ww if float(ww)/msmd.nchan(spw) < 0.5 else int(msmd.nchan(spw)/2)
-                 for ww, spw in zip(width, fdm_spws)]
-
         msmd.close()
 
+        # average as much as the bandwidth smearing at the longest baseline
+        # of the selected antennae allows
+        smearing = averaging_limits(continuum_ms, fdm_spws, msmd,
+                                    antennae='12m' if exclude_7m else
+                                    '7m' if only_7m else 'all')
+        width = smearing['widths']
+
+        timebin = 0.
+        if selfcal_timeaverage:
+            solint_limit = solint_averaging_limit(solints)
+            maxbin = smearing['max_timebin']
+            if solint_limit is not None:
+                maxbin = min(maxbin, solint_limit)
+            timebin = time_averaging_bin(maxbin, smearing['integration'])
+            logprint("Averaging the selfcal MS over {0} s (smearing limit {1:0.1f} s, "
+                     "solints {2})".format(timebin, smearing['max_timebin'], solints),
+                     origin='contim_selfcal')
+
         tb.open(continuum_ms)
         if 'CORRECTED_DATA' in tb.colnames():
             datacolumn='corrected'
@@ -307,15 +429,29 @@ for continuum_ms in continuum_mses:
               antenna=antennae,
               spw=spwstr,
               width=width,
+              timebin='{0}s'.format(timebin),
               field=field,
              )
+        record_stage(manifest, manifest_fn, 'split', split_hash, [selfcal_ms],
+                     timebin=timebin)
 
     logprint("Selfcal MS is: "
              "{0}".format(selfcal_ms), origin='contim_selfcal')
 
-    coosys,racen,deccen = determine_phasecenter(ms=selfcal_ms, field=field)
+    if not dryrun:
+        # the model is recreated before it is needed (see the gaincal stage)
+        reset_model_storage(selfcal_ms, model_storage)
+
+    # the split only selects the antennae of this array, the spws, and the
+    # field, and averages, so the pointings and baselines of the selfcal MS
+    # are those of the same array in the continuum MS; determining the
+    # geometry from the continuum MS shares the cached results with
+    # selfcal_driver.py
+    coosys,racen,deccen = determine_phasecenter(ms=continuum_ms, field=field,
+                                                exclude_7m=exclude_7m,
+                                                only_7m=only_7m)
     phasecenter = "{0} {1}deg {2}deg".format(coosys, racen, deccen)
-    (dra,ddec,pixscale) = list(determine_imsize(ms=selfcal_ms, field=field,
+    (dra,ddec,pixscale) = list(determine_imsize(ms=continuum_ms, field=field,
                                                 phasecenter=(racen,deccen),
                                                 exclude_7m=exclude_7m,
                                                 only_7m=only_7m,
@@ -330,11 +466,6 @@ for continuum_ms in continuum_mses:
         if 'imsize' not in imaging_parameters[key]:
             imaging_parameters[key]['imsize'] = imsize
 
-    contimagename = os.path.join(imaging_root, basename) + "_" + arrayname
-    if do_bsens:
-        # just a sanity check
-        assert 'bsens' in contimagename
-
     if not os.path.exists(contimagename+".uvwave_vs_amp.png"):
         # make a diagnostic plot to show the UV distribution
         plotms(vis=selfcal_ms,
@@ -349,14 +480,14 @@ for continuum_ms in continuum_mses:
               )
 
 
-    # only do robust = 0
-    robust = 0
-
-    pars_key = "{0}_{1}_{2}_robust{3}".format(field, band, arrayname, robust)
     if do_bsens and (pars_key+"_bsens") in imaging_parameters:
         impars = imaging_parameters[pars_key+"_bsens"]
     else:
         impars = imaging_parameters[pars_key]
+    impars = copy.copy(impars)
+    # how the model column is written before gaincal (see
+    # populate_model_column); this is not a tclean parameter
+    model_population = impars.pop('model_population', 'tclean')
 
     dirty_impars = copy.copy(impars)
     dirty_impars['niter'] = 0
@@ -364,11 +495,6 @@ for continuum_ms in continuum_mses:
     # NOTE: if anything besides `maskname` and `niter` ends up with a
     # dictionary, we'll need to parse it here
 
-    if do_bsens and (pars_key+"_bsens") in selfcal_pars:
-        selfcalpars = selfcal_pars[pars_key+"_bsens"]
-    else:
-        selfcalpars = selfcal_pars[pars_key]
-
     logprint("Selfcal parameters are: {0}".format(selfcalpars),
              origin='almaimf_cont_selfcal')
 
@@ -398,23 +524,27 @@ for continuum_ms in continuum_mses:
 
     imname = contimagename+"_robust{0}_dirty_preselfcal".format(robust)
 
-    if not os.path.exists(imname+".image.tt0"):
+    dirty_hash = stage_hash(stage_token(manifest, 'split'), dirty_impars,
+                            phasecenter)
+    if not stage_is_current(manifest, manifest_fn, 'dirty_preselfcal',
+                            dirty_hash, [imname+".image.tt0"]):
         logprint("(dirty, pre-) Imaging parameters are: {0}".format(dirty_impars),
                  origin='almaimf_cont_selfcal')
         if not dryrun:
-            tclean(vis=selfcal_ms,
-                   field=field.encode(),
-                   imagename=imname,
-                   phasecenter=phasecenter,
-                   outframe='LSRK',
-                   veltype='radio',
-                   interactive=False,
-                   pbcor=True,
-                   antenna=antennae,
-                   datacolumn='data',
-                   **dirty_impars
-                  )
-            test_tclean_success()
+            remove_image_products(imname)
+            result = run_tclean(vis=selfcal_ms,
+                                field=field.encode(),
+                                imagename=imname,
+                                phasecenter=phasecenter,
+                                outframe='LSRK',
+                                veltype='radio',
+                                interactive=False,
+                                pbcor=True,
+                                antenna=antennae,
+                                datacolumn='data',
+                                origin='almaimf_cont_selfcal',
+                                **dirty_impars
+                               )
 
             ia.open(imname+".image.tt0")
             ia.sethistory(origin='almaimf_cont_selfcal',
@@ -424,6 +554,8 @@ for continuum_ms in continuum_mses:
                           history=["git_version: {0}".format(git_version),
                                    "git_date: {0}".format(git_date)])
             ia.close()
+            record_stage(manifest, manifest_fn, 'dirty_preselfcal', dirty_hash,
+                         [imname+".image.tt0"], walltime=result['walltime'])
 
     if 'maskname' not in locals():
         # either use the reclean-based mask or the dirty mask
@@ -474,27 +606,32 @@ for continuum_ms in continuum_mses:
             # remove entries that are unspecified
             del impars_thisiter[key]
 
-    if not os.path.exists(imname+".image.tt0"):
+    preselfcal_hash = stage_hash(stage_token(manifest, 'dirty_preselfcal'),
+                                 impars_thisiter, maskname,
+                                 path_signature(maskname))
+    if not stage_is_current(manifest, manifest_fn, 'preselfcal',
+                            preselfcal_hash, [imname+".image.tt0"]):
         if maskname:
             assert os.path.exists(maskname), "Mask {0} was not found.".format(maskname)
         logprint("Imaging parameters are: {0}".format(impars_thisiter),
                  origin='almaimf_cont_selfcal')
         if not dryrun:
-            tclean(vis=selfcal_ms,
-                   field=field.encode(),
-                   imagename=imname,
-                   phasecenter=phasecenter,
-                   outframe='LSRK',
-                   veltype='radio',
-                   mask=maskname,
-                   interactive=False,
-                   antenna=antennae,
-                   savemodel='modelcolumn',
-                   datacolumn='data',
-                   pbcor=True,
-                   **impars_thisiter
-                  )
-            test_tclean_success()
+            remove_image_products(imname)
+            result = run_tclean(vis=selfcal_ms,
+                                field=field.encode(),
+                                imagename=imname,
+                                phasecenter=phasecenter,
+                                outframe='LSRK',
+                                veltype='radio',
+                                mask=maskname,
+                                interactive=False,
+                                antenna=antennae,
+                                savemodel=model_storage,
+                                datacolumn='data',
+                                pbcor=True,
+                                origin='almaimf_cont_selfcal',
+                                **impars_thisiter
+                               )
             ia.open(imname+".image.tt0")
             ia.sethistory(origin='almaimf_cont_selfcal',
                           history=["{0}: {1}".format(key, val) for key, val in
@@ -506,39 +643,43 @@ for continuum_ms in continuum_mses:
 
             exportfits(imname+".image.tt0", imname+".image.tt0.fits")
             exportfits(imname+".image.tt0.pbcor", imname+".image.tt0.pbcor.fits")
+            record_stage(manifest, manifest_fn, 'preselfcal', preselfcal_hash,
+                         [imname+".image.tt0"], walltime=result['walltime'],
+                         iterdone=result['iterdone'],
+                         nmajordone=result['nmajordone'],
+                         peakres=result['peakres'],
+                         stopcode=result['stopcode'],
+                         psf_walltime=result['psf_walltime'])
 
         # CHECK FOR MODEL FAILURES!
-        ms.open(selfcal_ms)
-        model_data = ms.getdata(['MODEL_PHASE'])
-        ms.close()
-        if 'model_phase' not in model_data or np.all(model_data['model_phase'] == 0):
+        if not model_is_populated(selfcal_ms, storage=model_storage):
             logprint("SEVERE error encountered: model column was not populated!"
                      "Therefore, populated model column from {0}".format(imname),
                      origin='almaimf_cont_selfcal')
             if not dryrun:
                 populate_model_column(imname, selfcal_ms, field, impars_thisiter,
                                       phasecenter, maskname,
-                                      antennae)
+                                      antennae, method=model_population,
+                                      storage=model_storage)
         else:
             logprint("Model column was populated from pre-selfcal image.",
                      origin='almaimf_cont_selfcal')
+        # the image whose model is in the model column of the selfcal MS
+        model_column_image = imname
 
     else:
-        # populate the model column (should be from data on disk matching
-        # this format, but we don't need to - and can't - specify it)
-        # If you want to use `ft`, you need to specify this:
-        # modelname = [contimagename+"_robust{0}.model.tt0".format(robust),
-        #              contimagename+"_robust{0}.model.tt1".format(robust)]
+        # the model column is populated from this image (with
+        # populate_model_column) only if the first gaincal has to be run
+        model_column_image = None
 
-        if not dryrun:
-            populate_model_column(imname, selfcal_ms, field, impars_thisiter,
-                                  phasecenter, maskname,
-                                  antennae)
-
-        logprint("Skipped completed file {0} (dirty),"
-                 " populated model column".format(imname),
+        logprint("Skipped completed file {0} (dirty)".format(imname),
                  origin='almaimf_cont_selfcal')
 
+    impars_lastiter = impars_thisiter
+    imname_lastiter = imname
+    maskname_lastiter = maskname
+    clean_stage = 'preselfcal'
+
     # make a custom mask using the first-pass clean
     # (note: this will be replaced after each iteration if there is a file with
     # the appropriate name)
@@ -570,34 +711,19 @@ for continuum_ms in continuum_mses:
 
     okfields_list = []
     cals = []
-    skipped_any = False
 
     for selfcaliter in selfcalpars.keys():
 
         logprint("Gaincal iteration {0}".format(selfcaliter),
                  origin='contim_selfcal')
+        # measure the cost of the whole iteration (model population, gaincal,
+        # applycal, and clean)
+        iteration_t0 = time.time()
+        iteration_io = process_io_bytes()
 
         imname = contimagename+"_robust{0}_selfcal{1}".format(robust,
                                                               selfcaliter)
 
-        # iteration #1 of phase-only self-calibration
-        caltype = 'amp' if 'a' in selfcalpars[selfcaliter]['calmode'] else 'phase'
-        caltable = '{0}_{1}_{2}{3}_{4}.cal'.format(basename, arrayname, caltype, selfcaliter,
-                                                   selfcalpars[selfcaliter]['solint'])
-        if not os.path.exists(caltable):
-            #check_model_is_populated(selfcal_ms)
-            if not dryrun:
-                gaincal(vis=selfcal_ms,
-                        caltable=caltable,
-                        gaintable=cals,
-                        **selfcalpars[selfcaliter])
-        else:
-            logprint("Skipping existing caltable {0}".format(caltable),
-                     origin='contim_selfcal')
-
-        cals.append(caltable)
-
-
         # set up the imaging parameters for this round, allowing for a flexible definition
         # with either, e.g. {'niter': 1000} or {'niter': {1:1000, 2:100000, 3:999999}} etc
         impars_thisiter = copy.copy(impars)
@@ -625,36 +751,59 @@ for continuum_ms in continuum_mses:
                 # remove entries that are unspecified
                 del impars_thisiter[key]
 
+        # iteration #1 of phase-only self-calibration
+        caltype = 'amp' if 'a' in selfcalpars[selfcaliter]['calmode'] else 'phase'
+        caltable = '{0}_{1}_{2}{3}_{4}.cal'.format(basename, arrayname, caltype, selfcaliter,
+                                                   selfcalpars[selfcaliter]['solint'])
+        gaincal_stage = 'gaincal{0}'.format(selfcaliter)
+        gaincal_hash = stage_hash(stage_token(manifest, clean_stage),
+                                  selfcalpars[selfcaliter], cals)
+        if not stage_is_current(manifest, manifest_fn, gaincal_stage,
+                                gaincal_hash, [caltable]):
+            #check_model_is_populated(selfcal_ms)
+            if not dryrun:
+                if model_column_image != imname_lastiter:
+                    # the solutions must be derived from the model of the
+                    # previous iteration, which was not made in this run
+                    populate_model_column(imname_lastiter, selfcal_ms, field,
+                                          copy.copy(impars_lastiter),
+                                          phasecenter, maskname, antennae,
+                                          method=model_population,
+                                          storage=model_storage)
+                    model_column_image = imname_lastiter
+                if os.path.exists(caltable):
+                    rmtables(caltable)
+                gaincal(vis=selfcal_ms,
+                        caltable=caltable,
+                        gaintable=cals,
+                        **selfcalpars[selfcaliter])
+                record_stage(manifest, manifest_fn, gaincal_stage,
+                             gaincal_hash, [caltable])
+        else:
+            logprint("Skipping existing caltable {0}".format(caltable),
+                     origin='contim_selfcal')
+
+        cals.append(caltable)
 
-        if os.path.exists(imname+".image.tt0"):
+        clean_hash = stage_hash(stage_token(manifest, gaincal_stage),
+                                impars_thisiter, maskname,
+                                path_signature(maskname), selfcal_field_id)
+        if stage_is_current(manifest, manifest_fn,
+                            'selfcal{0}'.format(selfcaliter), clean_hash,
+                            [imname+".image.tt0", caltable+".fields"]):
             with open(caltable+".fields", 'r') as fh:
                 okfields_str = fh.read()
             okfields_list.append(okfields_str)
-            skipped_any = True
             logprint("Skipped gaincal iteration {0} - already done".format(selfcaliter),
                      origin='contim_selfcal')
-            impars_lastiter = impars_thisiter
-            continue
-        elif skipped_any:
-            if not dryrun:
-                imname_lastiter = contimagename+"_robust{0}_selfcal{1}".format(robust,
-                                                                               selfcaliter-1)
-                populate_model_column(imname_lastiter, selfcal_ms, field,
-                                      impars_lastiter, phasecenter, maskname,
-                                      antennae)
-
-
-        # start from previous model to save time
-        # (in principle, should converge anyway)
-        if selfcaliter == 1:
-            modelname = [contimagename+"_robust{0}_preselfcal.model.tt0".format(robust),
-                         contimagename+"_robust{0}_preselfcal.model.tt1".format(robust)]
         else:
-            modelname = [contimagename+"_robust{0}_selfcal{1}.model.tt0".format(robust, selfcaliter-1),
-                         contimagename+"_robust{0}_selfcal{1}.model.tt1".format(robust, selfcaliter-1)]
-
+            if not dryrun:
+                remove_image_products(imname)
 
-        if not os.path.exists(imname+".image.tt0"):
+            # start from previous model to save time
+            # (in principle, should converge anyway)
+            modelname = [imname_lastiter+".model.tt0",
+                         imname_lastiter+".model.tt1"]
 
             if 'minsnr' in selfcalpars[selfcaliter]:
                 minsnr = selfcalpars[selfcaliter]['minsnr']
@@ -693,7 +842,7 @@ for continuum_ms in continuum_mses:
             assert len(okfields_list) == len(cals)
 
             if not dryrun:
-                clearcal(vis=selfcal_ms, addmodel=True)
+                clearcal(vis=selfcal_ms, addmodel=(model_storage == 'modelcolumn'))
                 # use gainfield so we interpolate the good solutions to the other
                 # fields
                 applycal(vis=selfcal_ms,
@@ -702,35 +851,71 @@ for continuum_ms in continuum_mses:
                          interp="linear",
                          applymode='calonly',
                          calwt=False)
+                # the corrected data no longer have all of the solutions applied
+                invalidate_stage(manifest, manifest_fn, 'applycal_final')
 
             if maskname:
                 # do not run the clean if no mask exists
                 assert os.path.exists(maskname), "Mask {0} was not found.".format(maskname)
 
-            # do this even if the output file exists: we need to populate the
-            # modelcolumn
             logprint("Imaging parameters are: {0} for image name {1}".format(impars_thisiter, imname),
                      origin='almaimf_cont_selfcal')
             existing_files = glob.glob(imname+"*")
             logprint("Pre-existing files matching imname = {0}".format(existing_files),
                      origin='almaimf_cont_selfcal')
+
+            # the applycal above does not change the weights or flags, so
+            # the PSF is the same as the last iteration's unless the imaging
+            # parameters that determine it have changed
+            psf_reused_from = None
+            psf_walltime_saved = None
+            if reuse_psf and psf_is_reusable(imname_lastiter, impars_thisiter,
+                                             impars_lastiter):
+                psf_reused_from = imname_lastiter
+                lastrecord = manifest['stages'].get(clean_stage, {})
+                psf_walltime_saved = (lastrecord.get('psf_walltime') or
+                                      lastrecord.get('psf_walltime_saved'))
+                logprint("Reusing the PSF of {0} for {1} (the PSF took {2} s to make)"
+                         .format(imname_lastiter, imname, psf_walltime_saved),
+                         origin='almaimf_cont_selfcal')
+                if not dryrun:
+                    copy_psf_products(imname_lastiter, imname)
+
+            # warm start: put the previous model (and mask) in place instead
+            # of passing a startmodel
+            mask_thisiter = maskname
+            if warm_start and model_is_reusable(imname_lastiter, impars_thisiter,
+                                                impars_lastiter):
+                logprint("Warm-starting {0} from the model of {1}"
+                         .format(imname, imname_lastiter),
+                         origin='almaimf_cont_selfcal')
+                modelname = ''
+                products = ['model']
+                if maskname == maskname_lastiter and os.path.exists(imname_lastiter+".mask"):
+                    # an empty mask parameter makes tclean keep the existing mask
+                    products.append('mask')
+                    mask_thisiter = ''
+                if not dryrun:
+                    copy_image_products(imname_lastiter, imname, products)
+
             if not dryrun:
-                tclean(vis=selfcal_ms,
-                       field=field.encode(),
-                       imagename=imname,
-                       phasecenter=phasecenter,
-                       startmodel=modelname,
-                       outframe='LSRK',
-                       veltype='radio',
-                       mask=maskname,
-                       interactive=False,
-                       antenna=antennae,
-                       savemodel='modelcolumn',
-                       datacolumn='corrected', # now use corrected data
-                       pbcor=True,
-                       **impars_thisiter
-                      )
-                test_tclean_success()
+                result = run_tclean(vis=selfcal_ms,
+                                    field=field.encode(),
+                                    imagename=imname,
+                                    phasecenter=phasecenter,
+                                    startmodel=modelname,
+                                    outframe='LSRK',
+                                    veltype='radio',
+                                    mask=mask_thisiter,
+                                    interactive=False,
+                                    antenna=antennae,
+                                    savemodel=model_storage,
+                                    datacolumn='corrected', # now use corrected data
+                                    pbcor=True,
+                                    calcpsf=psf_reused_from is None,
+                                    origin='almaimf_cont_selfcal',
+                                    **impars_thisiter
+                                   )
                 ia.open(imname+".image.tt0")
                 ia.sethistory(origin='almaimf_cont_selfcal',
                               history=["{0}: {1}".format(key, val) for key, val in
@@ -744,25 +929,36 @@ for continuum_ms in continuum_mses:
                 exportfits(imname+".image.tt0.pbcor", imname+".image.tt0.pbcor.fits", overwrite=True)
 
                 # CHECK FOR MODEL FAILURES!
-                ms.open(selfcal_ms)
-                model_data = ms.getdata(['MODEL_PHASE'])
-                ms.close()
-                if 'model_phase' not in model_data or np.all(model_data['model_phase'] == 0):
+                if not model_is_populated(selfcal_ms, storage=model_storage):
                     logprint("SEVERE error encountered: model column was not populated!"
                              "Therefore, populated model column from {0}".format(imname),
                              origin='almaimf_cont_selfcal')
                     populate_model_column(imname, selfcal_ms, field, impars_thisiter,
                                           phasecenter, maskname,
-                                          antennae)
-        else:
-            with open(caltable+".fields", 'r') as fh:
-                okfields_str = fh.read()
-            okfields_list.append(okfields_str)
-            if not dryrun:
-                populate_model_column(imname, selfcal_ms, field,
-                                      impars_thisiter, phasecenter, maskname,
-                                      antennae)
-
+                                          antennae, method=model_population,
+                                          storage=model_storage)
+                model_column_image = imname
+                record_stage(manifest, manifest_fn,
+                             'selfcal{0}'.format(selfcaliter), clean_hash,
+                             [imname+".image.tt0", caltable+".fields"],
+                             walltime=result['walltime'],
+                             iterdone=result['iterdone'],
+                             nmajordone=result['nmajordone'],
+                             peakres=result['peakres'],
+                             stopcode=result['stopcode'],
+                             warm_start=modelname == '',
+                             psf_walltime=result['psf_walltime'],
+                             psf_reused_from=psf_reused_from,
+                             psf_walltime_saved=psf_walltime_saved,
+                             model_storage=model_storage,
+                             iteration_walltime=time.time() - iteration_t0,
+                             iteration_io=io_bytes_since(iteration_io),
+                             ms_size=directory_size(selfcal_ms))
+
+        impars_lastiter = impars_thisiter
+        imname_lastiter = imname
+        maskname_lastiter = maskname
+        clean_stage = 'selfcal{0}'.format(selfcaliter)
 
         regsuffix = '_selfcal{2}_robust{0}_{1}'.format(robust, arrayname,
                                                        selfcaliter)
@@ -802,8 +998,14 @@ for continuum_ms in continuum_mses:
 
     # make sure the calibration tables have been applied, otherwise re-runs can
     # result in starting from un-corrected data
-    if not dryrun:
-        clearcal(vis=selfcal_ms, addmodel=True)
+    # (this is skipped if the manifest says that the corrected data are
+    # already from the final set of solutions)
+    applycal_hash = stage_hash(stage_token(manifest, clean_stage), cals)
+    if not dryrun and not stage_is_current(manifest, manifest_fn,
+                                           'applycal_final', applycal_hash,
+                                           []):
+        invalidate_stage(manifest, manifest_fn, 'applycal_final')
+        clearcal(vis=selfcal_ms, addmodel=(model_storage == 'modelcolumn'))
         # use gainfield so we interpolate the good solutions to the other
         # fields
         assert len(cals) >= selfcaliter
@@ -817,8 +1019,12 @@ for continuum_ms in continuum_mses:
 
         applycal(vis=selfcal_ms, gainfield=okfields_list, gaintable=cals,
                  interp="linear", applymode='calonly', calwt=False)
+        record_stage(manifest, manifest_fn, 'applycal_final', applycal_hash,
+                     [])
 
 
+    finaliter_tasks = []
+    finaliter_jobs = {}
     for robust in (0, -2, 2):
         logprint("Imaging self-cal iter {0} (final) with robust {1}"
                  .format(selfcaliter, robust),
@@ -829,6 +1035,7 @@ for continuum_ms in continuum_mses:
             impars_finaliter = copy.copy(imaging_parameters[pars_key+"_bsens"])
         else:
             impars_finaliter = copy.copy(imaging_parameters[pars_key])
+        impars_finaliter.pop('model_population', None)
         if 'maskname' in impars_finaliter:
             if isinstance(impars_finaliter['maskname'], str):
                 maskname = impars_finaliter['maskname']
@@ -879,6 +1086,21 @@ for continuum_ms in continuum_mses:
 
         finaliterimname = contimagename+"_robust{0}_selfcal{1}_finaliter".format(robust,
                                                                                  selfcaliter)
+        finaliter_stage = 'finaliter_robust{0}'.format(robust)
+        finaliter_hash = stage_hash(stage_token(manifest, clean_stage),
+                                    impars_finaliter, maskname,
+                                    path_signature(maskname))
+        if stage_is_current(manifest, manifest_fn, finaliter_stage,
+                            finaliter_hash, [finaliterimname+".image.tt0"]):
+            continue
+
+        finaliter_record = manifest['stages'].get(finaliter_stage)
+        if (finaliter_record is not None and
+                finaliter_record.get('upstream') != stage_token(manifest, clean_stage)):
+            # the self-calibration has changed since this image was made, so
+            # its model cannot be used as a starting point
+            remove_image_products(finaliterimname)
+
         if 'maskname' in locals() and maskname != "" and os.path.exists(finaliterimname+".mask"):
             logprint("Removing existing mask file {0} because mask {1} exists"
                      .format(finaliterimname+".mask", maskname),
@@ -895,53 +1117,89 @@ for continuum_ms in continuum_mses:
         if not dryrun:
             logprint("Final imaging parameters are: {0} for image name {1}".format(impars_finaliter, finaliterimname),
                      origin='almaimf_cont_selfcal')
-            tclean(vis=selfcal_ms,
-                   field=field.encode(),
-                   imagename=finaliterimname,
-                   phasecenter=phasecenter,
-                   startmodel=modelname,
-                   outframe='LSRK',
-                   veltype='radio',
-                   mask=maskname,
-                   interactive=False,
-                   antenna=antennae,
-                   savemodel='none',
-                   datacolumn='corrected',
-                   pbcor=True,
-                   **impars_finaliter
-                  )
-            test_tclean_success()
-            ia.open(finaliterimname+".image.tt0")
-            ia.sethistory(origin='almaimf_cont_selfcal',
-                          history=["{0}: {1}".format(key, val) for key, val in
-                                   impars_finaliter.items()])
-            ia.sethistory(origin='almaimf_cont_imaging',
-                          history=["git_version: {0}".format(git_version),
-                                   "git_date: {0}".format(git_date)])
-            ia.close()
-            # overwrite=True because these could already exist
-            exportfits(finaliterimname+".image.tt0", finaliterimname+".image.tt0.fits", overwrite=True)
-            exportfits(finaliterimname+".image.tt0.pbcor", finaliterimname+".image.tt0.pbcor.fits", overwrite=True)
+            tclean_kwargs = dict(vis=selfcal_ms,
+                                 field=field.encode(),
+                                 imagename=finaliterimname,
+                                 phasecenter=phasecenter,
+                                 startmodel=modelname,
+                                 outframe='LSRK',
+                                 veltype='radio',
+                                 mask=maskname,
+                                 interactive=False,
+                                 antenna=antennae,
+                                 savemodel='none',
+                                 datacolumn='corrected',
+                                 pbcor=True,
+                                 **impars_finaliter
+                                )
+            # the robust values are imaged after this loop, concurrently if
+            # ROBUST_NPROC > 1, each with its own CASA log
+            logfile = (finaliterimname+".casa.log") if robust_nproc > 1 else None
+            memory = estimate_selfcal_memory(impars_finaliter['imsize'])
+            finaliter_tasks.append(make_task(finaliter_stage, tclean_task,
+                                             args=(logfile, tclean_kwargs),
+                                             kwargs=dict(origin='almaimf_cont_selfcal'),
+                                             memory=memory))
+            finaliter_jobs[finaliter_stage] = (finaliterimname, finaliter_hash,
+                                               impars_finaliter)
+
+    if finaliter_tasks:
+        finaliter_results = run_tasks(finaliter_tasks, nproc=robust_nproc,
+                                      memory_budget=robust_memory_budget,
+                                      initializer=init_tclean_worker,
+                                      raise_on_failure=False)
+    # record the images that were made even if another one failed
+    for task in finaliter_tasks:
+        finaliter_stage = task['name']
+        if finaliter_results[finaliter_stage]['status'] != 'done':
+            continue
+        result = finaliter_results[finaliter_stage]['result']
+        finaliterimname, finaliter_hash, impars_finaliter = finaliter_jobs[finaliter_stage]
+        ia.open(finaliterimname+".image.tt0")
+        ia.sethistory(origin='almaimf_cont_selfcal',
+                      history=["{0}: {1}".format(key, val) for key, val in
+                               impars_finaliter.items()])
+        ia.sethistory(origin='almaimf_cont_imaging',
+                      history=["git_version: {0}".format(git_version),
+                               "git_date: {0}".format(git_date)])
+        ia.close()
+        # overwrite=True because these could already exist
+        exportfits(finaliterimname+".image.tt0", finaliterimname+".image.tt0.fits", overwrite=True)
+        exportfits(finaliterimname+".image.tt0.pbcor", finaliterimname+".image.tt0.pbcor.fits", overwrite=True)
+        record_stage(manifest, manifest_fn, finaliter_stage,
+                     finaliter_hash, [finaliterimname+".image.tt0"],
+                     upstream=stage_token(manifest, clean_stage),
+                     walltime=result['walltime'],
+                     iterdone=result['iterdone'])
+    failed = [task['name'] for task in finaliter_tasks
+              if finaliter_results[task['name']]['status'] != 'done']
+    if failed:
+        raise ValueError("Final imaging failed for {0}; see the CASA logs"
+                         .format(failed))
 
     imname = contimagename+"_robust0_dirty_postselfcal"
 
-    if not os.path.exists(imname+".image.tt0"):
+    dirty_post_hash = stage_hash(stage_token(manifest, clean_stage),
+                                 dirty_impars, phasecenter)
+    if not stage_is_current(manifest, manifest_fn, 'dirty_postselfcal',
+                            dirty_post_hash, [imname+".image.tt0"]):
         logprint("(dirty, post-) Imaging parameters are: {0}".format(dirty_impars),
                  origin='almaimf_cont_selfcal')
         if not dryrun:
-            tclean(vis=selfcal_ms,
-                   field=field.encode(),
-                   imagename=imname,
-                   phasecenter=phasecenter,
-                   outframe='LSRK',
-                   veltype='radio',
-                   interactive=False,
-                   pbcor=True,
-                   antenna=antennae,
-                   datacolumn='corrected',
-                   **dirty_impars
-                  )
-            test_tclean_success()
+            remove_image_products(imname)
+            result = run_tclean(vis=selfcal_ms,
+                                field=field.encode(),
+                                imagename=imname,
+                                phasecenter=phasecenter,
+                                outframe='LSRK',
+                                veltype='radio',
+                                interactive=False,
+                                pbcor=True,
+                                antenna=antennae,
+                                datacolumn='corrected',
+                                origin='almaimf_cont_selfcal',
+                                **dirty_impars
+                               )
 
             ia.open(imname+".image.tt0")
             ia.sethistory(origin='almaimf_cont_selfcal',
@@ -965,6 +1223,9 @@ for continuum_ms in continuum_mses:
             fh = fits.open(imname+".image.tt0.fits")
             fh[0].data = post-pre
             fh.writeto(imname.replace("post", "post-pre")+".fits", overwrite=True)
+            record_stage(manifest, manifest_fn, 'dirty_postselfcal',
+                         dirty_post_hash, [imname+".image.tt0"],
+                         walltime=result['walltime'])
 
 
     logprint("Completed band {0}".format(band),
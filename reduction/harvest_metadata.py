@@ -0,0 +1,427 @@
+"""
+Collect the metadata of all ``.split.cal`` measurement sets in the
+science_goal* tree and assemble them into the ``metadata.json`` and
+``contdatfiles.json`` files used by ``split_windows.py`` and the imaging
+scripts.
+
+Each MS is inspected by a worker in a process pool (each worker has its own
+msmd and tb tools).  The result for each MS is written to a cache file in
+``metadata_cache/`` as soon as it is available, keyed by the MS path and the
+modification time of its ANTENNA, FIELD and SPECTRAL_WINDOW subtables (see
+``utils.ms_geometry_mtime``; the flagging done by ``split_windows.py`` does
+not invalidate it), so an interrupted run loses nothing and a re-run only
+inspects MSes that are new or have changed.
+
+This can be run on its own from CASA:
+
+    >>> %run -i ./path/to/reduction/harvest_metadata.py
+
+You can set the following environmental variables for this module:
+    METADATA_NPROC=<number>
+        The number of worker processes to use.  Defaults to the number of
+        CPUs.  Set to 1 to collect the metadata serially in this process.
+"""
+import os
+import glob
+import json
+import hashlib
+import multiprocessing
+
+import numpy as np
+
+try:
+    from taskinit import msmdtool, tbtool
+except ImportError:
+    from casatools import msmetadata as msmdtool, table as tbtool
+
+from metadata_tools import logprint
+from utils import ms_geometry_mtime
+from baseline_tools import present_baselines, max_baseline, max_pairwise_distance
+
+# band name : frequency range (GHz)
+bands = {'B3': (80, 110),
+         'B6': (210, 250),
+        }
+
+# maximum baseline length (m) above which a 12m MS is a 'long' configuration
+lb_threshold = {'B3': 750,
+                'B6': 780,}
+
+# increment this when the contents of the records change, so that older cached
+# records are regenerated
+record_version = 2
+
+# the tools are created in each worker by _init_worker
+msmd = None
+tb = None
+
+
+def _init_worker():
+    global msmd, tb
+    msmd = msmdtool()
+    tb = tbtool()
+
+
+def find_split_cal(science_goals):
+    """
+    Walk the science goal directories and return a list of (dirpath, filename)
+    tuples for each .split.cal MS found
+    """
+    found = []
+    for sg in science_goals:
+        # walk only the science goals: walking other directories can be extremely
+        # inefficient
+        for dirpath, dirnames, filenames in os.walk(sg):
+            if dirpath.count(os.path.sep) >= 5:
+                # skip over things below the sci/gro/mou/<blah>/* level
+                continue
+            for fn in dirnames:
+                if fn[-10:] == ".split.cal":
+                    found.append((dirpath, fn))
+    return found
+
+
+def cache_filename(filename, cachedir):
+    """
+    The name of the cache file for the MS ``filename``
+    """
+    key = hashlib.md5(os.path.abspath(filename).encode()).hexdigest()
+    return os.path.join(cachedir, key + ".json")
+
+
+def collect_ms_metadata(dirpath, fn):
+    """
+    Collect the metadata for a single MS and return it as a JSON-serializable
+    dictionary.  The 'status' entry is 'ok', 'tp' (total power, skipped) or
+    'failed' (msmd could not summarize the MS, skipped).
+    """
+    logprint("Collecting metadata for {0} in {1}".format(fn, dirpath))
+
+    filename = os.path.join(dirpath, fn)
+    record = {'dirpath': dirpath,
+              'vis': fn,
+              'filename': os.path.abspath(filename),
+              'mtime': ms_geometry_mtime(filename),
+              'version': record_version,
+             }
+
+    msmd.open(filename)
+
+    antnames = msmd.antennanames()
+    fieldnames = np.array(msmd.fieldnames())
+    field = fieldnames[msmd.fieldsforintent('OBSERVE_TARGET#ON_SOURCE')]
+    assert len(np.unique(field)) == 1,"ERROR: field={0} fieldnames={1}".format(field, fieldnames)
+    field = str(field[0])
+
+    band = None
+    frq0 = msmd.chanfreqs(0)
+    for bb,(lo, hi) in bands.items():
+        try:
+            if lo*1e9 < frq0 and hi*1e9 > frq0:
+                band = bb
+        except ValueError:
+            if lo*1e9 < np.min(frq0) and hi*1e9 > np.max(frq0):
+                band = bb
+    if band is None:
+        msmd.close()
+        raise ValueError("MS {0} is not in any of the bands {1}".format(filename, bands))
+
+    record.update({'field': field, 'band': band})
+
+    if any('PM' in nm for nm in antnames):
+        if len(antnames) <= 4:
+            with open(os.path.join(dirpath, "{0}_{1}_TP".format(field, band)), 'w') as fh:
+                fh.write("{0}".format(antnames))
+            logprint("Skipping total power MS {0}".format(fn))
+            msmd.close()
+            record['status'] = 'tp'
+            return record
+        else:
+            logprint("WARNING: MS {0} contains PM antennae but is apparently not a TP data set".format(fn))
+
+    try:
+        # only a probe: msmd.summary raises a RuntimeError for a corrupt MS
+        msmd.summary()
+    except RuntimeError:
+        logprint("Skipping FAILED MS {0}".format(fn))
+        msmd.close()
+        record['status'] = 'failed'
+        return record
+
+    spws = msmd.spwsforfield(field)
+    targetspws = msmd.spwsforintent('OBSERVE_TARGET*')
+    # this is how DOSPLIT in scriptForPI decides to split
+    spws = [int(ss) for ss in spws if (ss in targetspws) and (msmd.nchan(ss) > 4)]
+
+    frqs = [msmd.chanfreqs(spw) for spw in spws]
+    frqslims = [(float(frq.min()), float(frq.max())) for frq in frqs]
+
+    msmd.close()
+
+    tb.open(filename+"/ANTENNA")
+    positions = tb.getcol('POSITION')
+    tb.close()
+    # only the baselines present in the data count: a concatenated MS lists
+    # the antenna positions of configurations that never observed together
+    ant1, ant2 = present_baselines(filename, msmd=msmd, tb=tb)
+    if len(ant1) > 0:
+        max_bl = int(max_baseline(positions, ant1, ant2))
+    else:
+        max_bl = int(max_pairwise_distance(positions))
+
+    array_config = ('7M' if max_bl < 100
+                    else '12Mshort' if max_bl < lb_threshold[band]
+                    else '12Mlong')
+
+    # touch the filename
+    with open(os.path.join(dirpath, "{0}_{1}_{2}".format(field, band, array_config)), 'w') as fh:
+        fh.write("{0}".format(antnames))
+    logprint("Acquired metadata for {0} in {1}_{2}_{3} successfully"
+             .format(fn, field, band, array_config))
+
+    record.update({'status': 'ok',
+                   'spws': spws,
+                   'freqs': frqslims,
+                   # muid is 1 level above calibrated
+                   'muid': dirpath.split("/")[-2],
+                   'max_bl': max_bl,
+                   'array_config': array_config,
+                  })
+
+    return record
+
+
+def _collect_ms_metadata_star(args):
+    """
+    Run ``collect_ms_metadata``, turning an exception into a 'failed' record
+    (with the error in 'error') so that one bad MS does not end the harvest
+    """
+    dirpath, fn = args
+    try:
+        return collect_ms_metadata(dirpath, fn)
+    except Exception as ex:
+        logprint("Skipping FAILED MS {0}: {1}".format(fn, ex))
+        msmd.close()
+        filename = os.path.join(dirpath, fn)
+        return {'dirpath': dirpath,
+                'vis': fn,
+                'filename': os.path.abspath(filename),
+                'mtime': None,
+                'version': record_version,
+                'status': 'failed',
+                'error': "{0}: {1}".format(type(ex).__name__, ex),
+               }
+
+
+def load_cached_record(filename, cachedir):
+    """
+    Return the cached metadata record for MS ``filename``, or None if there is
+    no record or the MS has been modified since the record was written.
+    """
+    cachefn = cache_filename(filename, cachedir)
+    if not os.path.exists(cachefn):
+        return None
+    with open(cachefn, 'r') as fh:
+        try:
+            record = json.load(fh)
+        except ValueError:
+            # a partially-written file is treated as missing
+            return None
+    if record['mtime'] != ms_geometry_mtime(filename):
+        logprint("MS {0} has been modified since its metadata were cached"
+                 .format(filename))
+        return None
+    if record.get('version') != record_version:
+        logprint("The cached metadata of MS {0} are out of date"
+                 .format(filename))
+        return None
+    return record
+
+
+def write_cached_record(record, cachedir):
+    cachefn = cache_filename(record['filename'], cachedir)
+    # write to a temporary file first so a crash cannot leave a corrupt record
+    with open(cachefn+".tmp", 'w') as fh:
+        json.dump(record, fh)
+    os.rename(cachefn+".tmp", cachefn)
+
+
+def add_record(record, records, cachedir):
+    """
+    Add a record to ``records`` (keyed by the MS path) and cache it.  The
+    records of MSes that raised an error are not cached, so that they are
+    inspected again by the next run.
+    """
+    records[os.path.join(record['dirpath'], record['vis'])] = record
+    if 'error' not in record:
+        write_cached_record(record, cachedir)
+
+
+def find_contdat(field, band, array_config, dirpath):
+    """
+    Find the cont.dat file for an MS.  A manually-created file
+    {field}.{band}.{array}.cont.dat or {field}.{band}.cont.dat in
+    ALMAIMF_ROOTDIR overrides the pipeline's calibration/cont.dat file.
+    """
+    contfile = os.path.join(os.getenv('ALMAIMF_ROOTDIR'),
+                            "{field}.{band}.{array}.cont.dat".format(field=field, band=band, array=array_config.lower()))
+    if os.path.exists(contfile):
+        logprint("##### Found manually-created cont.dat file {0}".format(contfile))
+    else:
+        contfile = os.path.join(os.getenv('ALMAIMF_ROOTDIR'),
+                                "{field}.{band}.cont.dat".format(field=field, band=band))
+        if os.path.exists(contfile):
+            logprint("##### Found manually-created cont.dat file {0}".format(contfile))
+        else:
+            contfile = os.path.join(dirpath, '../calibration/cont.dat')
+    return contfile
+
+
+def merge_records(records):
+    """
+    Merge the per-MS metadata records into the ``metadata`` and
+    ``contdat_files`` dictionaries that are written to ``metadata.json`` and
+    ``contdatfiles.json``.  ``records`` should be in the order the MSes were
+    found so that the per-field lists are deterministic.
+    """
+    metadata = {b:{} for b in bands}
+    contdat_files = {}
+
+    ran_findcont = False
+    pipescript = glob.glob("../script/*casa_pipescript.py")
+    if len(pipescript) > 0:
+        for pscr in pipescript:
+            with open(pscr, 'r') as fh:
+                txt = fh.read()
+            if 'findcont' in txt:
+                ran_findcont = True
+    ran_findcont = "ran_findcont" if ran_findcont else "did_not_run_findcont"
+
+    for record in records:
+        if record['status'] != 'ok':
+            continue
+
+        field, band, muid = record['field'], record['band'], record['muid']
+        dirpath, max_bl = record['dirpath'], record['max_bl']
+        array_config = record['array_config']
+
+        if field in metadata[band]:
+            metadata[band][field]['path'].append(os.path.abspath(dirpath)),
+            metadata[band][field]['vis'].append(record['vis'])
+            metadata[band][field]['spws'].append(record['spws'])
+            metadata[band][field]['freqs'].append(record['freqs'])
+            metadata[band][field]['muid'].append(muid)
+        else:
+            metadata[band][field] = {'path': [os.path.abspath(dirpath)],
+                                     'vis': [record['vis']],
+                                     'spws': [record['spws']],
+                                     'freqs': [record['freqs']],
+                                     'muid': [muid],
+                                    }
+
+        if 'muid_configs' in metadata[band][field]:
+            metadata[band][field]['muid_configs'][array_config] = muid
+        else:
+            metadata[band][field]['muid_configs'] = {array_config: muid}
+
+        contfile = find_contdat(field, band, array_config, dirpath)
+
+        if os.path.exists(contfile):
+            contdatpath = os.path.realpath(contfile)
+            contdat_files[field + band + muid] = contdatpath
+
+            if 'cont.dat' in metadata[band][field]:
+                metadata[band][field]['cont.dat'][max_bl] = contdatpath
+            else:
+                metadata[band][field]['cont.dat'] = {max_bl: contdatpath}
+        else:
+            if 'cont.dat' in metadata[band][field]:
+                if max_bl in metadata[band][field]['cont.dat']:
+                    logprint("*** Found DUPLICATE KEY={max_bl} in cont.dat metadata for band={band} field={field}"
+                             .format(max_bl=max_bl, band=band, field=field))
+                else:
+                    metadata[band][field]['cont.dat'][max_bl] = 'notfound_'+ ran_findcont
+            else:
+                metadata[band][field]['cont.dat'] = {max_bl: 'notfound_'+ ran_findcont}
+            contdat_files[field + band + muid] = 'notfound_'+ ran_findcont
+
+    return metadata, contdat_files
+
+
+def harvest_metadata(science_goals=None, nproc=None, cachedir='metadata_cache'):
+    """
+    Collect the metadata for all .split.cal MSes in the science goal
+    directories, reusing cached records for MSes that have not changed.
+
+    Parameters
+    ----------
+    science_goals : list or None
+        The science goal directories to search.  Defaults to all
+        ``science_goal*`` directories in the current directory.
+    nproc : int or None
+        The number of worker processes.  Defaults to the METADATA_NPROC
+        environmental variable or the number of CPUs.
+    cachedir : str
+        The directory in which the per-MS records are cached
+
+    Returns
+    -------
+    metadata, contdat_files : dict, dict
+        The contents of ``metadata.json`` and ``contdatfiles.json``
+    """
+    if science_goals is None:
+        science_goals = glob.glob("science_goal*")
+    if nproc is None:
+        nproc = int(os.getenv('METADATA_NPROC') or multiprocessing.cpu_count())
+
+    if not os.path.exists(cachedir):
+        os.mkdir(cachedir)
+
+    found = find_split_cal(science_goals)
+
+    records = {}
+    todo = []
+    for dirpath, fn in found:
+        filename = os.path.join(dirpath, fn)
+        record = load_cached_record(filename, cachedir)
+        if record is None:
+            todo.append((dirpath, fn))
+        else:
+            records[filename] = record
+
+    logprint("Found {0} MSes: {1} have cached metadata, {2} will be inspected "
+             "with {3} processes".format(len(found), len(records), len(todo),
+                                         nproc))
+
+    if nproc > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(processes=min(nproc, len(todo)),
+                                    initializer=_init_worker)
+        try:
+            # records are written as they arrive, so an interrupted run keeps
+            # the metadata of the MSes already inspected
+            for record in pool.imap_unordered(_collect_ms_metadata_star, todo):
+                add_record(record, records, cachedir)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker()
+        for dirpath, fn in todo:
+            add_record(_collect_ms_metadata_star((dirpath, fn)), records,
+                       cachedir)
+
+    # merge in the order the files were found, not the order they completed
+    return merge_records([records[os.path.join(dirpath, fn)]
+                          for dirpath, fn in found])
+
+
+if __name__ == "__main__":
+    metadata, contdat_files = harvest_metadata()
+
+    with open('metadata.json', 'w') as fh:
+        json.dump(metadata, fh)
+
+    with open('contdatfiles.json', 'w') as fh:
+        json.dump(contdat_files, fh)
+
+    logprint("Completed metadata assembly")
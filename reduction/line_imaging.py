@@ -17,38 +17,77 @@ For now, please pick chanchunks so that nchan/chanchunks is an integer.
         fields with this name (e.g., "W43-MM1", "W51-E", etc.)
     BAND_NUMBERS=<band(s)>
         Image this/these bands.  Can be "3", "6", or "3,6" (no quotes)
-    LINE_NAME=<name>
-        Image only one line at each run.  Can be 'n2hp', 'CO' (Case insensitive)
+    LINE_NAME=<name(s)>
+        The line(s) to image: a line of ``line_parameters`` (e.g. 'n2hp',
+        'CO'; case insensitive), 'full', or 'spw<N>', a comma-separated list
+        of them, or 'all' for all the lines of ``line_parameters``.  The lines
+        are grouped by spectral window, and the concatenation, continuum
+        subtraction, and phase center and image size determination are done
+        once per window for all of its lines.
+    LINE_NPROC=<number>
+        The number of line cubes of a spectral window imaged at once.
+        Defaults to 1 (serial).  If greater than 1, each cube has its own CASA
+        log (<image name>.casa.log).
+    LINE_MEMORY_GB=<number>
+        The total memory (GB) available to the concurrent cubes.  Defaults to
+        the physical memory of the machine.
+    LINE_TASK_MEMORY_GB=<number>
+        The memory (GB) each cube (or sub-cube) is assumed to need.  Defaults
+        to 4.
+    LINE_PARTITIONS=<number>
+        If greater than 1, each line cube is split into this many contiguous
+        sub-cubes in frequency, which are imaged in LINE_NPROC processes with
+        the same spatial setup and then concatenated into the cube's image,
+        residual, model, and pb.  The cleaning threshold is still set from
+        the rms of the whole cube.  The sub-cubes (<image name>.part<N>) are
+        kept so that a rerun continues them.  Cubes without an explicit
+        channel range ('full' and 'spw<N>') are imaged whole.  Default 1.
+    LINE_PERCHANNEL_THRESHOLD=<boolean>
+        If True, a threshold given as a multiple of the rms (e.g. '5sigma')
+        follows the rms of each channel of the residual instead of the rms of
+        the whole cube: it is passed to tclean as nsigma.  The noise spectrum
+        is saved as <image name>.noise.json.  Default False.
     LOGFILENAME=<name>
         Optional.  If specified, the logger will use this filenmae
+
+The phase center and image size of each concatenated MS are cached in
+``geometry_cache.json``, so imaging further lines of the same spw does not
+recompute them.  The frequency range and channel widths of the split MSes are
+read from ``spectral_index.json`` (written by split_windows.py; see
+spectral_index.py), so matching the lines to the spectral windows does not
+open every MS.
 """
 
+import copy
 import json
 import os
-import shutil
 import numpy as np
 import astropy.units as u
 from astropy import constants
 try:
-    from tasks import tclean, uvcontsub, impbcor, concat
+    from tasks import uvcontsub, concat
     from taskinit import casalog
 except ImportError:
     # futureproofing: CASA 6 imports this way
-    from casatasks import tclean, uvcontsub, impbcor, concat
+    from casatasks import uvcontsub, concat
     from casatasks import casalog
 from parse_contdotdat import parse_contdotdat, freq_selection_overlap
-from metadata_tools import determine_imsize, determine_phasecenter, is_7m, logprint
+from metadata_tools import (determine_imsize, determine_phasecenter, is_7m,
+                            logprint)
 from imaging_parameters import line_imaging_parameters, selfcal_pars, line_parameters
-from taskinit import msmdtool, iatool, mstool
-from metadata_tools import effectiveResolutionAtFreq
-from getversion import git_date, git_version
+from taskinit import msmdtool
+from spectral_index import (load_spectral_index, write_spectral_index,
+                            get_spectral_info, line_in_range, channel_width_kms)
+from line_imaging_tools import (image_line, init_line_worker, can_partition,
+                                image_line_partitioned)
+from task_graph import make_task, run_tasks, total_memory_gb
 msmd = msmdtool()
-ia = iatool()
-ms = mstool()
 
 with open('to_image.json', 'r') as fh:
     to_image = json.load(fh)
 
+spectral_index = load_spectral_index()
+
 if os.getenv('LOGFILENAME'):
     casalog.setlogfile(os.path.join(os.getcwd(), os.getenv('LOGFILENAME')))
 
@@ -88,10 +127,21 @@ if 'only_7m' not in locals():
         only_7m = False
 
 if os.getenv('LINE_NAME'):
-    line_name = os.getenv('LINE_NAME').lower()
+    line_names = []
+    for line_name in os.getenv('LINE_NAME').lower().split(','):
+        if line_name.strip() not in line_names:
+            line_names.append(line_name.strip())
+    if 'all' in line_names and len(line_names) > 1:
+        raise ValueError("LINE_NAME=all cannot be combined with other lines")
 else:
     raise ValueError("line_name was not defined")
 
+line_nproc = int(os.getenv('LINE_NPROC') or 1)
+line_memory_budget = float(os.getenv('LINE_MEMORY_GB') or total_memory_gb())
+line_task_memory = float(os.getenv('LINE_TASK_MEMORY_GB') or 4)
+line_partitions = int(os.getenv('LINE_PARTITIONS') or 1)
+per_channel_threshold = (os.getenv('LINE_PERCHANNEL_THRESHOLD') or 'false').lower() == 'true'
+
 if 'do_contsub' not in locals():
     if os.getenv('DO_CONTSUB') is not None:
         do_contsub = bool(os.getenv('DO_CONTSUB').lower() == 'true')
@@ -107,34 +157,27 @@ else:
 chanchunks = int(os.getenv('CHANCHUNKS') or 16)
 
 
+def spectral_info(vis):
+    """
+    The spectral index record of ``vis``, extracted from the MS (and saved to
+    the index) only if it is missing or out of date
+    """
+    record, modified = get_spectral_info(spectral_index, vis, field)
+    if modified:
+        write_spectral_index(spectral_index)
+    return record
+
+
 def set_impars(impars, line_name, vis):
     if line_name not in ('full', ) + spwnames:
+        linpars = line_parameters[field][line_name]
         local_impars = {}
         if 'width' in linpars:
             local_impars['width'] = linpars['width']
         else:
             # calculate the channel width
-            chanwidths = []
-            for vv in vis:
-                msmd.open(vv)
-                count_spws = len(msmd.spwsforfield(field))
-                chanwidth = np.max([np.abs(
-                    effectiveResolutionAtFreq(vv,
-                                              spw='{0}'.format(i),
-                                              freq=u.Quantity(linpars['restfreq']).to(u.GHz),
-                                              kms=True)) for i in
-                    range(count_spws)])
-
-                # second awful check b/c Todd's script failed for some cases
-                for spw in range(count_spws):
-                    chanwidths_hz = msmd.chanwidths(int(spw))
-                    chanfreqs_hz = msmd.chanfreqs(int(spw))
-                    ckms = constants.c.to(u.km/u.s).value
-                    if any(chanwidths_hz > (chanwidth / ckms)*chanfreqs_hz):
-                        chanwidth = np.max(chanwidths_hz/chanfreqs_hz * ckms)
-                msmd.close()
-
-                chanwidths.append(chanwidth)
+            chanwidths = [channel_width_kms(spectral_info(vv), linpars['restfreq'])
+                          for vv in vis]
 
             # chanwidth: mean? max?
             chanwidth = np.mean(chanwidths)
@@ -166,8 +209,9 @@ def set_impars(impars, line_name, vis):
 robust = 0
 
 logprint("Initializing line imaging with global parameters"
-         " exclude_7m={0}, only_7m={1}, band_list={2}, field_id={3}"
-         .format(exclude_7m, only_7m, band_list, field_id),
+         " exclude_7m={0}, only_7m={1}, band_list={2}, field_id={3},"
+         " line_names={4}"
+         .format(exclude_7m, only_7m, band_list, field_id, line_names),
          origin='almaimf_line_imaging')
 
 for band in band_list:
@@ -176,6 +220,10 @@ for band in band_list:
         logprint("Found spectral windows {0} in band {1}: field {2}"
                  .format(to_image[band][field].keys(), band, field),
                  origin='almaimf_line_imaging')
+        if line_names == ['all']:
+            field_lines = sorted(line_parameters[field].keys())
+        else:
+            field_lines = line_names
         for spw in to_image[band][field]:
 
             # python 2.7 specific hack: force 'field' to be a bytestring
@@ -190,10 +238,9 @@ for band in band_list:
             skip = False
             for vv in vis:
                 if not os.path.exists(vv):
-                    logprint("Skipped spectral window {0} for line {1}"
-                             " with frequency {2} because filename {3} "
+                    logprint("Skipped spectral window {0} because filename {1} "
                              "does not exist"
-                             .format(spw, line_name, targetfreq, vv),
+                             .format(spw, vv),
                              origin='almaimf_line_imaging')
                     skip = True
             if skip:
@@ -203,32 +250,38 @@ for band in band_list:
                          origin='almaimf_line_imaging')
                 continue
 
-            # load in the line parameter info
-            if line_name not in ('full', ) + spwnames:
-                linpars = line_parameters[field][line_name]
-                restfreq = u.Quantity(linpars['restfreq'])
-                vlsr = u.Quantity(linpars['vlsr'])
-
-                # check that the line is in range
-                ms.open(vis[0])
-                # assume spw is 0 because we're working on split data
-                freqs = ms.cvelfreqs(spwids=0, outframe='LSRK') * u.Hz
-                targetfreq = restfreq * (1 - vlsr/constants.c)
-                if freqs.min() > targetfreq or freqs.max() < targetfreq:
-                    # Skip this spw: it is not in range
-                    logprint("Skipped spectral window {0} for line {1}"
-                             " with frequency {2} because it's out of range"
-                             .format(spw, line_name, targetfreq),
-                             origin='almaimf_line_imaging')
-                    continue
+            # find the lines in this spw
+            spw_lines = []
+            for line_name in field_lines:
+                if line_name == 'full':
+                    spw_lines.append(line_name)
+                elif line_name in spwnames:
+                    if line_name.lstrip("spw") != spw:
+                        logprint("Skipped spectral window {0} because it's not {1}"
+                                 .format(spw, line_name),
+                                 origin='almaimf_line_imaging')
+                        continue
+                    spw_lines.append(line_name)
                 else:
+                    # load in the line parameter info
+                    linpars = line_parameters[field][line_name]
+                    restfreq = u.Quantity(linpars['restfreq'])
+                    vlsr = u.Quantity(linpars['vlsr'])
+
+                    # check that the line is in range
+                    targetfreq = restfreq * (1 - vlsr/constants.c)
+                    if not line_in_range(spectral_info(vis[0]), targetfreq):
+                        # Skip this spw: it is not in range
+                        logprint("Skipped spectral window {0} for line {1}"
+                                 " with frequency {2} because it's out of range"
+                                 .format(spw, line_name, targetfreq),
+                                 origin='almaimf_line_imaging')
+                        continue
                     logprint("Matched spectral window {0} to line {1}"
                              .format(spw, line_name),
                              origin='almaimf_line_imaging')
-            elif line_name in spwnames and line_name.lstrip("spw") != spw:
-                logprint("Skipped spectral window {0} because it's not {1}"
-                         .format(spw, line_name),
-                         origin='almaimf_line_imaging')
+                    spw_lines.append(line_name)
+            if not spw_lines:
                 continue
 
 
@@ -292,8 +345,8 @@ for band in band_list:
                     new_freq_selection = ",".join([
                         freq_selection_overlap(ms=concatvis,
                                                freqsel=cont_freq_selection,
-                                               spw=spw)
-                        for spw in spws])
+                                               spw=spwid)
+                        for spwid in spws])
                     # Let CASA decide: All spws, here's the freqsel.  Go.
                     # (this does not work)
                     # new_freq_selection = '*:'+cont_freq_selection
@@ -308,15 +361,6 @@ for band in band_list:
                 # if do_contsub, we want to use the contsub'd MS
                 concatvis = concatvis + contsub_suffix
 
-            if 'spw' in line_name:
-                if not int(line_name.lstrip('spw')) == int(spw):
-                    raise ValueError("Line name is {0}, which does not match spw number {1}".format(line_name, spw))
-
-            lineimagename = os.path.join(imaging_root,
-                                         "{0}_{1}_spw{2}_{3}_{4}{5}"
-                                         .format(field, band, spw, arrayname,
-                                                 line_name, contsub_suffix))
-
             logprint("Measurement sets are: " + str(concatvis),
                      origin='almaimf_line_imaging')
             coosys, racen, deccen = determine_phasecenter(ms=concatvis,
@@ -334,157 +378,55 @@ for band in band_list:
             imsize = [int(dra), int(ddec)]
             cellsize = ['{0:0.2f}arcsec'.format(pixscale)] * 2
 
-            dirty_tclean_made_residual = False
-
-
             # prepare for the imaging parameters
             pars_key = "{0}_{1}_{2}_robust{3}{4}".format(field, band,
                                                          arrayname, robust,
                                                          contsub_suffix.replace(".", "_"))
-            impars = line_imaging_parameters[pars_key]
-
-            set_impars(impars=impars, line_name=line_name, vis=vis)
-
-            impars['imsize'] = imsize
-            impars['cell'] = cellsize
-            impars['phasecenter'] = phasecenter
-            impars['field'] = [field.encode()]
-
-            # start with cube imaging
-            # step 1 is dirty imaging
-
-            if not os.path.exists(lineimagename+".image") and not os.path.exists(lineimagename+".residual"):
-                if os.path.exists(lineimagename+".psf"):
-                    logprint("WARNING: The PSF for {0} exists, but no image exists."
-                             "  This likely implies that an ongoing or incomplete "
-                             "imaging run for this file exists.  It will not be "
-                             "imaged this time; please check what is happening.  "
-                             "(this warning issued /before/ dirty imaging)"
-                             .format(lineimagename),
-                             origin='almaimf_line_imaging')
-                    continue
-                # first iteration makes a dirty image to estimate the RMS
-                impars_dirty = impars.copy()
-                impars_dirty['niter'] = 0
 
-                logprint("Dirty imaging parameters are {0}".format(impars_dirty),
-                         origin='almaimf_line_imaging')
-                tclean(vis=concatvis,
-                       imagename=lineimagename,
-                       restoringbeam='', # do not use restoringbeam='common'
-                       # it results in bad edge channels dominating the beam
-                       **impars_dirty
-                      )
-                for suffix in ('image', 'residual', 'model'):
-                    ia.open(lineimagename+"."+suffix)
-                    ia.sethistory(origin='almaimf_line_imaging',
-                                  history=["{0}: {1}".format(key, val) for key, val in
-                                           impars_dirty.items()])
-                    ia.sethistory(origin='almaimf_line_imaging',
-                                  history=["git_version: {0}".format(git_version),
-                                           "git_date: {0}".format(git_date)])
-                    ia.close()
-
-                if os.path.exists(lineimagename+".image"):
-                    # tclean with niter=0 is not supposed to produce a .image file,
-                    # but if it does (and it appears to have done so on at
-                    # least one run), we still want to clean the cube
-                    dirty_tclean_made_residual = True
-            elif not os.path.exists(lineimagename+".residual"):
-                raise ValueError("The residual image is required for further imaging.")
-            else:
-                logprint("Found existing files matching {0}".format(lineimagename),
-                         origin='almaimf_line_imaging'
-                        )
+            # the concatenation, continuum subtraction, and geometry are shared
+            # by all the lines of this spw; only the cubes differ
+            line_tasks = []
+            partitioned_lines = []
+            for line_name in spw_lines:
+                lineimagename = os.path.join(imaging_root,
+                                             "{0}_{1}_spw{2}_{3}_{4}{5}"
+                                             .format(field, band, spw, arrayname,
+                                                     line_name, contsub_suffix))
 
-            if os.path.exists(lineimagename+".psf") and not os.path.exists(lineimagename+".image"):
-                logprint("WARNING: The PSF for {0} exists, but no image exists."
-                         "  This likely implies that an ongoing or incomplete "
-                         "imaging run for this file exists.  It will not be "
-                         "imaged this time; please check what is happening."
-                         "(warning issued /after/ dirty imaging)"
-                         .format(lineimagename),
-                         origin='almaimf_line_imaging')
-                # just skip the rest here
-                continue
+                # copy, because the parameters are modified for each line
+                impars = copy.deepcopy(line_imaging_parameters[pars_key])
 
-            # the threshold needs to be computed if any imaging is to be done (either contsub or not)
-            # no .image file is produced, only a residual
-            logprint("Computing residual image statistics for {0}".format(lineimagename),
-                     origin='almaimf_line_imaging')
-            ia.open(lineimagename+".residual")
-            stats = ia.statistics(robust=True)
-            rms = float(stats['medabsdevmed'] * 1.482602218505602)
-            ia.close()
-
-            if rms >= 1:
-                raise ValueError("RMS was {0} - that's absurd.".format(rms))
-            if rms > 0.01:
-                logprint("The RMS found was pretty high: {0}".format(rms),
-                         origin='almaimf_line_imaging')
+                set_impars(impars=impars, line_name=line_name, vis=vis)
 
-            continue_imaging = False
-            nsigma = None
-            if 'threshold' in impars:
-                if 'sigma' in impars['threshold']:
-                    nsigma = int(impars['threshold'].strip('sigma'))
-                    threshold = "{0:0.4f}Jy".format(nsigma*rms) # 3 rms might be OK in practice
-                    logprint("Threshold used = {0} = {2}x{1}".format(threshold, rms, nsigma),
-                             origin='almaimf_line_imaging')
-                    impars['threshold'] = threshold
-                else:
-                    threshold = impars['threshold']
-                    nsigma = (u.Quantity(threshold) / rms).to(u.Jy).value
-                    logprint("Manual threshold used = {0} = {2}x{1}"
-                             .format(threshold, rms, nsigma),
-                             origin='almaimf_line_imaging')
+                impars['imsize'] = imsize
+                impars['cell'] = cellsize
+                impars['phasecenter'] = phasecenter
+                impars['field'] = [field.encode()]
 
-                if u.Quantity(threshold).to(u.Jy).value < stats['max']:
-                    logprint("Threshold {0} was not reached (peak residual={1}).  "
-                             "Continuing imaging.".format(threshold, stats['max']),
-                             origin='almaimf_line_imaging'
-                            )
-                    # if the threshold was not reached, keep cleaning
-                    continue_imaging = True
-
-            if continue_imaging or dirty_tclean_made_residual or not os.path.exists(lineimagename+".image"):
-                # continue imaging using a threshold
-                logprint("Imaging parameters are {0}".format(impars),
+                if line_partitions > 1 and can_partition(impars):
+                    partitioned_lines.append((lineimagename, impars))
+                    continue
+                line_tasks.append(make_task(lineimagename, image_line,
+                                            args=(lineimagename, concatvis, impars),
+                                            kwargs=dict(logfile=lineimagename+".casa.log"
+                                                        if line_nproc > 1 else None,
+                                                        per_channel_threshold=per_channel_threshold),
+                                            memory=line_task_memory))
+
+            logprint("Imaging lines {0} from {1}".format(spw_lines, concatvis),
+                     origin='almaimf_line_imaging')
+            run_tasks(line_tasks, nproc=line_nproc, memory_budget=line_memory_budget,
+                      initializer=init_line_worker)
+            # the sub-cubes of each partitioned cube use all the processes
+            for lineimagename, impars in partitioned_lines:
+                logprint("Imaging {0} in {1} partitions".format(lineimagename,
+                                                                line_partitions),
                          origin='almaimf_line_imaging')
-
-                # if we're re-running to try to get to completion, we must
-                # delete the mas to enable automultithresh to continue
-                # Updating to *remove* the mask instead
-                if os.path.exists(lineimagename+".mask") and 'usemask' in impars and impars['usemask'] == "auto-multithresh":
-                    shutil.rmtree(lineimagename+".mask")
-                elif os.path.exists(lineimagename+".mask"):
-                    if 'usemask' in impars and impars['usemask'] != 'user':
-                        raise ValueError("Mask exists but not specified as user.")
-
-                tclean(vis=concatvis,
-                       imagename=lineimagename,
-                       restoringbeam='', # do not use restoringbeam='common'
-                       # it results in bad edge channels dominating the beam
-                       **impars
-                      )
-                for suffix in ('image', 'residual', 'model'):
-                    ia.open(lineimagename+"."+suffix)
-                    ia.sethistory(origin='almaimf_line_imaging',
-                                  history=["{0}: {1}".format(key, val) for key, val in
-                                           impars.items()])
-                    ia.sethistory(origin='almaimf_line_imaging',
-                                  history=["nsigma: {0}".format(nsigma)])
-                    ia.sethistory(origin='almaimf_line_imaging',
-                                  history=["git_version: {0}".format(git_version),
-                                           "git_date: {0}".format(git_date)])
-                    ia.close()
-
-                impbcor(imagename=lineimagename+'.image',
-                        pbimage=lineimagename+'.pb',
-                        outfile=lineimagename+'.image.pbcor',
-                        cutoff=0.2,
-                        overwrite=True)
-
+                image_line_partitioned(lineimagename, concatvis, impars,
+                                       line_partitions, nproc=line_nproc,
+                                       memory_budget=line_memory_budget,
+                                       task_memory=line_task_memory,
+                                       per_channel_threshold=per_channel_threshold)
 
             logprint("Completed {0}->{1}".format(vis, concatvis), origin='almaimf_line_imaging')
 
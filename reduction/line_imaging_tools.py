@@ -0,0 +1,605 @@
+"""
+Helpers for ``line_imaging.py``.
+
+The imaging of one cube (a dirty image to measure the noise, then a clean to
+a threshold set from it) is a module-level function so that the cubes of
+several lines sharing a concatenated MS can be imaged concurrently with
+``task_graph.run_tasks``.
+
+A cube can also be partitioned into contiguous sub-cubes that are imaged
+concurrently and concatenated along frequency (``image_line_partitioned``).
+The sub-cubes are named ``<image name>.part<N>`` and are kept, so a rerun
+continues cleaning them.
+
+Instead of one threshold from the rms of the whole residual cube, the
+threshold can follow the noise of each channel (``noise_spectrum``), which
+is saved next to the cube as ``<image name>.noise.json``.
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+import astropy.units as u
+
+try:
+    from tasks import impbcor, imageconcat
+    from taskinit import casalog, iatool
+except ImportError:
+    from casatasks import impbcor, imageconcat, casalog
+    from casatools import image as iatool
+
+from metadata_tools import logprint, run_tclean, init_tclean_worker, tclean_task
+from task_graph import make_task, run_tasks
+from getversion import git_date, git_version
+from utils import ms_mtime
+
+ia = iatool()
+
+
+def init_line_worker():
+    """
+    Create new CASA tools in a worker process (see ``task_graph.run_tasks``)
+    """
+    global ia
+    ia = iatool()
+    init_tclean_worker()
+
+
+def set_history(imagename, history):
+    for suffix in ('image', 'residual', 'model'):
+        ia.open(imagename+"."+suffix)
+        ia.sethistory(origin='almaimf_line_imaging', history=history)
+        ia.sethistory(origin='almaimf_line_imaging',
+                      history=["git_version: {0}".format(git_version),
+                               "git_date: {0}".format(git_date)])
+        ia.close()
+
+
+def image_line(lineimagename, concatvis, impars, logfile=None,
+               per_channel_threshold=False):
+    """
+    Image one line cube: make a dirty cube if there is none, then clean it to
+    the threshold in ``impars`` (which may be given as a multiple of the rms
+    of the dirty residual, e.g. '3sigma') unless that was already reached
+
+    Parameters
+    ----------
+    lineimagename : str
+        The image name
+    concatvis : str
+        The concatenated (and possibly continuum-subtracted) MS
+    impars : dict
+        The tclean parameters
+    logfile : str or None
+        If given, the CASA log of this cube is written to this file (and the
+        previous log file is restored afterward)
+    per_channel_threshold : bool
+        Scale a threshold given as a multiple of the rms with the rms of each
+        channel (see ``residual_threshold``)
+
+    Returns
+    -------
+    status : str
+        'imaged', 'complete' (the threshold was already reached), or
+        'in progress' (another run appears to be imaging this cube)
+    """
+    previous_logfile = casalog.logfile()
+    if logfile is not None:
+        casalog.setlogfile(logfile)
+    try:
+        return _image_line(lineimagename, concatvis, dict(impars),
+                           per_channel_threshold=per_channel_threshold)
+    finally:
+        if logfile is not None:
+            casalog.setlogfile(previous_logfile)
+
+
+def noise_filename(lineimagename):
+    return lineimagename + ".noise.json"
+
+
+def noise_spectrum(lineimagename, use_cache=True):
+    """
+    The robust rms (from the median absolute deviation) and the peak of each
+    channel of a cube's residual.  ``ia.statistics`` computes them plane by
+    plane, so the cube is not loaded at once.  The spectrum is saved in
+    ``<image name>.noise.json`` and recomputed if the residual is modified.
+
+    Returns
+    -------
+    spectrum : dict
+        'rms', 'max', and 'npts' (the number of unmasked pixels) lists with
+        one value per channel, and the 'mtime' of the residual
+    """
+    residual = lineimagename+".residual"
+    mtime = ms_mtime(residual)
+    filename = noise_filename(lineimagename)
+    if use_cache and os.path.exists(filename):
+        with open(filename, 'r') as fh:
+            try:
+                spectrum = json.load(fh)
+            except ValueError:
+                spectrum = None
+        if spectrum is not None and spectrum['mtime'] == mtime:
+            return spectrum
+
+    logprint("Computing the noise spectrum of {0}".format(residual),
+             origin='almaimf_line_imaging')
+    ia.open(residual)
+    try:
+        csys = ia.coordsys()
+        spectral_axis = int(csys.findcoordinate('spectral')['pixel'][0])
+        csys.done()
+        # collapse all the axes but the spectral one
+        axes = [ii for ii in range(len(ia.shape())) if ii != spectral_axis]
+        stats = ia.statistics(axes=axes, robust=True)
+    finally:
+        ia.close()
+
+    spectrum = {'mtime': mtime,
+                'rms': (np.ravel(stats['medabsdevmed']) * 1.482602218505602).tolist(),
+                'max': np.ravel(stats['max']).tolist(),
+                'npts': np.ravel(stats['npts']).tolist(),
+               }
+    tmpfile = filename + ".tmp{0}".format(os.getpid())
+    with open(tmpfile, 'w') as fh:
+        json.dump(spectrum, fh)
+    os.rename(tmpfile, filename)
+    return spectrum
+
+
+def residual_threshold(lineimagename, impars, per_channel=False):
+    """
+    Measure the rms of a cube's residual and set the threshold in ``impars``
+    if it is given as a multiple of the rms (e.g. '3sigma')
+
+    If ``per_channel``, such a threshold follows the rms of each channel
+    (``noise_spectrum``) instead of the rms of the whole cube: it is passed
+    to tclean as ``nsigma``, with ``threshold`` set to the lowest of the
+    per-channel thresholds, so noisy channels are not cleaned into the noise
+    and quiet ones are cleaned deeper.
+
+    Returns
+    -------
+    stats : dict
+        The residual statistics (the noise spectrum if the threshold is per
+        channel)
+    nsigma : float or None
+        The threshold in units of the rms
+    continue_imaging : bool
+        Whether the peak residual is above the threshold (in any channel)
+    """
+    if per_channel and 'sigma' in impars.get('threshold', ''):
+        spectrum = noise_spectrum(lineimagename)
+        rms = np.array(spectrum['rms'])
+        peak = np.array(spectrum['max'])
+        # fully flagged or masked channels have no noise estimate
+        valid = (np.array(spectrum['npts']) > 0) & np.isfinite(rms) & (rms > 0)
+        if valid.any():
+            return _per_channel_threshold(lineimagename, impars, spectrum,
+                                          rms[valid], peak[valid])
+        logprint("No channel of {0} has a noise estimate; using the rms of "
+                 "the whole cube".format(lineimagename),
+                 origin='almaimf_line_imaging')
+
+    # the threshold needs to be computed if any imaging is to be done (either contsub or not)
+    # no .image file is produced, only a residual
+    logprint("Computing residual image statistics for {0}".format(lineimagename),
+             origin='almaimf_line_imaging')
+    ia.open(lineimagename+".residual")
+    stats = ia.statistics(robust=True)
+    rms = float(stats['medabsdevmed'] * 1.482602218505602)
+    ia.close()
+
+    if rms >= 1:
+        raise ValueError("RMS was {0} - that's absurd.".format(rms))
+    if rms > 0.01:
+        logprint("The RMS found was pretty high: {0}".format(rms),
+                 origin='almaimf_line_imaging')
+
+    continue_imaging = False
+    nsigma = None
+    if 'threshold' in impars:
+        if 'sigma' in impars['threshold']:
+            nsigma = int(impars['threshold'].strip('sigma'))
+            threshold = "{0:0.4f}Jy".format(nsigma*rms) # 3 rms might be OK in practice
+            logprint("Threshold used = {0} = {2}x{1}".format(threshold, rms, nsigma),
+                     origin='almaimf_line_imaging')
+            impars['threshold'] = threshold
+        else:
+            threshold = impars['threshold']
+            nsigma = (u.Quantity(threshold) / rms).to(u.Jy).value
+            logprint("Manual threshold used = {0} = {2}x{1}"
+                     .format(threshold, rms, nsigma),
+                     origin='almaimf_line_imaging')
+
+        if u.Quantity(threshold).to(u.Jy).value < stats['max']:
+            logprint("Threshold {0} was not reached (peak residual={1}).  "
+                     "Continuing imaging.".format(threshold, stats['max']),
+                     origin='almaimf_line_imaging'
+                    )
+            # if the threshold was not reached, keep cleaning
+            continue_imaging = True
+
+    return stats, nsigma, continue_imaging
+
+
+def _per_channel_threshold(lineimagename, impars, spectrum, rms, peak):
+    median_rms = np.median(rms)
+    if median_rms >= 1:
+        raise ValueError("Median channel RMS was {0} - that's absurd.".format(median_rms))
+    if median_rms > 0.01:
+        logprint("The median channel RMS found was pretty high: {0}".format(median_rms),
+                 origin='almaimf_line_imaging')
+
+    nsigma = int(impars['threshold'].strip('sigma'))
+    thresholds = nsigma * rms
+    # tclean cleans each channel to max(threshold, nsigma * its rms)
+    impars['nsigma'] = nsigma
+    impars['threshold'] = "{0:0.4f}Jy".format(thresholds.min())
+    nabove = int(np.sum(peak > thresholds))
+    logprint("Per-channel thresholds of {0} = {1}x rms: {2:0.4f} to {3:0.4f} Jy "
+             "(median {4:0.4f} Jy); {5} of {6} channels have a peak residual "
+             "above their threshold"
+             .format(lineimagename, nsigma, thresholds.min(), thresholds.max(),
+                     np.median(thresholds), nabove, len(thresholds)),
+             origin='almaimf_line_imaging')
+    return spectrum, nsigma, nabove > 0
+
+
+def prepare_mask(lineimagename, impars):
+    # if we're re-running to try to get to completion, we must
+    # delete the mas to enable automultithresh to continue
+    # Updating to *remove* the mask instead
+    if os.path.exists(lineimagename+".mask") and 'usemask' in impars and impars['usemask'] == "auto-multithresh":
+        shutil.rmtree(lineimagename+".mask")
+    elif os.path.exists(lineimagename+".mask"):
+        if 'usemask' in impars and impars['usemask'] != 'user':
+            raise ValueError("Mask exists but not specified as user.")
+
+
+def _image_line(lineimagename, concatvis, impars, per_channel_threshold=False):
+    dirty_tclean_made_residual = False
+
+    # start with cube imaging
+    # step 1 is dirty imaging
+
+    if not os.path.exists(lineimagename+".image") and not os.path.exists(lineimagename+".residual"):
+        if os.path.exists(lineimagename+".psf"):
+            logprint("WARNING: The PSF for {0} exists, but no image exists."
+                     "  This likely implies that an ongoing or incomplete "
+                     "imaging run for this file exists.  It will not be "
+                     "imaged this time; please check what is happening.  "
+                     "(this warning issued /before/ dirty imaging)"
+                     .format(lineimagename),
+                     origin='almaimf_line_imaging')
+            return 'in progress'
+        # first iteration makes a dirty image to estimate the RMS
+        impars_dirty = impars.copy()
+        impars_dirty['niter'] = 0
+
+        logprint("Dirty imaging parameters are {0}".format(impars_dirty),
+                 origin='almaimf_line_imaging')
+        run_tclean(vis=concatvis,
+                   imagename=lineimagename,
+                   restoringbeam='', # do not use restoringbeam='common'
+                   # it results in bad edge channels dominating the beam
+                   check=False,
+                   origin='almaimf_line_imaging',
+                   **impars_dirty
+                  )
+        set_history(lineimagename,
+                    ["{0}: {1}".format(key, val) for key, val in
+                     impars_dirty.items()])
+
+        if os.path.exists(lineimagename+".image"):
+            # tclean with niter=0 is not supposed to produce a .image file,
+            # but if it does (and it appears to have done so on at
+            # least one run), we still want to clean the cube
+            dirty_tclean_made_residual = True
+    elif not os.path.exists(lineimagename+".residual"):
+        raise ValueError("The residual image is required for further imaging.")
+    else:
+        logprint("Found existing files matching {0}".format(lineimagename),
+                 origin='almaimf_line_imaging'
+                )
+
+    if os.path.exists(lineimagename+".psf") and not os.path.exists(lineimagename+".image"):
+        logprint("WARNING: The PSF for {0} exists, but no image exists."
+                 "  This likely implies that an ongoing or incomplete "
+                 "imaging run for this file exists.  It will not be "
+                 "imaged this time; please check what is happening."
+                 "(warning issued /after/ dirty imaging)"
+                 .format(lineimagename),
+                 origin='almaimf_line_imaging')
+        # just skip the rest here
+        return 'in progress'
+
+    stats, nsigma, continue_imaging = residual_threshold(lineimagename, impars,
+                                                         per_channel=per_channel_threshold)
+
+    if not (continue_imaging or dirty_tclean_made_residual or not os.path.exists(lineimagename+".image")):
+        return 'complete'
+
+    # continue imaging using a threshold
+    logprint("Imaging parameters are {0}".format(impars),
+             origin='almaimf_line_imaging')
+
+    prepare_mask(lineimagename, impars)
+
+    run_tclean(vis=concatvis,
+               imagename=lineimagename,
+               restoringbeam='', # do not use restoringbeam='common'
+               # it results in bad edge channels dominating the beam
+               check=False,
+               origin='almaimf_line_imaging',
+               **impars
+              )
+    set_history(lineimagename,
+                ["{0}: {1}".format(key, val) for key, val in impars.items()]
+                + ["nsigma: {0}".format(nsigma)])
+
+    impbcor(imagename=lineimagename+'.image',
+            pbimage=lineimagename+'.pb',
+            outfile=lineimagename+'.image.pbcor',
+            cutoff=0.2,
+            overwrite=True)
+    return 'imaged'
+
+
+def partition_channels(nchan, npartitions):
+    """
+    Split ``nchan`` channels into (at most) ``npartitions`` contiguous ranges
+    whose sizes differ by at most one channel.  Each range has at least two
+    channels, so that every sub-cube has per-channel beams.
+
+    Returns
+    -------
+    partitions : list
+        (first channel, number of channels) of each range
+    """
+    npartitions = max(1, min(int(npartitions), int(nchan) // 2))
+    edges = [nchan * ii // npartitions for ii in range(npartitions + 1)]
+    return [(edges[ii], edges[ii+1] - edges[ii]) for ii in range(npartitions)]
+
+
+def can_partition(impars):
+    """
+    A cube can be partitioned if its channels are given explicitly (start,
+    width, and nchan, with start and width in compatible units)
+    """
+    if not all(key in impars for key in ('start', 'width', 'nchan')):
+        return False
+    if int(impars['nchan']) < 2:
+        return False
+    return u.Quantity(impars['start']).unit.is_equivalent(u.Quantity(impars['width']).unit)
+
+
+def partition_impars(impars, npartitions):
+    """
+    The tclean parameters of the sub-cubes of a cube: each covers a
+    contiguous range of the cube's channels on the same channel grid, and
+    all have the spatial setup of the cube
+    """
+    start = u.Quantity(impars['start'])
+    width = u.Quantity(impars['width']).to(start.unit)
+    partitions = []
+    for first, nchan in partition_channels(int(impars['nchan']), npartitions):
+        part_impars = dict(impars)
+        # CASA does not accept the spaces of e.g. 'km / s'
+        part_impars['start'] = '{0:.6f}{1}'.format((start + first*width).value,
+                                                   start.unit.to_string().replace(' ', ''))
+        part_impars['nchan'] = nchan
+        if 'chanchunks' in impars:
+            part_impars['chanchunks'] = min(int(impars['chanchunks']), nchan)
+        partitions.append(part_impars)
+    return partitions
+
+
+def partition_names(lineimagename, npartitions):
+    return ['{0}.part{1}'.format(lineimagename, ii) for ii in range(npartitions)]
+
+
+def _image_grid(imagename):
+    ia.open(imagename)
+    try:
+        shape = ia.shape()
+        csys = ia.coordsys()
+        spectral_axis = int(csys.findcoordinate('spectral')['pixel'][0])
+        grid = {'shape': [nn for ii, nn in enumerate(shape) if ii != spectral_axis],
+                'nchan': shape[spectral_axis],
+               }
+        for name in ('referencevalue', 'referencepixel', 'increment'):
+            grid['direction_'+name] = getattr(csys, name)(type='direction')['numeric']
+        refval = csys.referencevalue(type='spectral')['numeric'][0]
+        refpix = csys.referencepixel(type='spectral')['numeric'][0]
+        grid['chanwidth'] = csys.increment(type='spectral')['numeric'][0]
+        # the frequency of the first channel
+        grid['freq0'] = refval - refpix * grid['chanwidth']
+        csys.done()
+    finally:
+        ia.close()
+    return grid
+
+
+def check_partitions(imagenames):
+    """
+    Check that the images of the sub-cubes of a cube, in order, can be
+    concatenated along frequency: they must have the same spatial grid and
+    channel width, and each must start one channel after the previous one
+    ends
+    """
+    grids = [_image_grid(imagename) for imagename in imagenames]
+    reference = grids[0]
+    for imagename, grid in zip(imagenames[1:], grids[1:]):
+        if (list(grid['shape']) != list(reference['shape']) or
+                not all(np.allclose(grid['direction_'+name],
+                                    reference['direction_'+name],
+                                    rtol=1e-9, atol=0)
+                        for name in ('referencevalue', 'referencepixel', 'increment'))):
+            raise ValueError("{0} does not have the spatial grid of {1}"
+                             .format(imagename, imagenames[0]))
+        if not np.isclose(grid['chanwidth'], reference['chanwidth'], rtol=1e-6, atol=0):
+            raise ValueError("{0} does not have the channel width of {1}"
+                             .format(imagename, imagenames[0]))
+    for ii in range(1, len(grids)):
+        expected = grids[ii-1]['freq0'] + grids[ii-1]['nchan'] * grids[ii-1]['chanwidth']
+        if np.abs(grids[ii]['freq0'] - expected) > 1e-3 * np.abs(reference['chanwidth']):
+            raise ValueError("{0} does not start one channel after {1} ends "
+                             "({2} Hz instead of {3} Hz)"
+                             .format(imagenames[ii], imagenames[ii-1],
+                                     grids[ii]['freq0'], expected))
+
+
+def _beam_majors(imagename):
+    """
+    Whether an image has per-channel beams, and the beam major axes (arcsec)
+    """
+    ia.open(imagename)
+    beam = ia.restoringbeam()
+    ia.close()
+    if 'beams' in beam:
+        beams = [beam['beams']['*{0}'.format(ii)]['*0'] for ii in range(beam['nChannels'])]
+    elif 'major' in beam:
+        beams = [beam]
+    else:
+        beams = []
+    return 'beams' in beam, np.array([u.Quantity(bm['major']['value'],
+                                                 bm['major']['unit']).to(u.arcsec).value
+                                      for bm in beams])
+
+
+def check_partition_beams(imagenames, tolerance=0.05):
+    """
+    Check that the restored sub-cubes all have per-channel beams, and warn if
+    the beam jumps by more than ``tolerance`` (fractionally) across the
+    boundary of two sub-cubes
+    """
+    beams = [_beam_majors(imagename) for imagename in imagenames]
+    for imagename, (per_channel, major) in zip(imagenames, beams):
+        if not per_channel:
+            raise ValueError("{0} does not have per-channel beams"
+                             .format(imagename))
+    majors = [major for per_channel, major in beams]
+    for ii in range(1, len(majors)):
+        if len(majors[ii]) == 0:
+            continue
+        jump = np.abs(majors[ii][0] - majors[ii-1][-1]) / majors[ii-1][-1]
+        if jump > tolerance:
+            logprint("WARNING: the beam major axis changes by {0:0.1%} from the "
+                     "last channel of {1} to the first of {2}"
+                     .format(jump, imagenames[ii-1], imagenames[ii]),
+                     origin='almaimf_line_imaging')
+
+
+def concat_partitions(lineimagename, npartitions, products):
+    """
+    Concatenate the ``products`` (e.g. 'image', 'residual') of the sub-cubes
+    of a cube along frequency into the products of the cube
+    """
+    for product in products:
+        imagenames = ['{0}.{1}'.format(partname, product)
+                      for partname in partition_names(lineimagename, npartitions)]
+        check_partitions(imagenames)
+        if product == 'image':
+            check_partition_beams(imagenames)
+        outfile = '{0}.{1}'.format(lineimagename, product)
+        if os.path.exists(outfile):
+            shutil.rmtree(outfile)
+        logprint("Concatenating {0} into {1}".format(imagenames, outfile),
+                 origin='almaimf_line_imaging')
+        imageconcat(inputimage=imagenames, outputimage=outfile, axis=-1,
+                    relax=False, overwrite=True)
+
+
+def image_line_partitioned(lineimagename, concatvis, impars, npartitions,
+                           nproc=1, memory_budget=None, task_memory=0,
+                           per_channel_threshold=False):
+    """
+    Image one line cube as ``npartitions`` sub-cubes in up to ``nproc``
+    processes, with the same steps as ``image_line``: dirty sub-cubes, a
+    threshold from the rms of their concatenated residual, and cleans of the
+    sub-cubes to that threshold.  The sub-cubes' image, residual, model, and
+    pb are concatenated into the products of the cube.
+
+    ``impars`` must give the channels explicitly (see ``can_partition``).
+    Each sub-cube has its own CASA log (<sub-cube name>.casa.log).  See
+    ``residual_threshold`` for ``per_channel_threshold``.
+
+    Returns
+    -------
+    status : str
+        See ``image_line``
+    """
+    impars = dict(impars)
+    partitions = partition_impars(impars, npartitions)
+    # there are fewer partitions than requested if there are fewer channels
+    npartitions = len(partitions)
+    partnames = partition_names(lineimagename, npartitions)
+
+    dirty_tasks = []
+    for partname, part_impars in zip(partnames, partitions):
+        if os.path.exists(partname+".residual"):
+            continue
+        if os.path.exists(partname+".psf"):
+            logprint("WARNING: The PSF for {0} exists, but no residual exists."
+                     "  This likely implies that an ongoing or incomplete "
+                     "imaging run for this file exists.  It will not be "
+                     "imaged this time; please check what is happening."
+                     .format(partname),
+                     origin='almaimf_line_imaging')
+            return 'in progress'
+        impars_dirty = dict(part_impars)
+        impars_dirty['niter'] = 0
+        logprint("Dirty imaging parameters of {0} are {1}".format(partname, impars_dirty),
+                 origin='almaimf_line_imaging')
+        dirty_tasks.append(make_task(partname+".dirty", tclean_task,
+                                     args=(partname+".casa.log",
+                                           dict(vis=concatvis, imagename=partname,
+                                                restoringbeam='', **impars_dirty)),
+                                     kwargs=dict(check=False,
+                                                 origin='almaimf_line_imaging'),
+                                     memory=task_memory))
+    if dirty_tasks:
+        run_tasks(dirty_tasks, nproc=nproc, memory_budget=memory_budget,
+                  initializer=init_line_worker)
+
+    # the threshold is set from the noise of the whole cube, as without
+    # partitioning
+    concat_partitions(lineimagename, npartitions, ('residual',))
+    stats, nsigma, continue_imaging = residual_threshold(lineimagename, impars,
+                                                         per_channel=per_channel_threshold)
+    if not continue_imaging and os.path.exists(lineimagename+".image"):
+        return 'complete'
+
+    logprint("Imaging parameters are {0}".format(impars),
+             origin='almaimf_line_imaging')
+    clean_tasks = []
+    for partname, part_impars in zip(partnames, partitions):
+        for key in ('threshold', 'nsigma'):
+            if key in impars:
+                part_impars[key] = impars[key]
+        prepare_mask(partname, part_impars)
+        clean_tasks.append(make_task(partname, tclean_task,
+                                     args=(partname+".casa.log",
+                                           dict(vis=concatvis, imagename=partname,
+                                                restoringbeam='', **part_impars)),
+                                     kwargs=dict(check=False,
+                                                 origin='almaimf_line_imaging'),
+                                     memory=task_memory))
+    run_tasks(clean_tasks, nproc=nproc, memory_budget=memory_budget,
+              initializer=init_line_worker)
+
+    concat_partitions(lineimagename, npartitions, ('image', 'residual', 'model', 'pb'))
+    set_history(lineimagename,
+                ["{0}: {1}".format(key, val) for key, val in impars.items()]
+                + ["nsigma: {0}".format(nsigma),
+                   "partitions: {0}".format(npartitions)])
+
+    impbcor(imagename=lineimagename+'.image',
+            pbimage=lineimagename+'.pb',
+            outfile=lineimagename+'.image.pbcor',
+            cutoff=0.2,
+            overwrite=True)
+    return 'imaged'
@@ -1,17 +1,25 @@
 import numpy as np
 import os
+import re
+import json
+import time
+import glob
+import fcntl
+import shutil
 import astropy.units as u
 from astropy import constants
 try:
     from casac import casac
     synthesisutils = casac.synthesisutils
     from taskinit import msmdtool, casalog, qatool, tbtool, mstool, iatool
-    from tasks import tclean
+    from tasks import tclean, ft, delmod
 except ImportError:
     from casatools import (quanta as qatool, table as tbtool, msmetadata as
                            msmdtool, synthesisutils, ms as mstool,
                            image as iatool)
-    from casatasks import casalog, tclean
+    from casatasks import casalog, tclean, ft, delmod
+from utils import ms_geometry_mtime
+from baseline_tools import present_baselines, max_baseline, max_pairwise_distance
 msmd = msmdtool()
 ms = mstool()
 qa = qatool()
@@ -29,9 +37,7 @@ def is_7m(ms):
     """
     Determine if a measurement set includes 7m data
     """
-    msmd.open(ms)
-    diameter = msmd.antennadiameter(0)['value']
-    msmd.close()
+    diameter = get_ms_geometry(ms)['antenna_diameters'][0]
     if diameter == 7.0:
         return True
     else:
@@ -48,59 +54,303 @@ def zero_to_2pi(x):
     return x
 
 
-def get_indiv_phasecenter(ms, field):
+# in-memory cache of get_ms_geometry results, keyed by absolute MS path
+_geometry_cache = {}
+# increment this when the contents of the geometry change, so that older
+# on-disk caches are regenerated
+geometry_version = 2
+
+def geometry_cache_filename(vis):
+    """
+    The on-disk cache of an MS's geometry is stored next to the MS
+    """
+    return os.path.abspath(vis).rstrip('/') + ".geometry.json"
+
+def extract_ms_geometry(vis):
+    """
+    Read all of the metadata that the phase center and image size
+    determinations need from an MS in one pass.
+
+    Returns
+    -------
+    geometry : dict
+        A dictionary of JSON-serializable per-field, per-antenna, and per-spw
+        quantities:
+        ``fieldnames``, ``field_has_scans``, ``field_antenna_diameter`` (the
+        diameter of the first antenna in the first scan of each field, or
+        None), ``phasecenter_ra`` and ``phasecenter_dec`` (radians, with RA
+        in 0 < r < 2pi), ``phasecenter_refer``, ``antenna_diameters``,
+        ``antenna_positions`` (3 x nant, m), ``max_baseline`` (m) for
+        'all', '12m' (all non-7m antennae), and '7m' antennae, ``reffreq``
+        (Hz, per spw), and ``spwsforfield`` (keyed by field name).  The
+        maximum baselines only include baselines present in the data.
+    """
+    logprint("Extracting the geometry of {0}".format(vis))
+
+    tb.open(vis+"/ANTENNA")
+    positions = tb.getcol('POSITION')
+    diameters = tb.getcol('DISH_DIAMETER')
+    tb.close()
+
+    msmd.open(vis)
+    fieldnames = list(msmd.fieldnames())
+    field_has_scans = []
+    field_antenna_diameter = []
+    ras, decs, refers = [], [], []
+    for fid in range(len(fieldnames)):
+        scans = msmd.scansforfield(fid)
+        field_has_scans.append(len(scans) > 0)
+        diameter = None
+        if len(scans) > 0:
+            antids = msmd.antennasforscan(scans[0])
+            if len(antids) > 0:
+                diameter = msmd.antennadiameter(antids[0])['value']
+        field_antenna_diameter.append(diameter)
+        pc = msmd.phasecenter(fid)
+        ras.append(zero_to_2pi(pc['m0']['value']))
+        decs.append(pc['m1']['value'])
+        refers.append(pc['refer'])
+    reffreq = [msmd.reffreq(spw)['m0']['value'] for spw in range(msmd.nspw())]
+    spwsforfield = {}
+    for fieldname in set(fieldnames):
+        try:
+            spwsforfield[fieldname] = [int(x) for x in msmd.spwsforfield(fieldname)]
+        except RuntimeError:
+            spwsforfield[fieldname] = []
+    msmd.close()
+
+    # only use the baselines that are present in the data: a concatenated MS
+    # lists antenna positions from configurations that never observed
+    # together
+    ant1, ant2 = present_baselines(vis, msmd=msmd, tb=tb)
+    subsets = {'all': np.ones(diameters.size, dtype='bool'),
+               '12m': diameters != 7,
+               '7m': diameters == 7,
+              }
+    if len(ant1) > 0:
+        max_baselines = {key: max_baseline(positions, ant1, ant2, antsel=sel)
+                         for key, sel in subsets.items()}
+    else:
+        logprint("No baselines found in {0}; using the distances between all "
+                 "antennae".format(vis))
+        max_baselines = {key: max_pairwise_distance(positions, antsel=sel)
+                         for key, sel in subsets.items()}
+
+    return {'version': geometry_version,
+            'mtime': ms_geometry_mtime(vis),
+            'fieldnames': fieldnames,
+            'field_has_scans': field_has_scans,
+            'field_antenna_diameter': field_antenna_diameter,
+            'phasecenter_ra': ras,
+            'phasecenter_dec': decs,
+            'phasecenter_refer': refers,
+            'antenna_diameters': diameters.tolist(),
+            'antenna_positions': positions.tolist(),
+            'max_baseline': max_baselines,
+            'reffreq': reffreq,
+            'spwsforfield': spwsforfield,
+           }
+
+def get_ms_geometry(vis):
+    """
+    Return the geometry of an MS (see ``extract_ms_geometry``), using the
+    in-memory cache or the ``<vis>.geometry.json`` file next to the MS if the
+    MS's geometry has not been modified since they were made (see
+    ``utils.ms_geometry_mtime``).
+    """
+    key = os.path.abspath(vis).rstrip('/')
+    mtime = ms_geometry_mtime(vis)
+
+    geometry = _geometry_cache.get(key)
+    if (geometry is not None and geometry['mtime'] == mtime and
+            geometry.get('version') == geometry_version):
+        return geometry
+
+    cachefile = geometry_cache_filename(vis)
+    if os.path.exists(cachefile):
+        try:
+            with open(cachefile, 'r') as fh:
+                geometry = json.load(fh)
+        except ValueError:
+            logprint("Could not read geometry cache {0}; it will be "
+                     "regenerated".format(cachefile))
+            geometry = None
+        if (geometry is not None and geometry['mtime'] == mtime and
+                geometry.get('version') == geometry_version):
+            _geometry_cache[key] = geometry
+            return geometry
+
+    geometry = extract_ms_geometry(vis)
+    _geometry_cache[key] = geometry
+    try:
+        tmpfile = cachefile + ".tmp{0}".format(os.getpid())
+        with open(tmpfile, 'w') as fh:
+            json.dump(geometry, fh)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError) as ex:
+        logprint("Could not write geometry cache {0}: {1}".format(cachefile, ex))
+
+    return geometry
+
+def get_indiv_phasecenter(ms, field, exclude_7m=False, only_7m=False):
     """
     Get the phase center of an individual field in radians
+
+    If ``exclude_7m`` or ``only_7m``, only the pointings observed with the
+    12m or the 7m antennae are used, as in ``get_indiv_imsize``
     """
     logprint("Determining phasecenter of individual {0}".format(ms))
 
-    msmd.open(ms)
-    field_matches = np.array([fld == field for fld in msmd.fieldnames()],
-                             dtype=bool)
-    field_ids, = np.where(field_matches)
+    geom = get_ms_geometry(ms)
 
     # only use the field IDs that have associated scans
-    field_id_has_scans = np.array([len(msmd.scansforfield(fid)) > 0
-                                   for fid in field_ids], dtype='bool')
-
-    ptgctrs = [msmd.phasecenter(ii) for ii in field_ids[field_id_has_scans]]
+    sel = ((np.array(geom['fieldnames']) == field) &
+           np.array(geom['field_has_scans'], dtype='bool'))
+    if exclude_7m or only_7m:
+        # the diameter of the first antenna of the first scan of each field (m)
+        antsize = np.array([np.nan if x is None else x
+                            for x in geom['field_antenna_diameter']])
+        if exclude_7m:
+            sel &= antsize > 7
+        else:
+            sel &= antsize == 7
+        assert any(sel), ("No {0} pointings of field {1} found in ms {2}"
+                          .format('12m' if exclude_7m else '7m', field, ms))
+    field_ids, = np.where(sel)
 
-    mean_ra = np.mean([zero_to_2pi(pc['m0']['value']) for pc in ptgctrs])
-    mean_dec = np.mean([pc['m1']['value'] for pc in ptgctrs])
-    csys = ptgctrs[0]['refer']
-    msmd.close()
+    mean_ra = np.mean(np.array(geom['phasecenter_ra'])[field_ids])
+    mean_dec = np.mean(np.array(geom['phasecenter_dec'])[field_ids])
+    csys = geom['phasecenter_refer'][field_ids[0]]
 
     logprint("Phasecenter of {0} is {1} {2} {3}".format(ms, mean_ra, mean_dec, csys))
 
     return mean_ra, mean_dec, csys
 
 
-def determine_phasecenter(ms, field, formatted=False):
+# persistent cache of the determine_phasecenter and determine_imsize results,
+# shared by the imaging scripts run in the same directory as to_image.json
+geometry_results_file = 'geometry_cache.json'
+
+def _ms_identity(ms):
+    mses = ms if isinstance(ms, list) else [ms]
+    return [[os.path.abspath(vis).rstrip('/'), ms_geometry_mtime(vis)] for vis in mses]
+
+def _json_default(x):
+    # numpy scalars and arrays
+    if hasattr(x, 'tolist'):
+        return x.tolist()
+    return str(x)
+
+def geometry_results_key(funcname, ms, **kwargs):
+    """
+    The key of a result in the geometry results cache: the function, the
+    path and modification time of each MS, and the other arguments
+    """
+    return json.dumps([funcname, _ms_identity(ms), kwargs], sort_keys=True,
+                      default=_json_default)
+
+def load_geometry_results():
+    if not os.path.exists(geometry_results_file):
+        return {}
+    with open(geometry_results_file, 'r') as fh:
+        try:
+            return json.load(fh)
+        except ValueError:
+            logprint("Could not read {0}; ignoring it"
+                     .format(geometry_results_file))
+            return {}
+
+def get_geometry_result(key):
+    """
+    Return the cached result for ``key``, or None
+    """
+    return load_geometry_results().get(key)
+
+def store_geometry_result(key, value):
+    """
+    Add a result to the geometry results cache, removing the results of
+    earlier versions of the same MSes.  Several scripts may share the cache
+    (e.g., the units of selfcal_driver.py), so the read-modify-write is done
+    holding a lock on ``geometry_cache.json.lock``.
+    """
+    try:
+        lockfh = open(geometry_results_file + ".lock", 'a')
+    except (IOError, OSError) as ex:
+        logprint("Could not write {0}: {1}".format(geometry_results_file, ex))
+        return
+    try:
+        fcntl.flock(lockfh, fcntl.LOCK_EX)
+        results = load_geometry_results()
+        identity = dict((path, mtime) for path, mtime in json.loads(key)[1])
+        for oldkey in list(results):
+            for path, mtime in json.loads(oldkey)[1]:
+                if path in identity and identity[path] != mtime:
+                    del results[oldkey]
+                    break
+        results[key] = value
+        try:
+            tmpfile = geometry_results_file + ".tmp{0}".format(os.getpid())
+            with open(tmpfile, 'w') as fh:
+                json.dump(results, fh, default=_json_default)
+            os.rename(tmpfile, geometry_results_file)
+        except (IOError, OSError) as ex:
+            logprint("Could not write {0}: {1}".format(geometry_results_file, ex))
+    finally:
+        # closing the file releases the lock
+        lockfh.close()
+
+def determine_phasecenter(ms, field, formatted=False, use_cache=True,
+                          exclude_7m=False, only_7m=False):
     """
     Identify the correct phasecenter for the MS (apparently, if you don't do
     this, the phase center is set to some random pointing in the mosaic)
+
+    ``exclude_7m`` and ``only_7m`` restrict the pointings to those of the 12m
+    or 7m antennae (see ``get_indiv_phasecenter``).
+
+    If ``use_cache``, the result is stored in and retrieved from
+    ``geometry_cache.json`` in the current directory, keyed by the MS paths
+    and modification times and the arguments.
     """
+    if use_cache:
+        key = geometry_results_key('determine_phasecenter', ms, field=field,
+                                   formatted=formatted, exclude_7m=exclude_7m,
+                                   only_7m=only_7m)
+        result = get_geometry_result(key)
+        if result is not None:
+            logprint("Using cached phasecenter of {0}: {1}".format(ms, result))
+            return result if formatted else tuple(result)
+
     logprint("Determining phasecenter of {0}".format(ms))
 
     if isinstance(ms, list):
-        results = [get_indiv_phasecenter(vis, field) for vis in ms]
+        results = [get_indiv_phasecenter(vis, field, exclude_7m=exclude_7m,
+                                         only_7m=only_7m)
+                   for vis in ms]
         csys = results[0][2]
 
         mean_ra = np.mean([ra for ra, dec, csys in results])
         mean_dec = np.mean([dec for ra, dec, csys in results])
     else:
-        mean_ra, mean_dec, csys = get_indiv_phasecenter(ms, field)
+        mean_ra, mean_dec, csys = get_indiv_phasecenter(ms, field,
+                                                        exclude_7m=exclude_7m,
+                                                        only_7m=only_7m)
 
     logprint("Determined phasecenter is {0} {1}deg {2}deg".format(csys,
                                                                   mean_ra*180/np.pi,
                                                                   mean_dec*180/np.pi))
 
     if formatted:
-        return "{0} {1} {2}".format(csys,
-                                    qa.angle({'value': mean_ra, 'unit': 'rad'}, form='tim')[0],
-                                    qa.angle({'value': mean_dec, 'unit': 'rad'})[0])
+        result = "{0} {1} {2}".format(csys,
+                                      qa.angle({'value': mean_ra, 'unit': 'rad'}, form='tim')[0],
+                                      qa.angle({'value': mean_dec, 'unit': 'rad'})[0])
     else:
-        return (csys, mean_ra*180/np.pi, mean_dec*180/np.pi)
+        result = (csys, mean_ra*180/np.pi, mean_dec*180/np.pi)
+
+    if use_cache:
+        store_geometry_result(key, result)
+
+    return result
 
 def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
                      min_pixscale=0.02, only_7m=False, exclude_7m=False,
@@ -116,20 +366,20 @@ def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
 
     cen_ra, cen_dec = phasecenter
 
-    msmd.open(ms)
+    geom = get_ms_geometry(ms)
+    fieldnames = np.array(geom['fieldnames'])
 
-    field_matches = np.array([fld == field for fld in msmd.fieldnames()], dtype=bool)
+    field_matches = fieldnames == field
     if not any(field_matches):
         raise ValueError("Did not find any matched for field {0}.  "
                          "The valid field names are {1}."
-                         .format(field, msmd.fieldnames()))
+                         .format(field, geom['fieldnames']))
     field_ids, = np.where(field_matches)
     logprint("Found field IDs {0} matching field name {1}."
              .format(field_ids, field))
 
     # only use the field IDs that have associated scans
-    field_id_has_scans = np.array([len(msmd.scansforfield(fid)) > 0
-                                   for fid in field_ids], dtype='bool')
+    field_id_has_scans = np.array(geom['field_has_scans'], dtype='bool')[field_ids]
 
     logprint("Field IDs {0} matching field name {1} have scans."
              .format(field_ids[field_id_has_scans], field))
@@ -139,65 +389,33 @@ def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
         logprint("Found *scanless* field IDs {0} matching field name {1}."
                  .format(noscans, field))
 
-    first_scan_for_field = [msmd.scansforfield(fid)[0]
-                            for fid,fid_ok in zip(field_ids, field_id_has_scans)
-                            if fid_ok
-                           ]
-    first_antid = [msmd.antennasforscan(scid)[0]
-                   for scid in first_scan_for_field
-                   if len(msmd.antennasforscan(scid)) > 0
-                  ]
-
-    # compute baselines to determine synth beamsize
-    tb.open(ms+"/ANTENNA")
-    positions = tb.getcol('POSITION')
-    diameters = tb.getcol('DISH_DIAMETER')
-    tb.close()
-
-    antsize = np.array([msmd.antennadiameter(antid)['value']
-                        for antid in first_antid]) # m
+    # the diameter of the first antenna of the first scan of each field (m)
+    antsize = np.array([np.nan if x is None else x
+                        for x in geom['field_antenna_diameter']])[field_ids]
+    field_ids = field_ids[field_id_has_scans & np.isfinite(antsize)]
+    antsize = antsize[field_id_has_scans & np.isfinite(antsize)]
 
     if exclude_7m:
         assert 12 in antsize, "No 12m antennae found in ms {0}".format(ms)
-        assert len(first_antid) == len(antsize) == len(first_scan_for_field) == len(field_ids[field_id_has_scans]) == (field_id_has_scans).sum()
-        first_antid = [x for x,y in zip(first_antid, antsize) if y > 7]
-        first_scan_for_field = [x for x,y in zip(first_scan_for_field, antsize) if y > 7]
-        field_ids = np.array([x for x,y in zip(field_ids[field_id_has_scans], antsize) if y > 7])
-        # this one is trivial: should be all True
-        field_id_has_scans = np.array([x for x,y in zip(field_id_has_scans[field_id_has_scans], antsize) if y > 7])
-
-        bl_sel = diameters != 7
-
-        antsize = np.array([x for x in antsize if x > 7])
+        field_ids = field_ids[antsize > 7]
+        antsize = antsize[antsize > 7]
+        max_baseline = geom['max_baseline']['12m']
         logprint("Determining pixel scale and image size for only 12m data")
     elif only_7m:
         assert 7 in antsize, "No 7m antennae found in ms {0}".format(ms)
-        assert len(first_antid) == len(antsize) == len(first_scan_for_field) == len(field_ids[field_id_has_scans]) == (field_id_has_scans).sum()
-        first_antid = [x for x,y in zip(first_antid, antsize) if y == 7]
-        first_scan_for_field = [x for x,y in zip(first_scan_for_field, antsize) if y == 7]
-        field_ids = np.array([x for x,y in zip(field_ids[field_id_has_scans], antsize) if y == 7])
-        # this one is trivial: should be all True
-        field_id_has_scans = np.array([x for x,y in zip(field_id_has_scans[field_id_has_scans], antsize) if y == 7])
-
-        bl_sel = diameters == 7
-
-        antsize = np.array([x for x in antsize if x == 7])
+        field_ids = field_ids[antsize == 7]
+        antsize = antsize[antsize == 7]
+        max_baseline = geom['max_baseline']['7m']
         logprint("Determining pixel scale and image size for only 7m data")
     else:
-        # the shape matters if any are false...
-        field_id_has_scans = field_id_has_scans[field_id_has_scans]
-        bl_sel = slice(None)
+        max_baseline = geom['max_baseline']['all']
         logprint("Determining pixel scale and image size for all data, both 7m and 12m")
 
-    # note that for concatenated MSes, this includes baselines that don't exist
-    # (i.e., it includes baselines between TM1 and TM2 positions)
-    baseline_lengths = (((positions[None,:,:]-positions.T[:,:,None])**2).sum(axis=1)**0.5)
-    max_baseline = baseline_lengths[bl_sel,:][:,bl_sel].max()
     logprint("Maximum baseline length = {0}".format(max_baseline))
 
     # because we're working with line-split data, we assume the reffreq comes
     # from spw 0
-    freq = msmd.reffreq(spw)['m0']['value'] # Hz
+    freq = geom['reffreq'][int(spw)] # Hz
     wavelength = 299792458.0/freq # m
     # go a little past the first null in each direction
     # (radians)
@@ -220,16 +438,14 @@ def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
     else:
         raise ValueError("Pixel scale was {0}\", too small".format(pixscale*206265))
 
-    pb_pix = (primary_beam_fwhm / pixscale)[field_id_has_scans]
+    pb_pix = primary_beam_fwhm / pixscale
 
 
     def r2d(x):
         return x * 180 / np.pi
 
-    ptgctrs = [msmd.phasecenter(ii) for ii in field_ids[field_id_has_scans]]
-
-    ptgctrs_ra_deg, ptgctrs_dec_deg = (np.array([r2d(zero_to_2pi(pc['m0']['value'])) for pc in ptgctrs]),
-                                       np.array([r2d(pc['m1']['value']) for pc in ptgctrs]))
+    ptgctrs_ra_deg = r2d(np.array(geom['phasecenter_ra'])[field_ids])
+    ptgctrs_dec_deg = r2d(np.array(geom['phasecenter_dec'])[field_ids])
     pix_centers_ra = (ptgctrs_ra_deg - cen_ra) / r2d(pixscale)
     pix_centers_dec = (ptgctrs_dec_deg - cen_dec) / r2d(pixscale)
 
@@ -261,8 +477,6 @@ def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
     logprint("Furthest Dec pixels from center are {0},{1}"
              .format(furthest_dec_pix_minus, furthest_dec_pix_plus))
 
-    msmd.close()
-
     dra,ddec = (furthest_ra_pix_plus-furthest_ra_pix_minus,
                 furthest_dec_pix_plus-furthest_dec_pix_minus)
 
@@ -280,7 +494,26 @@ def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
     return imsize_corrected[0], imsize_corrected[1], pixscale_as
 
 
-def determine_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4., **kwargs):
+def determine_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
+                     use_cache=True, **kwargs):
+    """
+    Determine the image size and pixel scale needed to cover all pointings
+    of ``field`` in ``ms``.  See ``get_indiv_imsize`` for the other keyword
+    arguments.  If ``use_cache``, the result is stored in and retrieved from
+    ``geometry_cache.json`` (see ``determine_phasecenter``).
+    """
+
+    if kwargs.get('makeplot'):
+        use_cache = False
+    if use_cache:
+        key = geometry_results_key('determine_imsize', ms, field=field,
+                                   phasecenter=list(phasecenter), spw=spw,
+                                   pixfraction_of_fwhm=pixfraction_of_fwhm,
+                                   **kwargs)
+        result = get_geometry_result(key)
+        if result is not None:
+            logprint("Using cached imsize of {0}: {1}".format(ms, result))
+            return tuple(result)
 
     logprint("Determining imsize of {0}".format(ms))
 
@@ -295,9 +528,7 @@ def determine_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4., **
     else:
 
         if spw=='all':
-            msmd.open(ms)
-            spws = msmd.spwsforfield(field)
-            msmd.close()
+            spws = get_ms_geometry(ms)['spwsforfield'][field]
 
             logprint("Determining imsize of all spectral windows: {0}".format(spws))
             results = [get_indiv_imsize(ms, field, phasecenter, spw,
@@ -321,6 +552,9 @@ def determine_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4., **
 
     logprint("Determined imsize is {0},{1} w/scale {2}\"".format(dra,ddec,pixscale))
 
+    if use_cache:
+        store_geometry_result(key, (int(dra), int(ddec), float(pixscale)))
+
     return int(dra), int(ddec), pixscale
 
 def determine_imsizes(mses, field, phasecenter, **kwargs):
@@ -342,8 +576,151 @@ def check_model_is_populated(msfile):
         raise ValueError("Model phase column was not populated")
     ms.close()
 
+def has_virtual_model(vis):
+    """
+    Determine whether an MS has a virtual model, i.e. one saved by tclean with
+    savemodel='virtual' or by ft with usescratch=False.  The model is
+    referenced either by a keyword of the main table or, if the MS has a
+    SOURCE table, by its SOURCE_MODEL column.
+    """
+    tb.open(vis)
+    keywords = tb.keywordnames()
+    tb.close()
+    if any(kw.startswith('definedmodel_field_') for kw in keywords):
+        return True
+    source = os.path.join(vis, 'SOURCE')
+    if not os.path.isdir(source):
+        return False
+    tb.open(source)
+    try:
+        if 'SOURCE_MODEL' not in tb.colnames():
+            return False
+        return any(tb.iscelldefined('SOURCE_MODEL', row) and
+                   len(tb.getcell('SOURCE_MODEL', row)) > 0
+                   for row in range(tb.nrows()))
+    finally:
+        tb.close()
+
+def model_is_populated(vis, storage='modelcolumn'):
+    """
+    Check that the model used by gaincal has been set: either the MODEL_DATA
+    column has nonzero phases (storage='modelcolumn') or a virtual model
+    exists (storage='virtual')
+    """
+    if storage == 'virtual':
+        return has_virtual_model(vis)
+    ms.open(vis)
+    model_data = ms.getdata(['MODEL_PHASE'])
+    ms.close()
+    return 'model_phase' in model_data and not np.all(model_data['model_phase'] == 0)
+
+model_storage_modes = ('modelcolumn', 'virtual')
+
+def reset_model_storage(vis, storage):
+    """
+    Prepare an MS for the given model storage mode.  A virtual model takes
+    precedence over the MODEL_DATA column, so virtual models are always
+    removed; for storage='virtual', the MODEL_DATA column is deleted as well
+    to free the disk space it uses.
+    """
+    if storage not in model_storage_modes:
+        raise ValueError("Model storage {0} is not one of {1}"
+                         .format(storage, model_storage_modes))
+    logprint("Removing existing models from {0} (model storage: {1})"
+             .format(vis, storage), origin='almaimf_cont_selfcal')
+    delmod(vis=vis, otf=True, scr=(storage == 'virtual'))
 
 
+
+# in-memory cache of read_spectral_windows results, keyed by absolute MS path
+_spectral_window_cache = {}
+
+def read_spectral_windows(vis):
+    """
+    Read the channel frequencies, widths, and effective resolutions (Hz) of
+    all the spectral windows of an MS with one read of each column of its
+    SPECTRAL_WINDOW table.  The result is kept in memory until the MS's
+    geometry is modified (see ``utils.ms_geometry_mtime``).
+
+    Returns
+    -------
+    spectral_windows : dict
+        'chan_freq', 'chan_width', and 'resolution', each with one array per
+        spw, and the same concatenated over all the spws ('all_chan_freq',
+        etc.) with the index of each spw's first channel in 'offsets'
+    """
+    if (not os.path.exists(vis+'/SPECTRAL_WINDOW')):
+        raise ValueError("Could not find ms (or its SPECTRAL_WINDOW table).")
+    key = os.path.abspath(vis).rstrip('/')
+    mtime = ms_geometry_mtime(vis)
+    spectral_windows = _spectral_window_cache.get(key)
+    if spectral_windows is not None and spectral_windows['mtime'] == mtime:
+        return spectral_windows
+
+    tb.open(vis+'/SPECTRAL_WINDOW')
+    try:
+        # getvarcol, unlike getcol, allows a different number of channels
+        # in each spw; its rows are named r1, r2, ...
+        columns = dict((name, tb.getvarcol(name.upper()))
+                       for name in ('chan_freq', 'chan_width', 'resolution'))
+    finally:
+        tb.close()
+
+    spectral_windows = {'mtime': mtime}
+    for name, values in columns.items():
+        spectral_windows[name] = [np.asarray(values['r{0}'.format(row+1)]).ravel()
+                                  for row in range(len(values))]
+        spectral_windows['all_'+name] = np.concatenate(spectral_windows[name])
+    nchans = [len(freqs) for freqs in spectral_windows['chan_freq']]
+    spectral_windows['offsets'] = np.concatenate([[0], np.cumsum(nchans)[:-1]]).astype('int')
+    _spectral_window_cache[key] = spectral_windows
+    return spectral_windows
+
+def effective_resolution(vis, freq, spws=None, kms=True):
+    """
+    The effective resolution of the channel nearest to ``freq`` in each spw
+    (the largest, if two channels are equally near)
+
+    Parameters
+    ----------
+    vis : str
+        The measurement set
+    freq : quantity
+        The frequency
+    spws : list or None
+        The spw IDs.  Defaults to all the spws of the MS.
+    kms : bool
+        Return the resolutions in km/s at ``freq`` instead of Hz
+
+    Returns
+    -------
+    resolutions : array
+        The absolute resolution in each spw
+    """
+    spectral_windows = read_spectral_windows(vis)
+    freq = u.Quantity(freq, u.Hz).to(u.Hz).value
+    offsets = spectral_windows['offsets']
+    # the spw of each channel, to compare it to the nearest channel of its spw
+    nchans = np.diff(np.append(offsets, len(spectral_windows['all_chan_freq'])))
+    spw_of_chan = np.repeat(np.arange(len(offsets)), nchans)
+
+    sepfreq = np.abs(spectral_windows['all_chan_freq'] - freq)
+    nearest = sepfreq == np.minimum.reduceat(sepfreq, offsets)[spw_of_chan]
+    resolution = np.where(nearest, np.abs(spectral_windows['all_resolution']), -np.inf)
+    resolutions = np.maximum.reduceat(resolution, offsets)
+    if spws is not None:
+        resolutions = resolutions[np.array(spws, dtype='int')]
+    if kms:
+        resolutions = constants.c.to(u.km/u.s).value * resolutions / freq
+    return resolutions
+
+def max_effective_resolution(vis, freq, spws=None, kms=True):
+    """
+    The largest effective resolution at ``freq`` of the spws ``spws`` (see
+    ``effective_resolution``)
+    """
+    return np.max(effective_resolution(vis, freq, spws=spws, kms=kms))
+
 def effectiveResolutionAtFreq(vis, spw, freq, kms=True):
     """
     Returns the effective resolution of a channel (in Hz or km/s)
@@ -354,48 +731,330 @@ def effectiveResolutionAtFreq(vis, spw, freq, kms=True):
     To see this information for an ASDM, use
        printLOsFromASDM(showEffective=True)
     -Todd Hunter
+
+    See ``effective_resolution`` for a faster version for many spws.
     """
-    if (not os.path.exists(vis+'/SPECTRAL_WINDOW')):
-        raise ValueError("Could not find ms (or its SPECTRAL_WINDOW table).")
-    mytb = tbtool()
-    mytb.open(vis+'/SPECTRAL_WINDOW')
+    spectral_windows = read_spectral_windows(vis)
     if (type(spw) != list and type(spw) != np.ndarray):
         spws = [int(spw)]
     else:
         spws = [int(s) for s in spw]
     bws = []
     for spw in spws:
-        chfreq = mytb.getcell('CHAN_FREQ',spw) # Hz
+        chfreq = spectral_windows['chan_freq'][spw] # Hz
         sepfreq = np.abs(chfreq-freq.to(u.Hz).value)
         ind = np.where(sepfreq==sepfreq.min())
-        bwarr = mytb.getcell('RESOLUTION',spw) # Hz
+        bwarr = spectral_windows['resolution'][spw] # Hz
         bw = bwarr[ind]
         if kms:
             bw = constants.c.to(u.km/u.s).value*bw/freq.to(u.Hz).value
         bws.append(bw)
-    mytb.close()
     if (len(bws) == 1):
         bws = bws[0]
     return bws
 
-def test_tclean_success():
-    # An EXTREMELY HACKY way to test whether tclean succeeded on the previous iteration
-    with open(casalog.logfile(), "r") as fh:
-        lines = fh.readlines()
+def _logfile_size():
+    logfile = casalog.logfile()
+    if logfile and os.path.exists(logfile):
+        return os.path.getsize(logfile)
+    return None
 
-    for line in lines[-5:]:
+def read_log_since(offset):
+    """
+    Return the lines written to the CASA log file after byte ``offset``
+    """
+    logfile = casalog.logfile()
+    if offset is None or not logfile or not os.path.exists(logfile):
+        return []
+    with open(logfile, 'r') as fh:
+        fh.seek(offset)
+        return fh.readlines()
+
+_re_iterations = re.compile(r"Completed (\d+) iterations")
+_re_stop = re.compile(r"Reached global stopping criteri(?:on|a)\s*:\s*(.*)$|"
+                      r"(Reached n-sigma threshold.*)$")
+_re_peakres = re.compile(r"Peak residual \(max,min\)[^(]*\(\s*([-+0-9.eE]+)\s*,"
+                         r"\s*([-+0-9.eE]+)\s*\)")
+_re_logtime = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)")
+
+def _log_timestamp(line):
+    match = _re_logtime.search(line)
+    if match:
+        return time.mktime(time.strptime(match.groups()[0], '%Y-%m-%d %H:%M:%S'))
+
+def parse_tclean_log(lines):
+    """
+    Extract the errors, number of iterations and major cycles, stopping
+    reason, final peak residual, and the time spent making the PSF (from the
+    "Make PSF" banner to the next step, to the resolution of the log
+    timestamps) from the log lines of one tclean call.  Values that are not
+    found are None.
+    """
+    result = {'severe': [],
+              'iterdone': None,
+              'nmajordone': None,
+              'stopcode': None,
+              'peakres': None,
+              'psf_walltime': None,
+             }
+    nmajor = 0
+    psf_start = None
+    for line in lines:
+        if 'Make PSF' in line:
+            psf_start = _log_timestamp(line)
+        elif psf_start is not None and ('Major Cycle' in line or 'Make PB' in line):
+            psf_end = _log_timestamp(line)
+            if psf_end is not None:
+                result['psf_walltime'] = psf_end - psf_start
+            psf_start = None
+        if 'SEVERE' in line:
+            result['severe'].append(line.strip())
+        match = _re_iterations.search(line)
+        if match:
+            result['iterdone'] = int(match.groups()[0])
+        if 'Major Cycle' in line and 'Run' in line:
+            nmajor += 1
+        match = _re_stop.search(line)
+        if match:
+            result['stopcode'] = [x for x in match.groups() if x][0].strip()
+        match = _re_peakres.search(line)
+        if match:
+            result['peakres'] = float(match.groups()[0])
+    if nmajor > 0:
+        result['nmajordone'] = nmajor
+    return result
+
+def test_tclean_success(result=None):
+    """
+    Raise an exception if a tclean call failed.
+
+    Parameters
+    ----------
+    result : dict or None
+        The result of ``run_tclean``.  If None, the end of the CASA log is
+        checked instead, which only detects errors in the final lines.
+    """
+    if result is not None:
+        lines = result['severe']
+    else:
+        # check the last few lines of the log without reading all of it
+        logfile = casalog.logfile()
+        with open(logfile, "r") as fh:
+            fh.seek(max(os.path.getsize(logfile) - 65536, 0))
+            lines = fh.readlines()[-5:]
+
+    for line in lines:
         if 'SEVERE  tclean::::      An error occurred running task tclean.' in line:
             raise ValueError("tclean failed.  See log for detailed error report.\n{0}".format(line))
         if 'SEVERE' in line:
             raise ValueError("SEVERE error message encountered: {0}".format(line))
 
+def run_tclean(check=True, origin='almaimf_metadata', **kwargs):
+    """
+    Run tclean and summarize what it did using its return value and the CASA
+    log messages written during the call (only the new part of the log is
+    read).
+
+    Parameters
+    ----------
+    check : bool
+        Raise an exception (see ``test_tclean_success``) if a SEVERE message
+        was logged during the call
+    kwargs :
+        The tclean parameters
+
+    Returns
+    -------
+    result : dict
+        'imagename', 'walltime' (s), 'iterdone', 'nmajordone', 'stopcode',
+        'peakres', 'psf_walltime' (s) (None if unknown), 'severe' (the SEVERE
+        log lines), and 'return' (tclean's return value)
+    """
+    offset = _logfile_size()
+    t0 = time.time()
+    returned = tclean(**kwargs)
+    walltime = time.time() - t0
+
+    result = parse_tclean_log(read_log_since(offset))
+    result['imagename'] = kwargs.get('imagename')
+    result['walltime'] = walltime
+    result['return'] = returned
+    # newer versions of tclean return a summary dictionary
+    if isinstance(returned, dict):
+        for key in ('iterdone', 'nmajordone', 'stopcode'):
+            if key in returned:
+                result[key] = returned[key]
+        if 'stopDescription' in returned:
+            result['stopcode'] = returned['stopDescription']
+
+    logprint("tclean {0}: {1} iterations in {2} major cycles, stopped by: {3}, "
+             "peak residual {4}, wall time {5:0.1f}s"
+             .format(result['imagename'], result['iterdone'],
+                     result['nmajordone'], result['stopcode'],
+                     result['peakres'], walltime),
+             origin=origin)
+
+    if check:
+        test_tclean_success(result)
+
+    return result
+
+
+def init_tclean_worker():
+    """
+    Create new CASA tools in a worker process (see ``task_graph.run_tasks``)
+    """
+    global msmd, ms, qa, st, tb, ia
+    msmd = msmdtool()
+    ms = mstool()
+    qa = qatool()
+    st = synthesisutils()
+    tb = tbtool()
+    ia = iatool()
+
+
+def tclean_task(logfile, tclean_kwargs, check=True, origin='almaimf_metadata'):
+    """
+    Run tclean as a task of ``task_graph.run_tasks``, so that several tclean
+    runs can proceed at once in separate processes
+
+    Parameters
+    ----------
+    logfile : str or None
+        If given, the CASA log of this run is written to this file (and the
+        previous log file is restored afterward)
+    tclean_kwargs : dict
+        The tclean parameters
+    check, origin :
+        See ``run_tclean``
+
+    Returns
+    -------
+    result : dict
+        The ``run_tclean`` summary
+    """
+    previous_logfile = casalog.logfile()
+    if logfile is not None:
+        # create the file so run_tclean can find the start of this run's log
+        open(logfile, 'a').close()
+        casalog.setlogfile(logfile)
+    try:
+        return run_tclean(check=check, origin=origin, **tclean_kwargs)
+    finally:
+        if logfile is not None:
+            casalog.setlogfile(previous_logfile)
+
+
+# the tclean parameters that the PSF (and the sum of weights, weight, and
+# primary beam images made with it) depend on, besides the visibilities and
+# their weights
+psf_parameter_keys = ('imsize', 'cell', 'weighting', 'robust', 'npixels',
+                      'uvtaper', 'uvrange', 'spw', 'stokes', 'specmode',
+                      'reffreq', 'gridder', 'wprojplanes', 'facets',
+                      'deconvolver', 'nterms', 'mosweight', 'pblimit',
+                      'normtype', 'perchanweightdensity', 'psfphasecenter',
+                      'vptable', 'usepointing', 'conjbeams')
+
+# the image products made along with the PSF that tclean needs when it is run
+# with calcpsf=False
+psf_products = ('psf', 'sumwt', 'weight', 'pb')
+
+def psf_parameters(impars):
+    """
+    The subset of the imaging parameters ``impars`` that determines the PSF
+    """
+    return {key: impars[key] for key in psf_parameter_keys if key in impars}
+
+def psf_is_reusable(imname, impars, previous_impars):
+    """
+    Determine whether an image can be made with the PSF of a previous image
+    ``imname`` of the same MS, i.e. whether the PSF products exist and the
+    PSF-determining imaging parameters are the same.  The caller must make
+    sure the weights and flags of the visibilities have not changed (e.g.,
+    only calwt=False, applymode='calonly' applycal runs in between).
+    """
+    if psf_parameters(impars) != psf_parameters(previous_impars):
+        return False
+    suffix = ".tt0" if impars.get('deconvolver') == 'mtmfs' else ""
+    return (os.path.exists(imname + ".psf" + suffix) and
+            os.path.exists(imname + ".sumwt" + suffix))
+
+def copy_image_products(imname, target_imname, products):
+    """
+    Copy the image products (e.g., 'psf', 'model'; all Taylor terms) of
+    ``imname`` to the image name ``target_imname``.  Returns the copied
+    products.
+    """
+    copied = []
+    for product in products:
+        for fn in (glob.glob("{0}.{1}".format(imname, product)) +
+                   glob.glob("{0}.{1}.tt*".format(imname, product))):
+            target = target_imname + fn[len(imname):]
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            shutil.copytree(fn, target)
+            copied.append(target)
+    logprint("Copied the {0} products of {1} to {2}: {3}"
+             .format(products, imname, target_imname, copied))
+    return copied
+
+def copy_psf_products(imname, target_imname):
+    """
+    Copy the PSF, sum of weights, weight, and primary beam images of
+    ``imname`` to the image name ``target_imname`` so that tclean can be run
+    on ``target_imname`` with calcpsf=False.  Returns the copied products.
+    """
+    return copy_image_products(imname, target_imname, psf_products)
+
+# the tclean parameters that determine the pixels of the model image
+model_parameter_keys = ('imsize', 'cell', 'specmode', 'reffreq', 'deconvolver',
+                        'nterms', 'stokes', 'projection')
+
+def model_is_reusable(imname, impars, previous_impars):
+    """
+    Determine whether the model of a previous image ``imname`` can be used
+    as-is as the starting model of an image with parameters ``impars``, i.e.
+    whether it exists and has the same pixels (the phase center is assumed to
+    be the same)
+    """
+    if ({key: impars.get(key) for key in model_parameter_keys} !=
+            {key: previous_impars.get(key) for key in model_parameter_keys}):
+        return False
+    suffix = ".tt0" if impars.get('deconvolver') == 'mtmfs' else ""
+    return os.path.exists(imname + ".model" + suffix)
+
+
+model_population_methods = ('tclean', 'predict', 'ft')
 
 def populate_model_column(imname, selfcal_ms, field, impars_thisiter,
                           phasecenter, maskname, antennae,
-                          startmodel=''):
-    # run tclean to repopulate the modelcolumn prior to gaincal
-    # (force niter = 0 so we don't clean any more)
-
+                          startmodel='', method='tclean',
+                          storage='modelcolumn'):
+    """
+    Write the model of the image ``imname`` into the MODEL_DATA column of
+    ``selfcal_ms`` prior to gaincal (or, with storage='virtual', save it as a
+    virtual model that gaincal evaluates on the fly).
+
+    ``method`` selects how this is done:
+
+        'tclean': run tclean with niter=0 and calcres=True.  This recomputes
+            the residual (a full major cycle) only to save the model.
+        'predict': run tclean with niter=0, calcres=False, and calcpsf=False,
+            so the existing ``.model.tt*`` images are only degridded into the
+            model column and the image products are left unchanged.  The
+            ``.psf.tt*`` images of ``imname`` must exist.
+        'ft': use ``ft`` on the ``.model.tt*`` images.  ``ft`` does not apply
+            the primary beam, so it is only used with the 'standard' gridder;
+            'predict' is used for mosaics.
+
+    Returns the wall time (s) spent populating the model column.
+    """
+    if method not in model_population_methods:
+        raise ValueError("Model population method {0} is not one of {1}"
+                         .format(method, model_population_methods))
+    if storage not in model_storage_modes:
+        raise ValueError("Model storage {0} is not one of {1}"
+                         .format(storage, model_storage_modes))
 
     # bugfix: for no reason at all, the reference frequency can change.
     # tclean chokes if it gets the wrong reffreq.
@@ -403,58 +1062,88 @@ def populate_model_column(imname, selfcal_ms, field, impars_thisiter,
     reffreq = "{0}Hz".format(ia.coordsys().referencevalue()['numeric'][3])
     ia.close()
 
-    # have to remove mask for tclean to work
-    os.system('rm -r {0}.mask'.format(imname))
     impars_thisiter['niter'] = 0
-    logprint("(dirty) Imaging parameters are: {0}".format(impars_thisiter),
-             origin='almaimf_cont_selfcal')
-    logprint("This tclean run with zero iterations is only being done to "
-             "populate the model column from image {0}.".format(imname),
-             origin='almaimf_cont_selfcal')
+
+    if method == 'ft' and impars_thisiter.get('gridder', 'standard') != 'standard':
+        logprint("ft cannot predict a model imaged with gridder={0}; using "
+                 "method='predict' instead"
+                 .format(impars_thisiter['gridder']),
+                 origin='almaimf_cont_selfcal')
+        method = 'predict'
+
+    t0 = time.time()
+
+    if method == 'ft':
+        nterms = impars_thisiter.get('nterms', 2)
+        modelname = [imname+".model.tt{0}".format(ii) for ii in range(nterms)]
+        logprint("Using ft to populate the model column from {0}"
+                 .format(modelname),
+                 origin='almaimf_cont_selfcal')
+        ft(vis=selfcal_ms,
+           field=field.encode(),
+           model=modelname,
+           nterms=nterms,
+           reffreq=reffreq,
+           usescratch=(storage == 'modelcolumn'))
+        return time.time() - t0
+
+    tclean_pars = dict(impars_thisiter)
+    if method == 'tclean':
+        # have to remove mask for tclean to work
+        os.system('rm -r {0}.mask'.format(imname))
+        logprint("(dirty) Imaging parameters are: {0}".format(impars_thisiter),
+                 origin='almaimf_cont_selfcal')
+        logprint("This tclean run with zero iterations is only being done to "
+                 "populate the model column from image {0}.".format(imname),
+                 origin='almaimf_cont_selfcal')
+        tclean_pars.update(dict(mask=maskname,
+                                pbcor=True,
+                                calcres=True,
+                                calcpsf=False))
+    else:
+        logprint("Predicting the model column from {0}.model.tt* without "
+                 "recomputing the residual.".format(imname),
+                 origin='almaimf_cont_selfcal')
+        tclean_pars.update(dict(calcres=False,
+                                calcpsf=False,
+                                restoration=False,
+                                pbcor=False))
+
     try:
-        tclean(vis=selfcal_ms,
-                     field=field.encode(),
-                     imagename=imname,
-                     phasecenter=phasecenter,
-                     outframe='LSRK',
-                     veltype='radio',
-                     mask=maskname,
-                     interactive=False,
-                     antenna=antennae,
-                     #reffreq=reffreq,
-                     startmodel=startmodel,
-                     savemodel='modelcolumn',
-                     datacolumn='corrected',
-                     pbcor=True,
-                     calcres=True,
-                     calcpsf=False,
-                     **impars_thisiter
-                    )
-        test_tclean_success()
+        run_tclean(vis=selfcal_ms,
+                   field=field.encode(),
+                   imagename=imname,
+                   phasecenter=phasecenter,
+                   outframe='LSRK',
+                   veltype='radio',
+                   interactive=False,
+                   antenna=antennae,
+                   startmodel=startmodel,
+                   savemodel=storage,
+                   datacolumn='corrected',
+                   origin='almaimf_cont_selfcal',
+                   **tclean_pars
+                  )
     except Exception as ex:
         print(ex)
         logprint("tclean FAILED with reffreq unspecified."
                  "  Trying again with reffreq={0}.".format(reffreq),
                  origin='almaimf_cont_selfcal')
-        tclean(vis=selfcal_ms,
-               field=field.encode(),
-               imagename=imname,
-               phasecenter=phasecenter,
-               outframe='LSRK',
-               veltype='radio',
-               mask=maskname,
-               interactive=False,
-               antenna=antennae,
-               reffreq=reffreq,
-               startmodel=startmodel,
-               savemodel='modelcolumn',
-               datacolumn='corrected',
-               pbcor=True,
-               calcres=True,
-               calcpsf=False,
-               **impars_thisiter
-              )
-        test_tclean_success()
+        tclean_pars['reffreq'] = reffreq
+        run_tclean(vis=selfcal_ms,
+                   field=field.encode(),
+                   imagename=imname,
+                   phasecenter=phasecenter,
+                   outframe='LSRK',
+                   veltype='radio',
+                   interactive=False,
+                   antenna=antennae,
+                   startmodel=startmodel,
+                   savemodel=storage,
+                   datacolumn='corrected',
+                   origin='almaimf_cont_selfcal',
+                   **tclean_pars
+                  )
 
     # # even if this works, I hate it.
     # if not success:
@@ -511,3 +1200,5 @@ def populate_model_column(imname, selfcal_ms, field, impars_thisiter,
     # if not success:
     #     raise ValueError("tclean failed to restore the model {0}.model* "
     #                      "into the model column".format(imname))
+
+    return time.time() - t0
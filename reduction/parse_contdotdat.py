@@ -1,24 +1,186 @@
-import numpy as np
+"""
+Parse cont.dat files and map their frequency selections to channels.
+
+Only ``freq_selection_overlap`` and ``cont_channel_selection_to_contdotdat``
+need CASA (they read measurement sets); the CASA tools are imported when they
+are called, so the parsing and channel mapping can be used outside of CASA
+(e.g., by the analysis scripts).
+
+cont.dat files are parsed into a structure (see ``read_contdotdat``) that is
+cached in memory and in ``contdat_cache/`` (or the directory given by the
+CONTDAT_CACHE_DIR environmental variable), keyed by the file's path and
+modification time, so the many scripts that read the same files only parse
+them once.
+"""
+import os
 import string
-try:
-    from __casac__.quanta import quanta
-    from taskinit import msmdtool
-except (ImportError, ModuleNotFoundError):
-    from casatools import quanta
-    from casatools import msmetadata as msmdtool
-qq = quanta()
+import pickle
+import hashlib
+from collections import OrderedDict
 
-def parse_contdotdat(filepath):
+import numpy as np
+
+# the frequency units that appear in cont.dat files and selection strings
+frequency_units = {'Hz': 1.,
+                   'kHz': 1e3,
+                   'MHz': 1e6,
+                   'GHz': 1e9,
+                   'THz': 1e12,
+                  }
 
-    selections = []
+def frequency_to_hz(value, unit):
+    """
+    Convert a frequency in ``unit`` (one of ``frequency_units``) to Hz
+    """
+    try:
+        return float(value) * frequency_units[unit]
+    except KeyError:
+        raise ValueError("Unrecognized frequency unit '{0}'".format(unit))
 
+def parse_frequency_range(selstr):
+    """
+    Convert one frequency range of a selection string (e.g.,
+    '216.04~216.06GHz') to a (low, high) tuple in Hz
+    """
+    lo, hi = selstr.strip(string.ascii_letters).split("~")
+    unit = selstr.lstrip(string.punctuation + string.digits)
+    return tuple(sorted((frequency_to_hz(lo, unit), frequency_to_hz(hi, unit))))
+
+# increment this when the parsed structure changes, so that older cache files
+# are regenerated
+contdat_version = 1
+
+_contdat_cache = {}
+# the parsed intervals of frequency selection strings
+_interval_cache = {}
+
+def _file_key(filepath):
+    stat = os.stat(filepath)
+    return (stat.st_mtime, stat.st_size, contdat_version)
+
+def contdat_cache_filename(filepath):
+    """
+    The name of the on-disk cache of the parsed cont.dat file ``filepath``
+    """
+    cachedir = os.getenv('CONTDAT_CACHE_DIR') or 'contdat_cache'
+    key = hashlib.md5(os.path.abspath(filepath).encode()).hexdigest()
+    return os.path.join(cachedir, key + ".pkl")
+
+def _parse_contdotdat_file(filepath):
+    contdat = OrderedDict()
+    field, spw = None, None
     with open(filepath, 'r') as fh:
         for line in fh:
-            if "LSRK" in line:
-                selections.append(line.split()[0])
+            tokens = line.split()
+            if not tokens:
+                continue
+            if tokens[0] == 'Field:':
+                field = " ".join(tokens[1:])
+                spw = None
+            elif tokens[0] == 'SpectralWindow:':
+                spw = int(tokens[1])
+            elif '~' in tokens[0] and len(tokens) > 1:
+                # ranges without a frame are not used
+                section = contdat.setdefault(field, OrderedDict()).setdefault(
+                    spw, {'selections': [], 'frames': [], 'intervals': []})
+                section['selections'].append(tokens[0])
+                section['frames'].append(tokens[1])
+                section['intervals'].append(parse_frequency_range(tokens[0]))
+    for spws in contdat.values():
+        for section in spws.values():
+            section['intervals'] = np.array(section['intervals'],
+                                            dtype='float').reshape(-1, 2)
+    return contdat
+
+def read_contdotdat(filepath, use_cache=True):
+    """
+    Parse a cont.dat file
 
+    Parameters
+    ----------
+    filepath : str
+        The cont.dat file
+    use_cache : bool
+        Use (and update) the in-memory and on-disk caches of parsed files.
+        A cached result is used only if the file has not been modified since.
+
+    Returns
+    -------
+    contdat : OrderedDict
+        The file's sections in file order: field name -> spectral window
+        (int, or None for ranges before the first ``SpectralWindow:`` line)
+        -> dict with 'intervals' (an (n, 2) array of [low, high] frequencies
+        in Hz), 'frames' (the frame of each range, e.g. 'LSRK'), and
+        'selections' (the ranges as written in the file)
+    """
+    key = _file_key(filepath)
+    abspath = os.path.abspath(filepath)
+    if use_cache:
+        cached = _contdat_cache.get(abspath)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        cachefn = contdat_cache_filename(filepath)
+        if os.path.exists(cachefn):
+            try:
+                with open(cachefn, 'rb') as fh:
+                    cached = pickle.load(fh)
+            except Exception:
+                # a partially-written file is treated as missing
+                cached = None
+            if cached is not None and cached[0] == key:
+                _contdat_cache[abspath] = cached
+                return cached[1]
+
+    contdat = _parse_contdotdat_file(filepath)
+
+    if use_cache:
+        _contdat_cache[abspath] = (key, contdat)
+        try:
+            if not os.path.exists(os.path.dirname(cachefn)):
+                os.makedirs(os.path.dirname(cachefn))
+            # write to a temporary file first so a crash (or another process
+            # writing the same file) cannot leave a corrupt cache
+            tmpfile = cachefn + ".tmp{0}".format(os.getpid())
+            with open(tmpfile, 'wb') as fh:
+                pickle.dump((key, contdat), fh, protocol=2)
+            os.rename(tmpfile, cachefn)
+        except (IOError, OSError):
+            pass
+
+    return contdat
+
+def contdotdat_intervals(contdat, frame='LSRK', field=None, spw=None):
+    """
+    The [low, high] frequency intervals (Hz) of the ranges in ``frame`` of a
+    parsed cont.dat file (see ``read_contdotdat``), optionally only those of
+    one field and/or spectral window, sorted by the low frequency
+    """
+    intervals = [section['intervals'][np.array(section['frames']) == frame]
+                 for fieldname, spws in contdat.items()
+                 if field is None or fieldname == field
+                 for spwnum, section in spws.items()
+                 if spw is None or spwnum == spw]
+    intervals = np.concatenate(intervals + [np.zeros([0, 2])])
+    return intervals[np.argsort(intervals[:,0], kind='mergesort')]
 
-    return ";".join(selections)
+def parse_contdotdat(filepath):
+    """
+    Return the LSRK ranges of a cont.dat file as a single ';'-separated
+    frequency selection string (of all fields and spectral windows, in file
+    order)
+    """
+    contdat = read_contdotdat(filepath)
+    selections = [sel
+                  for spws in contdat.values()
+                  for section in spws.values()
+                  for sel, frame in zip(section['selections'], section['frames'])
+                  if frame == 'LSRK']
+    selection = ";".join(selections)
+    # the intervals of this selection are already known
+    if selection and selection not in _interval_cache:
+        _interval_cache[selection] = contdotdat_intervals(contdat)
+
+    return selection
 
 def contchannels_to_linechannels(contsel, freqslist):
     """
@@ -41,22 +203,11 @@ def contchannels_to_linechannels(contsel, freqslist):
 
     new_sel = []
 
-    for spw,freq in freqslist.items():
-        fmin, fmax = np.min(freq), np.max(freq)
-        if fmin > fmax:
-            raise ValueError("this is literally impossible")
-        selected = np.zeros_like(freq, dtype='bool')
-        for selstr in contsel.split(";"):
-            lo, hi = selstr.strip(string.ascii_letters).split("~")
-            unit = selstr.lstrip(string.punctuation + string.digits)
-            flo = qq.convert({'value':float(lo), 'unit':unit}, 'Hz')['value']
-            fhi = qq.convert({'value':float(hi), 'unit':unit}, 'Hz')['value']
-            if flo > fhi:
-                flo,fhi = fhi,flo
-
-            if fhi < fmax and flo > fmin:
-                selected |= (freq > flo) & (freq < fhi)
+    # parse the selection once for all spectral windows
+    intervals = frequency_intervals(contsel)
 
+    for spw,freq in freqslist.items():
+        selected = interval_mask(intervals, freq)
 
         # invert from continuum to line
         invselected = ~selected
@@ -74,6 +225,88 @@ def contchannels_to_linechannels(contsel, freqslist):
 
     return ",".join(new_sel)
 
+
+def frequency_intervals(contsel):
+    """
+    Parse a frequency selection string (e.g., '215~216GHz;217.5~218GHz') into
+    an (n, 2) array of [low, high] frequencies in Hz, sorted by the low
+    frequency.  The results are cached, so repeated calls with the same string
+    (e.g., once per MS) are free.
+    """
+    if contsel in _interval_cache:
+        return _interval_cache[contsel]
+
+    intervals = [parse_frequency_range(selstr) for selstr in contsel.split(";")]
+    intervals = np.array(intervals, dtype='float').reshape(-1, 2)
+    intervals = intervals[np.argsort(intervals[:,0], kind='mergesort')]
+    _interval_cache[contsel] = intervals
+    return intervals
+
+def interval_mask(intervals, freq):
+    """
+    Return a boolean array that is True for the channels with frequencies
+    ``freq`` that are strictly inside any of the ``intervals`` (see
+    ``frequency_intervals``).  As in the original per-range implementation,
+    only the intervals that lie entirely within the range of ``freq`` are
+    used.
+
+    The number of intervals containing each channel is the number of
+    intervals starting below it minus the number ending at or below it, which
+    two sorted searches give for all channels at once.
+    """
+    freq = np.asarray(freq)
+    fmin, fmax = np.min(freq), np.max(freq)
+    if fmin > fmax:
+        raise ValueError("this is literally impossible")
+    inside = ((intervals[:,1] < fmax) & (intervals[:,0] > fmin) &
+              # an empty interval contains no channels
+              (intervals[:,0] < intervals[:,1]))
+    los = intervals[inside, 0]
+    his = np.sort(intervals[inside, 1])
+    ncontaining = (np.searchsorted(los, freq, side='left') -
+                   np.searchsorted(his, freq, side='right'))
+    return ncontaining > 0
+
+def contchannel_mask(contsel, freq):
+    """
+    Return a boolean array that is True for the channels with frequencies
+    ``freq`` that are selected as continuum in the frequency selection string
+    ``contsel``
+    """
+    return interval_mask(frequency_intervals(contsel), freq)
+
+def channel_ranges(mask):
+    """
+    Return the inclusive (first, last) channel ranges of the contiguous True
+    sections of a boolean channel mask
+    """
+    padded = np.concatenate([[False], mask, [False]]).astype('int8')
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return [(int(lo), int(hi)-1) for lo, hi in zip(edges[::2], edges[1::2])]
+
+def contchannels_to_contchannel_ranges(contsel, freqslist):
+    """
+    Parameters
+    ----------
+    contsel : str
+        A CASA selection string with assumed units of frequency and no assumed
+        spectral windows.
+    freqslist : dict
+        A dictionary of frequency arrays, where the key is the spectral window
+        number and the value is a numpy array of frequencies
+
+    Returns
+    -------
+    channel_ranges : dict
+        A dictionary keyed by spectral window listing the inclusive (first,
+        last) ranges of the *continuum* channels, e.g.  {0: [(16, 29), (41,
+        100)]}.  Spectral windows with no continuum channels have an empty
+        list.
+    """
+    intervals = frequency_intervals(contsel)
+    return {spw: channel_ranges(interval_mask(intervals, freq))
+            for spw, freq in freqslist.items()}
+
 def freq_selection_overlap(ms, freqsel, spw=0):
     """
     For a given frequency selection string (e.g., '215~216GHz;900~950GHz'),
@@ -89,6 +322,10 @@ def freq_selection_overlap(ms, freqsel, spw=0):
     spw : int
         The spectral window number, default to 0
     """
+    try:
+        from taskinit import msmdtool
+    except ImportError:
+        from casatools import msmetadata as msmdtool
 
     msmd = msmdtool()
     msmd.open(ms)
@@ -105,8 +342,8 @@ def freq_selection_overlap(ms, freqsel, spw=0):
         if lo > hi:
             lo, hi = hi, lo
 
-        flo = qq.convert({'value':float(lo), 'unit':unit}, 'Hz')['value']
-        fhi = qq.convert({'value':float(hi), 'unit':unit}, 'Hz')['value']
+        flo = frequency_to_hz(lo, unit)
+        fhi = frequency_to_hz(hi, unit)
 
         if ((fhi < fmax) and (fhi > fmin)) and ((flo > fmin) and (flo < fmax)):
             new_sel.append(selstr)
@@ -128,7 +365,12 @@ def cont_channel_selection_to_contdotdat(cont_channel_selection, msname,
     Convert the result to a selection string:
         fselstr = ",".join(str(x)+":"+ ";".join(freqsel[x]) for x in freqsel)
     """
+    try:
+        from taskinit import mstool
+    except ImportError:
+        from casatools import ms as mstool
 
+    ms = mstool()
     ms.open(msname)
 
     freqsels = {}
@@ -0,0 +1,154 @@
+"""
+Run ``continuum_imaging_selfcal.py`` for several fields, bands, and array
+configurations concurrently on one machine.
+
+The slurm scripts submit one job per field and array; this driver instead
+reads ``continuum_mses.txt``, makes one work unit per (field, band, array,
+bsens) combination, and runs each unit in its own CASA process, several at a
+time.  A unit is only started if its estimated memory fits in what the
+running units leave free, so many small 7m fields can run side by side while
+a large 12m mosaic runs alone.  Each unit writes its own CASA log,
+``casa_log_selfcalcont_<field>_<band>_<array>[_bsens]_<date>.log``, and its
+standard output to ``<field>_<band>_<array>[_bsens]_selfcal.log``.
+
+Run it from the directory containing ``continuum_mses.txt`` (the one you
+would run ``continuum_imaging_selfcal.py`` from):
+
+    >>> %run -i ./path/to/reduction/selfcal_driver.py
+
+You can set the following environmental variables for this script:
+    FIELD_ID=<names>
+        A comma-separated list of the fields to self-calibrate.  Default all.
+    BAND_TO_IMAGE=<bands>
+        A comma-separated list of the bands to self-calibrate (e.g. B3,B6).
+        Default all.
+    SELFCAL_ARRAYS=<arrays>
+        A comma-separated list of the array configurations to self-calibrate
+        (12M, 7M12M, 7M).  Default 12M,7M12M,7M.
+    SELFCAL_BSENS_ARRAYS=<arrays>
+        The array configurations for which the bsens data are also
+        self-calibrated.  Default 12M.
+    SELFCAL_NPROC=<number>
+        The number of units run at once.  Default 1.
+    SELFCAL_MEMORY_GB=<number>
+        The total memory (GB) available to the running units.  Defaults to
+        the physical memory of the machine.
+    SELFCAL_BASE_MEMORY_GB=<number>, SELFCAL_BYTES_PER_PIXEL=<number>
+        The memory of a unit is estimated as SELFCAL_BASE_MEMORY_GB (default
+        2) plus SELFCAL_BYTES_PER_PIXEL (default 100) times the number of
+        pixels in its image.
+    CASA=<path>
+        The CASA executable.  Default ``casa``.
+    SELFCAL_XVFB=<boolean>
+        Run CASA with ``xvfb-run -a`` (plotms needs a display).  Defaults to
+        True if DISPLAY is not set.
+
+The other variables read by ``continuum_imaging_selfcal.py`` (e.g.,
+SELFCAL_MODEL_STORAGE) are passed through to every unit.
+"""
+import os
+import sys
+import time
+
+if os.getenv('ALMAIMF_ROOTDIR') is None:
+    try:
+        import metadata_tools
+        os.environ['ALMAIMF_ROOTDIR'] = os.path.split(metadata_tools.__file__)[0]
+    except ImportError:
+        raise ValueError("metadata_tools not found on path; make sure to "
+                         "specify ALMAIMF_ROOTDIR environment variable "
+                         "or your PYTHONPATH variable to include the directory"
+                         " containing the ALMAIMF code.")
+else:
+    sys.path.append(os.getenv('ALMAIMF_ROOTDIR'))
+almaimf_rootdir = os.getenv('ALMAIMF_ROOTDIR')
+
+from metadata_tools import logprint, determine_phasecenter, determine_imsize
+from selfcal_tools import (selfcal_units, unit_environment,
+                           estimate_selfcal_memory, run_selfcal_unit)
+from task_graph import make_task, run_tasks, total_memory_gb
+
+
+def env_list(name, default=None):
+    value = os.getenv(name)
+    if not value:
+        return default
+    return [x.strip() for x in value.split(",")]
+
+
+with open('continuum_mses.txt', 'r') as fh:
+    continuum_mses = [x.strip() for x in fh.readlines() if x.strip()]
+
+if len(continuum_mses) == 0:
+    raise IOError("Your continuum_mses.txt file is empty.  There is nothing "
+                  "to image or self-calibrate.")
+
+bands = env_list('BAND_TO_IMAGE')
+if bands is not None:
+    bands = [band if 'B' in band else 'B'+band for band in bands]
+units = selfcal_units(continuum_mses,
+                      arrays=env_list('SELFCAL_ARRAYS', ['12M', '7M12M', '7M']),
+                      bsens_arrays=env_list('SELFCAL_BSENS_ARRAYS', ['12M']),
+                      fields=env_list('FIELD_ID'),
+                      bands=bands)
+
+nproc = int(os.getenv('SELFCAL_NPROC') or 1)
+memory_budget = float(os.getenv('SELFCAL_MEMORY_GB') or total_memory_gb())
+base_memory = float(os.getenv('SELFCAL_BASE_MEMORY_GB') or 2)
+bytes_per_pixel = float(os.getenv('SELFCAL_BYTES_PER_PIXEL') or 100)
+
+casa_command = [os.getenv('CASA') or 'casa']
+if os.getenv('SELFCAL_XVFB') is not None:
+    use_xvfb = os.getenv('SELFCAL_XVFB').lower() == 'true'
+else:
+    use_xvfb = os.getenv('DISPLAY') is None
+if use_xvfb:
+    # -a picks a free display number, so concurrent units do not collide
+    casa_command = ['xvfb-run', '-a'] + casa_command
+
+script = os.path.join(almaimf_rootdir, 'continuum_imaging_selfcal.py')
+
+# continuum_imaging_selfcal creates this if it does not exist; make it here so
+# the concurrent units do not race to do so
+if not os.path.exists('imaging_results'):
+    os.mkdir('imaging_results')
+
+# estimate the memory of each unit from its image size, determined the same
+# way as in continuum_imaging_selfcal (both use the continuum MS and the
+# results are cached in geometry_cache.json, so the units reuse them)
+for unit in units:
+    coosys, racen, deccen = determine_phasecenter(ms=unit['continuum_ms'],
+                                                  field=unit['field'],
+                                                  exclude_7m=unit['array'] == '12M',
+                                                  only_7m=unit['array'] == '7M')
+    dra, ddec, pixscale = determine_imsize(ms=unit['continuum_ms'],
+                                           field=unit['field'],
+                                           phasecenter=(racen, deccen),
+                                           exclude_7m=unit['array'] == '12M',
+                                           only_7m=unit['array'] == '7M',
+                                           spw='all',
+                                           pixfraction_of_fwhm=1/8. if unit['array'] == '7M' else 1/4.)
+    unit['memory'] = estimate_selfcal_memory([dra, ddec], base_gb=base_memory,
+                                             bytes_per_pixel=bytes_per_pixel)
+    logprint("Unit {0}: image size {1}x{2}, estimated memory {3:0.1f} GB"
+             .format(unit['name'], dra, ddec, unit['memory']),
+             origin='selfcal_driver')
+
+# start the largest units first so that they are not starved by the small ones
+units = sorted(units, key=lambda unit: unit['memory'], reverse=True)
+
+datestr = time.strftime('%Y-%m-%d_%H_%M_%S')
+tasks = []
+for unit in units:
+    logfile = os.path.abspath("casa_log_selfcalcont_{0}_{1}.log"
+                              .format(unit['name'], datestr))
+    outputfile = os.path.abspath("{0}_selfcal.log".format(unit['name']))
+    tasks.append(make_task(unit['name'], run_selfcal_unit,
+                           args=(unit['name'], unit_environment(unit),
+                                 casa_command, script, logfile, outputfile),
+                           memory=unit['memory']))
+
+logprint("Running {0} self-calibration units with {1} processes and {2:0.1f} GB"
+         .format(len(tasks), nproc, memory_budget),
+         origin='selfcal_driver')
+run_tasks(tasks, nproc=nproc, memory_budget=memory_budget)
@@ -0,0 +1,156 @@
+"""
+Checkpoint manifest for ``continuum_imaging_selfcal.py``.
+
+The manifest is a JSON file (one per field, band, and array) that records,
+for each completed stage of the self-calibration (split, dirty imaging,
+pre-selfcal clean, gaincal and clean of each iteration, final imaging for each
+robust value, post-selfcal dirty imaging), a hash of the stage's inputs and the
+products it made.
+
+Each stage's hash includes a token identifying the last run of the stage it
+follows, so changing the parameters of one stage (or deleting its products)
+makes that stage and every later stage stale, while the earlier stages are
+left alone.  A stage is re-run if its products are missing or its recorded
+hash differs from the current one.  Products made before the manifest existed
+(i.e., by an older version of the script) are adopted: they are recorded with
+the current hash instead of being remade.
+"""
+import os
+import glob
+import json
+import shutil
+import hashlib
+import time
+
+from metadata_tools import logprint
+
+
+def path_signature(path):
+    """
+    A hash of the contents of a file, or of the top-level files of a CASA
+    table/image directory (the logtable and other subdirectories are
+    skipped because they record when, not what, was written).  Returns None
+    if the path does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    md5 = hashlib.md5()
+    if os.path.isdir(path):
+        filenames = sorted(fn for fn in os.listdir(path)
+                           if os.path.isfile(os.path.join(path, fn)))
+        paths = [os.path.join(path, fn) for fn in filenames]
+    else:
+        paths = [path]
+    for fn in paths:
+        md5.update(os.path.basename(fn).encode())
+        with open(fn, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(2**20), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def stage_hash(upstream, *inputs):
+    """
+    Hash the inputs of a stage (parameter dictionaries, file signatures,
+    etc.) together with the token of the stage it depends on
+    """
+    md5 = hashlib.md5()
+    md5.update(json.dumps([upstream, inputs], sort_keys=True,
+                          default=str).encode())
+    return md5.hexdigest()
+
+
+def load_manifest(filename):
+    if os.path.exists(filename):
+        with open(filename, 'r') as fh:
+            try:
+                return json.load(fh)
+            except ValueError:
+                logprint("Could not read manifest {0}; starting a new one"
+                         .format(filename), origin='contim_selfcal')
+    return {'stages': {}}
+
+
+def write_manifest(manifest, filename):
+    # write to a temporary file first so a crash cannot corrupt the manifest
+    with open(filename+".tmp", 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.rename(filename+".tmp", filename)
+
+
+def stage_is_current(manifest, filename, stage, inputs_hash, outputs):
+    """
+    Determine whether a stage can be skipped: all of its outputs exist and it
+    was last run with the same inputs.  Outputs that exist but were never
+    recorded in the manifest are adopted, i.e., recorded as current.
+    """
+    missing = [fn for fn in outputs if not os.path.exists(fn)]
+    if missing:
+        logprint("Stage {0} must be run: {1} not found".format(stage, missing),
+                 origin='contim_selfcal')
+        return False
+    record = manifest['stages'].get(stage)
+    if record is None:
+        if not outputs:
+            return False
+        logprint("Adopting the existing products {1} of stage {0}"
+                 .format(stage, outputs), origin='contim_selfcal')
+        record_stage(manifest, filename, stage, inputs_hash, outputs,
+                     adopted=True)
+        return True
+    if record['inputs'] != inputs_hash:
+        logprint("Stage {0} is stale: its inputs have changed".format(stage),
+                 origin='contim_selfcal')
+        return False
+    logprint("Stage {0} is up to date".format(stage), origin='contim_selfcal')
+    return True
+
+
+def record_stage(manifest, filename, stage, inputs_hash, outputs, **info):
+    """
+    Record a completed stage and write the manifest.  Any extra keyword
+    arguments (e.g., timing) are stored with the stage.
+    """
+    completed = time.strftime('%Y-%m-%d %H:%M:%S')
+    record = {'inputs': inputs_hash,
+              'outputs': list(outputs),
+              'completed': completed,
+              # identifies this particular run of the stage, so that the
+              # stages that depend on it are remade when it is remade
+              'token': stage_hash(inputs_hash, completed, time.time()),
+             }
+    record.update(info)
+    manifest['stages'][stage] = record
+    write_manifest(manifest, filename)
+
+
+def invalidate_stage(manifest, filename, stage):
+    """
+    Forget a stage, e.g. before re-running it or when something else has
+    undone its effect
+    """
+    if stage in manifest['stages']:
+        del manifest['stages'][stage]
+        write_manifest(manifest, filename)
+
+
+def stage_token(manifest, stage):
+    """
+    The value identifying the last run of a stage, to be included in the
+    hashes of the stages that depend on it (None if the stage has not run)
+    """
+    return manifest['stages'].get(stage, {}).get('token')
+
+
+def remove_image_products(imname):
+    """
+    Remove the products of a previous tclean run with image name ``imname``
+    so that a stale stage is remade from scratch
+    """
+    for fn in glob.glob(imname+".*"):
+        logprint("Removing stale product {0}".format(fn),
+                 origin='contim_selfcal')
+        if os.path.isdir(fn):
+            shutil.rmtree(fn)
+        else:
+            os.remove(fn)
@@ -0,0 +1,145 @@
+"""
+Helpers for running ``continuum_imaging_selfcal.py`` on many fields, bands,
+and array configurations at once (see ``selfcal_driver.py``).
+
+Each work unit is one run of the self-calibration script in its own CASA
+process, configured through the same environmental variables the slurm
+scripts set (FIELD_ID, BAND_TO_IMAGE, EXCLUDE_7M, ONLY_7M, DO_BSENS).
+"""
+import os
+import subprocess
+
+import numpy as np
+
+from metadata_tools import logprint
+
+# the EXCLUDE_7M and ONLY_7M settings that select each array configuration
+array_environment = {'12M': {'EXCLUDE_7M': 'True', 'ONLY_7M': 'False'},
+                     '7M12M': {'EXCLUDE_7M': 'False', 'ONLY_7M': 'False'},
+                     '7M': {'EXCLUDE_7M': 'False', 'ONLY_7M': 'True'},
+                    }
+
+
+def bsens_ms_name(continuum_ms):
+    """
+    The bsens continuum MS corresponding to a cleanest continuum MS (the same
+    substitution ``continuum_imaging_selfcal.py`` makes for DO_BSENS)
+    """
+    return continuum_ms.replace('_continuum_merged.cal.ms',
+                                '_continuum_merged_bsens.cal.ms')
+
+
+def selfcal_units(continuum_mses, arrays=('12M', '7M12M', '7M'),
+                  bsens_arrays=('12M',), fields=None, bands=None):
+    """
+    Make the list of self-calibration work units
+
+    Parameters
+    ----------
+    continuum_mses : list
+        The cleanest continuum MSes, as listed in ``continuum_mses.txt``
+    arrays : list
+        The array configurations to self-calibrate ('12M', '7M12M', '7M')
+    bsens_arrays : list
+        The array configurations for which the bsens data are also
+        self-calibrated
+    fields, bands : list or None
+        If given, only these fields and bands are included
+
+    Returns
+    -------
+    units : list
+        Dictionaries with 'name', 'field', 'band', 'array', 'bsens', and
+        'continuum_ms' keys
+    """
+    units = []
+    for continuum_ms in continuum_mses:
+        # strip off .cal.ms, as continuum_imaging_selfcal does
+        basename = os.path.split(continuum_ms[:-7])[1]
+        band = 'B3' if 'B3' in basename else 'B6' if 'B6' in basename else 'ERROR'
+        field = basename.split("_")[0]
+        if fields is not None and field not in fields:
+            continue
+        if bands is not None and band not in bands:
+            continue
+
+        for array in arrays:
+            if array not in array_environment:
+                raise ValueError("Unknown array configuration {0}".format(array))
+            for bsens in (False, True):
+                if bsens and array not in bsens_arrays:
+                    continue
+                vis = bsens_ms_name(continuum_ms) if bsens else continuum_ms
+                if not os.path.exists(vis):
+                    logprint("Skipping {0} {1} {2}{3}: {4} does not exist"
+                             .format(field, band, array,
+                                     " bsens" if bsens else "", vis))
+                    continue
+                units.append({'name': "{0}_{1}_{2}{3}".format(field, band, array,
+                                                              "_bsens" if bsens else ""),
+                              'field': field,
+                              'band': band,
+                              'array': array,
+                              'bsens': bsens,
+                              'continuum_ms': vis,
+                             })
+    return units
+
+
+def unit_environment(unit):
+    """
+    The environmental variables that make ``continuum_imaging_selfcal.py``
+    process only the given work unit
+    """
+    environment = {'FIELD_ID': unit['field'],
+                   'BAND_TO_IMAGE': unit['band'],
+                   'DO_BSENS': str(unit['bsens']),
+                  }
+    environment.update(array_environment[unit['array']])
+    return environment
+
+
+def estimate_selfcal_memory(imsize, base_gb=2., bytes_per_pixel=100.):
+    """
+    A rough estimate of the memory (GB) a self-calibration run (or a tclean
+    run) needs: a fixed amount for CASA itself plus an amount proportional to
+    the number of image pixels (the image products of all Taylor terms and the
+    gridding buffers).  ``imsize`` is the tclean imsize, [nx, ny] or n.
+    """
+    imsize = np.atleast_1d(imsize)
+    npix = imsize.prod() if imsize.size > 1 else imsize[0]**2
+    return base_gb + npix * bytes_per_pixel / 1024.**3
+
+
+def run_selfcal_unit(name, environment, casa_command, script, logfile,
+                     outputfile):
+    """
+    Run ``script`` for one work unit in a new CASA process
+
+    Parameters
+    ----------
+    name : str
+        The name of the work unit (used in messages)
+    environment : dict
+        Environmental variables to set in addition to the current ones
+    casa_command : list
+        The command starting CASA, e.g. ``['xvfb-run', '-a', 'casa']``
+    script : str
+        The script to execute
+    logfile : str
+        The CASA log file of this unit
+    outputfile : str
+        The file to which the standard output and error are written
+    """
+    env = dict(os.environ)
+    env.update(environment)
+    command = list(casa_command) + ['--logfile', logfile, '--nogui',
+                                    '--nologger', '-c',
+                                    "execfile('{0}')".format(script)]
+    with open(outputfile, 'w') as fh:
+        returncode = subprocess.call(command, env=env, stdout=fh,
+                                     stderr=subprocess.STDOUT)
+    if returncode != 0:
+        raise ValueError("Self-calibration of {0} failed with return code {1}; "
+                         "see {2} and {3}".format(name, returncode, logfile,
+                                                  outputfile))
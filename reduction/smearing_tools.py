@@ -0,0 +1,178 @@
+"""
+Channel and time averaging limits set by bandwidth and time-average smearing.
+
+Averaging the visibilities over a bandwidth smears a source radially, and
+averaging over time smears it azimuthally.  Both reduce the peak brightness
+of a source in proportion to its distance from the phase center in units of
+the synthesized beam.  The averaging is chosen so that the peak response at
+the half-power radius of the primary beam is reduced by no more than 2%:
+
+    bandwidth: dnu / nu <= 0.25 * Synth_HPBW / PB_HPBW
+        (Roberto's interpolation of
+        https://science.nrao.edu/facilities/vla/docs/manuals/oss2016A/performance/fov/bw-smearing)
+    time: 1 - R = 1.22e-9 * (theta / Synth_HPBW)**2 * tau**2, with tau in s
+        (Bridle & Schwab 1999); at theta = PB_HPBW / 2,
+        tau <= 8098 s * Synth_HPBW / PB_HPBW
+
+The synthesized beam is taken to be lambda / B_max, B_max being the longest
+baseline present in the data, and the primary beam HPBW to be
+1.22 lambda / D for the smallest dish.  Their ratio, D / (1.22 B_max), does
+not depend on frequency.
+"""
+import numpy as np
+
+from metadata_tools import get_ms_geometry, logprint
+
+# dnu / nu = bandwidth_smearing_factor * Synth_HPBW / PB_HPBW
+bandwidth_smearing_factor = 0.25
+# the largest tolerated fractional loss of peak response from time averaging
+time_smearing_loss = 0.02
+
+
+def beam_ratio(max_baseline, dish_diameter):
+    """
+    The ratio of the synthesized beam to the primary beam HPBW for a maximum
+    baseline and dish diameter in the same units
+    """
+    if max_baseline <= 0:
+        raise ValueError("The maximum baseline must be positive to determine "
+                         "the smearing limits")
+    return dish_diameter / (1.22 * max_baseline)
+
+
+def max_channel_width(freq, ratio):
+    """
+    The largest averaged channel width (in the units of ``freq``) at
+    frequency ``freq`` given the synthesized to primary beam ratio
+    """
+    return bandwidth_smearing_factor * ratio * freq
+
+
+def max_time_bin(ratio):
+    """
+    The largest averaging time (s) given the synthesized to primary beam ratio
+    """
+    # theta = PB_HPBW / 2, so theta / Synth_HPBW = 1 / (2 * ratio)
+    return 2 * (time_smearing_loss / 1.22e-9)**0.5 * ratio
+
+
+def channel_averaging_width(chanwidth, nchan, targetwidth):
+    """
+    The number of channels of width ``chanwidth`` to average to reach (at
+    most) ``targetwidth`` in a window of ``nchan`` channels.  At least two
+    output channels are kept: CASA cannot average more channels than there
+    are, and averaging by more than half the window drops edge channels.
+    """
+    width = int(targetwidth / np.abs(chanwidth))
+    if width <= 0:
+        raise ValueError("The channel width {0} is greater than the target "
+                         "width {1}".format(chanwidth, targetwidth))
+    return max(min(width, nchan // 2), 1)
+
+
+def time_averaging_bin(maxbin, integration):
+    """
+    The largest whole number of integrations no longer than ``maxbin`` (s), or
+    0 if that is fewer than two (no averaging)
+    """
+    nint = int(maxbin // integration)
+    if nint < 2:
+        return 0.
+    return nint * integration
+
+
+def averaging_limits(vis, spws, msmd, antennae='all'):
+    """
+    Determine the channel averaging widths and time bin that keep the
+    smearing of ``vis`` within the limits
+
+    Parameters
+    ----------
+    vis : str
+        The measurement set
+    spws : list
+        The spectral windows to be averaged
+    msmd : msmetadata tool
+        A closed msmetadata tool
+    antennae : 'all', '12m', or '7m'
+        The antennae that will be kept (see
+        ``metadata_tools.extract_ms_geometry``)
+
+    Returns
+    -------
+    limits : dict
+        'widths' (the number of channels to average in each spw),
+        'timebin' (s, a whole number of integrations; 0 means no averaging),
+        'max_timebin' (s), 'integration' (s), 'max_baseline' (m),
+        'dish_diameter' (m), and 'beam_ratio'
+    """
+    geometry = get_ms_geometry(vis)
+    diameters = np.array(geometry['antenna_diameters'])
+    selected = {'all': np.ones(diameters.size, dtype='bool'),
+                '12m': diameters != 7,
+                '7m': diameters == 7,
+               }[antennae]
+    max_baseline = geometry['max_baseline'][antennae]
+    dish_diameter = diameters[selected].min()
+    ratio = beam_ratio(max_baseline, dish_diameter)
+
+    widths = []
+    msmd.open(vis)
+    try:
+        for spw in spws:
+            chanfreqs = msmd.chanfreqs(spw)
+            # the primary beam is largest at the lowest frequency
+            targetwidth = max_channel_width(np.min(chanfreqs), ratio)
+            widths.append(channel_averaging_width(np.mean(msmd.chanwidths(spw)),
+                                                  len(chanfreqs), targetwidth))
+        scan = msmd.scansforspw(spws[0])[0]
+        integration = msmd.exposuretime(scan=scan, spwid=spws[0])['value']
+    finally:
+        msmd.close()
+
+    maxbin = max_time_bin(ratio)
+    limits = {'widths': widths,
+              'timebin': time_averaging_bin(maxbin, integration),
+              'max_timebin': maxbin,
+              'integration': integration,
+              'max_baseline': max_baseline,
+              'dish_diameter': float(dish_diameter),
+              'beam_ratio': ratio,
+             }
+    logprint("Smearing limits for {0} ({1} antennae): max baseline {2:0.1f} m, "
+             "dish {3:0.1f} m, channel widths {4}, time bin {5:0.1f} s "
+             "(integration {6:0.2f} s, limit {7:0.1f} s)"
+             .format(vis, antennae, max_baseline, dish_diameter, widths,
+                     limits['timebin'], integration, maxbin))
+    return limits
+
+
+_solint_units = {'s': 1., 'min': 60., 'h': 3600.}
+
+def solint_seconds(solint):
+    """
+    The length (s) of a gaincal solint: None for 'inf', 0 for 'int', or the
+    time of e.g. '30s', '2min', or '0.5h'
+    """
+    if solint == 'inf':
+        return None
+    if solint == 'int':
+        return 0.
+    for unit in ('min', 'h', 's'):
+        if solint.endswith(unit):
+            return float(solint[:-len(unit)]) * _solint_units[unit]
+    # a bare number is in seconds
+    return float(solint)
+
+
+def solint_averaging_limit(solints):
+    """
+    The longest time bin (s) that leaves at least two averaged integrations
+    in each of the solution intervals ``solints``: None if they are all
+    'inf', 0 (no averaging) if any is 'int'
+    """
+    lengths = [solint_seconds(solint) for solint in solints]
+    lengths = [length for length in lengths if length is not None]
+    if not lengths:
+        return None
+    return min(lengths) / 2.
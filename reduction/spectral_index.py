@@ -0,0 +1,174 @@
+"""
+An index of the spectral setup of the single-window MSes listed in
+``to_image.json``, so that ``line_imaging.py`` can match lines to spectral
+windows and determine channel widths without opening every MS.
+
+For each MS, the index records the LSRK frequency range of spw 0 (the split
+MSes have one window per field) and, for each spw of the field, what the
+channel width determination needs: the effective resolution (RESOLUTION
+column) and the largest ratio of channel width to frequency.  The index is
+written to ``spectral_index.json`` by ``split_windows.py`` once the splits are
+done; entries for MSes that are missing or have been modified since (see
+``utils.ms_geometry_mtime``) are recomputed when they are looked up.
+"""
+import os
+import json
+
+import numpy as np
+from astropy import constants
+import astropy.units as u
+
+try:
+    from taskinit import msmdtool, mstool
+except ImportError:
+    from casatools import msmetadata as msmdtool, ms as mstool
+
+from metadata_tools import logprint, read_spectral_windows
+from utils import ms_geometry_mtime
+
+spectral_index_filename = 'spectral_index.json'
+
+# increment this when the contents of the records change, so that older
+# records are regenerated
+spectral_index_version = 1
+
+msmd = msmdtool()
+ms = mstool()
+
+
+def extract_spectral_info(vis, field):
+    """
+    Read the spectral setup of the MS ``vis`` for field ``field``
+
+    Returns
+    -------
+    record : dict
+        'lsrk_min' and 'lsrk_max' (Hz; spw 0), and 'spws', a list with one
+        entry per spw of the field with 'resolution' (Hz; one value if it is
+        the same for all channels, otherwise one per channel, with the
+        channel frequencies in 'chanfreqs') and 'max_fractional_width' (the
+        largest channel width / channel frequency)
+    """
+    logprint("Extracting the spectral setup of {0}".format(vis),
+             origin='almaimf_spectral_index')
+    record = {'version': spectral_index_version,
+              'mtime': ms_geometry_mtime(vis),
+              'spws': [],
+             }
+
+    msmd.open(vis)
+    nspws = len(msmd.spwsforfield(field))
+    msmd.close()
+
+    spectral_windows = read_spectral_windows(vis)
+    for spw in range(nspws):
+        chanfreqs = spectral_windows['chan_freq'][spw]
+        resolution = spectral_windows['resolution'][spw]
+        spwrecord = {'max_fractional_width':
+                     float(np.max(spectral_windows['chan_width'][spw] / chanfreqs))}
+        if np.all(resolution == resolution[0]):
+            spwrecord['resolution'] = float(resolution[0])
+        else:
+            spwrecord['resolution'] = resolution.tolist()
+            spwrecord['chanfreqs'] = chanfreqs.tolist()
+        record['spws'].append(spwrecord)
+
+    ms.open(vis)
+    # assume spw is 0 because we're working on split data
+    freqs = ms.cvelfreqs(spwids=0, outframe='LSRK')
+    ms.close()
+    record['lsrk_min'] = float(np.min(freqs))
+    record['lsrk_max'] = float(np.max(freqs))
+
+    return record
+
+
+def load_spectral_index(filename=spectral_index_filename):
+    if os.path.exists(filename):
+        with open(filename, 'r') as fh:
+            try:
+                return json.load(fh)
+            except ValueError:
+                logprint("Could not read {0}; it will be regenerated"
+                         .format(filename), origin='almaimf_spectral_index')
+    return {}
+
+
+def write_spectral_index(index, filename=spectral_index_filename):
+    # write to a temporary file first so a crash cannot corrupt the index
+    tmpfile = filename + ".tmp{0}".format(os.getpid())
+    with open(tmpfile, 'w') as fh:
+        json.dump(index, fh)
+    os.rename(tmpfile, filename)
+
+
+def get_spectral_info(index, vis, field):
+    """
+    Return the spectral setup of ``vis`` from the index, extracting it (and
+    adding it to ``index``) if it is missing or out of date.  The second
+    return value is True if the index was modified.
+    """
+    key = os.path.abspath(vis).rstrip('/')
+    record = index.get(key)
+    if (record is not None and record.get('version') == spectral_index_version
+            and record['mtime'] == ms_geometry_mtime(vis)):
+        return record, False
+    record = extract_spectral_info(vis, field)
+    index[key] = record
+    return record, True
+
+
+def build_spectral_index(to_image, filename=spectral_index_filename):
+    """
+    Add the MSes of a ``to_image`` dictionary (band -> field -> spw -> list
+    of MSes) that exist to the index in ``filename``, and return the index
+    """
+    index = load_spectral_index(filename)
+    modified = False
+    for band in to_image:
+        for field in to_image[band]:
+            for spw in to_image[band][field]:
+                for vis in to_image[band][field][spw]:
+                    if os.path.exists(vis):
+                        modified |= get_spectral_info(index, vis, str(field))[1]
+    if modified:
+        write_spectral_index(index, filename)
+    return index
+
+
+def line_in_range(record, targetfreq):
+    """
+    Determine whether the (LSRK) frequency ``targetfreq`` is within the LSRK
+    frequency range of an MS's record
+    """
+    targetfreq = u.Quantity(targetfreq, u.Hz).value
+    return record['lsrk_min'] <= targetfreq <= record['lsrk_max']
+
+
+def spw_resolution(spwrecord, freq):
+    """
+    The effective resolution (Hz) of the channel nearest to ``freq`` (Hz);
+    see ``metadata_tools.effective_resolution``
+    """
+    resolution = spwrecord['resolution']
+    if np.isscalar(resolution):
+        return resolution
+    sepfreq = np.abs(np.array(spwrecord['chanfreqs']) - freq)
+    return np.max(np.abs(np.array(resolution)[sepfreq == sepfreq.min()]))
+
+
+def channel_width_kms(record, restfreq):
+    """
+    The velocity channel width (km/s) to image a line at ``restfreq`` with:
+    the largest effective resolution of the spws at the rest frequency,
+    increased to the largest channel width if that is wider
+    """
+    restfreq = u.Quantity(restfreq).to(u.Hz).value
+    ckms = constants.c.to(u.km/u.s).value
+    chanwidth = np.max([np.abs(spw_resolution(spwrecord, restfreq))
+                        for spwrecord in record['spws']]) * ckms / restfreq
+    # second awful check b/c Todd's script failed for some cases
+    widest = max(spwrecord['max_fractional_width'] for spwrecord in record['spws'])
+    if widest * ckms > chanwidth:
+        chanwidth = widest * ckms
+    return chanwidth
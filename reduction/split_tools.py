@@ -0,0 +1,374 @@
+"""
+The individual splitting steps of ``split_windows.py``.  Each function
+produces one output MS and is run as a task by ``task_graph.run_tasks``, so
+they may run in worker processes; ``init_worker`` gives each worker its own
+CASA tools.
+"""
+import os
+import numpy as np
+
+try:
+    from taskinit import msmdtool, mstool, tbtool
+    from tasks import split, flagmanager, flagdata, rmtables, concat
+except ImportError:
+    from casatools import (msmetadata as msmdtool, ms as mstool, table as
+                           tbtool)
+    from casatasks import split, flagmanager, flagdata, rmtables, concat
+
+from parse_contdotdat import (parse_contdotdat, contchannels_to_linechannels,
+                              contchannels_to_contchannel_ranges,
+                              contchannel_mask, channel_ranges)
+from metadata_tools import logprint
+from smearing_tools import averaging_limits
+
+msmd = msmdtool()
+ms = mstool()
+tb = tbtool()
+
+
+def init_worker():
+    global msmd, ms, tb
+    msmd = msmdtool()
+    ms = mstool()
+    tb = tbtool()
+
+
+def ms_is_complete(vis):
+    """
+    Check that an MS exists and that its main table can be opened and has
+    data in it.  An interrupted split leaves behind an MS that fails this
+    check.
+    """
+    if not os.path.exists(os.path.join(vis, 'table.dat')):
+        return False
+    try:
+        tb.open(vis)
+        nrows = tb.nrows()
+        tb.close()
+    except RuntimeError:
+        return False
+    return nrows > 0
+
+
+def get_datacolumn(vis):
+    tb.open(vis)
+    if 'CORRECTED_DATA' in tb.colnames():
+        datacolumn='corrected'
+    else:
+        datacolumn='data'
+    tb.close()
+    return datacolumn
+
+
+def split_line_window(invis, outvis, spw, field):
+    """
+    Split out a single spectral window
+    """
+    logprint("Splitting {0}'s spw {2} to {1}".format(invis, outvis, spw))
+
+    datacolumn = get_datacolumn(invis)
+    assert split(vis=invis,
+                 spw=spw,
+                 field=field,
+                 outputvis=outvis,
+                 # there is no corrected_data column because we're
+                 # splitting from split MSes
+                 datacolumn=datacolumn,
+                ), "Split failed 3"
+
+
+def determine_continuum_widths(visfile, spws):
+    """
+    Determine the channel averaging widths for the continuum data (the
+    widest that keep the bandwidth smearing within the limit for the longest
+    baseline and smallest dish of ``visfile``; see ``smearing_tools``) and
+    the LSRK frequencies of each spectral window
+    """
+    logprint("Determining smoothing widths for continuum data.")
+    widths = averaging_limits(visfile, spws, msmd)['widths']
+
+    ms.open(visfile)
+    freqs = {}
+    for spw in spws:
+        # these are TOPO freqs: freqs[spw] = msmd.chanfreqs(spw)
+        try:
+            freqs[spw] = ms.cvelfreqs(spwid=[spw], outframe='LSRK')
+        except TypeError:
+            freqs[spw] = ms.cvelfreqs(spwids=[spw], outframe='LSRK')
+    ms.close()
+
+    return widths, freqs
+
+
+def split_continuum(visfile, contvis, spws, field, band, contfile):
+    """
+    Flag the line channels identified from the cont.dat file, split out the
+    channel-averaged continuum, and restore the original flags
+    """
+    logprint("Flagging and splitting {0} to {1} for continuum"
+             .format(visfile, contvis),)
+
+    widths, freqs = determine_continuum_widths(visfile, spws)
+    datacolumn = get_datacolumn(visfile)
+
+    cont_channel_selection = parse_contdotdat(contfile)
+    linechannels = contchannels_to_linechannels(cont_channel_selection,
+                                                freqs)
+
+
+    flagmanager(vis=visfile, mode='save',
+                versionname='before_cont_flags')
+
+    # not clear why this is done in other imaging scripts, but it
+    # seems to achieve the wrong effect.
+    #initweights(vis=visfile, wtmode='weight', dowtsp=True)
+
+
+    flagdata(vis=visfile, mode='manual', spw=linechannels,
+             flagbackup=False)
+
+
+    flagmanager(vis=visfile, mode='save',
+                versionname='line_channel_flags')
+
+    rmtables(contvis)
+    os.system('rm -rf ' + contvis + '.flagversions')
+
+
+    # Average the channels within spws
+    # (assert here checks that this completes successfully)
+    assert split(vis=visfile,
+                 spw=",".join(map(str,spws)),
+                 field=field,
+                 outputvis=contvis,
+                 width=widths,
+                 datacolumn=datacolumn), "Split failed!"
+
+    if not os.path.exists(contvis):
+        raise IOError("Split failed for {0}".format(contvis))
+
+    # If you flagged any line channels, restore the previous flags
+    flagmanager(vis=visfile, mode='restore',
+                versionname='before_cont_flags')
+
+
+def trim_channel_ranges(ranges, width):
+    """
+    Trim a list of inclusive (first, last) continuum channel ranges so that
+    each one contains a whole number of ``width``-channel averaging bins.
+
+    split concatenates the selected channels of a spectral window before
+    averaging them, so a bin that spans the end of one range and the start of
+    the next would average across a line.  Trimming the end of each range to
+    a multiple of the width makes every output channel lie within a single
+    contiguous continuum range.  The width is reduced if needed to keep at
+    least 2 output channels (see ``determine_continuum_widths``).
+
+    Returns
+    -------
+    ranges : list
+        The trimmed ranges
+    width : int
+        The (possibly reduced) averaging width
+    """
+    total = sum(hi - lo + 1 for lo, hi in ranges)
+    width = max(min(width, total // 2), 1)
+    while True:
+        trimmed = [(lo, lo + ((hi - lo + 1) // width) * width - 1)
+                   for lo, hi in ranges if hi - lo + 1 >= width]
+        nkept = sum(hi - lo + 1 for lo, hi in trimmed)
+        if nkept >= 2 * width or width == 1:
+            return trimmed, width
+        width -= 1
+
+
+def split_continuum_selected(visfile, contvis, spws, field, band, contfile,
+                             max_loss=0.1, max_preaverage=8):
+    """
+    Split out the channel-averaged continuum by selecting only the continuum
+    channels identified from the cont.dat file.  Unlike ``split_continuum``,
+    this does not modify the flags of ``visfile``, so it can run concurrently
+    with the other splits of the same MS.
+
+    The continuum ranges are trimmed to whole averaging bins (see
+    ``trim_channel_ranges``), which drops the ranges shorter than the width
+    and the end of the others.  If that drops more than ``max_loss`` of the
+    continuum channels of any spw, the line channels are instead flagged in
+    an intermediate MS (``split_continuum_singlepass`` without the bsens
+    continuum), so the source MS is still not modified.
+    """
+    logprint("Splitting continuum channels of {0} to {1}"
+             .format(visfile, contvis),)
+
+    widths, freqs = determine_continuum_widths(visfile, spws)
+    datacolumn = get_datacolumn(visfile)
+
+    cont_channel_selection = parse_contdotdat(contfile)
+    contranges = contchannels_to_contchannel_ranges(cont_channel_selection,
+                                                    freqs)
+
+    selections = []
+    selwidths = []
+    for spw, width in zip(spws, widths):
+        ranges, selwidth = trim_channel_ranges(contranges[spw], width)
+        ntotal = sum(hi - lo + 1 for lo, hi in contranges[spw])
+        if ntotal == 0:
+            logprint("No continuum channels in spw {0} of {1}; skipping it"
+                     .format(spw, visfile))
+            continue
+        nkept = sum(hi - lo + 1 for lo, hi in ranges)
+        logprint("spw {0}: keeping {1} of {2} continuum channels ({3:0.1%}) in "
+                 "{4} ranges, width = {5}".format(spw, nkept, ntotal,
+                                                  nkept / float(ntotal),
+                                                  len(ranges), selwidth))
+        if nkept < (1 - max_loss) * ntotal:
+            logprint("Selecting whole averaging bins would drop more than "
+                     "{0:0.0%} of the continuum of spw {1}; flagging the line "
+                     "channels in an intermediate MS instead"
+                     .format(max_loss, spw))
+            return split_continuum_singlepass(visfile, contvis, None, spws,
+                                              field, band, contfile,
+                                              max_preaverage=max_preaverage)
+        selections.append("{0}:".format(spw) +
+                          ";".join(["{0}~{1}".format(lo, hi)
+                                    for lo, hi in ranges]))
+        selwidths.append(selwidth)
+
+    if not selections:
+        raise ValueError("No continuum channels were found in {0} using {1}"
+                         .format(visfile, contfile))
+
+    rmtables(contvis)
+    os.system('rm -rf ' + contvis + '.flagversions')
+
+    assert split(vis=visfile,
+                 spw=",".join(selections),
+                 field=field,
+                 outputvis=contvis,
+                 width=selwidths,
+                 datacolumn=datacolumn), "Split failed!"
+
+    if not os.path.exists(contvis):
+        raise IOError("Split failed for {0}".format(contvis))
+
+
+def split_continuum_bsens(visfile, contvis_bestsens, spws, field, band):
+    """
+    Split out the channel-averaged 'best sensitivity' continuum, in which no
+    line channels are flagged
+    """
+    logprint("Splitting 'best-sensitivity' {0} to {1} for continuum"
+             .format(visfile, contvis_bestsens),)
+
+    widths, freqs = determine_continuum_widths(visfile, spws)
+    datacolumn = get_datacolumn(visfile)
+
+    # Average the channels within spws for the "best sensitivity"
+    # continuum, in which nothing is flagged out
+    assert split(vis=visfile,
+                 spw=",".join(map(str,spws)),
+                 field=field,
+                 outputvis=contvis_bestsens,
+                 width=widths,
+                 datacolumn=datacolumn), "Split Failed 2"
+
+
+def preaverage_width(width, max_preaverage):
+    """
+    The largest divisor of ``width`` that is no larger than ``max_preaverage``
+    """
+    for factor in range(min(width, max_preaverage), 0, -1):
+        if width % factor == 0:
+            return factor
+
+
+def split_continuum_singlepass(visfile, contvis, contvis_bestsens, spws, field,
+                               band, contfile, max_preaverage=8):
+    """
+    Produce both the cleanest and the 'best sensitivity' continuum while
+    reading ``visfile`` only once.
+
+    The selected windows are split once into an intermediate MS averaged by
+    a factor that divides each window's continuum width.  The bsens continuum
+    is split from the intermediate MS, then the line channels are flagged in
+    the intermediate MS (which is ours to modify, so no flag versions are
+    needed) and the cleanest continuum is split from it.  An intermediate
+    channel is flagged if any of the source channels it contains is a line
+    channel, so the line flags are slightly wider than in ``split_continuum``
+    when the averaging factor is >1.
+
+    If ``contvis_bestsens`` is None, only the cleanest continuum is made.
+    """
+    if contvis_bestsens is None:
+        logprint("Splitting {0} to {1} for continuum through an intermediate MS"
+                 .format(visfile, contvis),)
+    else:
+        logprint("Splitting {0} to {1} and {2} for continuum in a single pass"
+                 .format(visfile, contvis, contvis_bestsens),)
+
+    widths, freqs = determine_continuum_widths(visfile, spws)
+    datacolumn = get_datacolumn(visfile)
+
+    preaverage = [preaverage_width(wid, max_preaverage) for wid in widths]
+    postaverage = [wid // pre for wid, pre in zip(widths, preaverage)]
+    logprint("Pre-averaging widths: {0}, final widths: {1}"
+             .format(preaverage, postaverage))
+
+    cont_channel_selection = parse_contdotdat(contfile)
+
+    # split renumbers the selected windows from 0 in the order given
+    linechannels = []
+    for newspw, (spw, pre) in enumerate(zip(spws, preaverage)):
+        contmask = contchannel_mask(cont_channel_selection, freqs[spw])
+        # split keeps a partial bin at the end of the window
+        nout = int(np.ceil(len(contmask) / float(pre)))
+        padded = np.ones(nout * pre, dtype='bool')
+        padded[:len(contmask)] = contmask
+        linemask = ~padded.reshape(nout, pre).all(axis=1)
+        if linemask.any():
+            linechannels.append("{0}:".format(newspw) +
+                                ";".join(["{0}~{1}".format(lo, hi)
+                                          for lo, hi in
+                                          channel_ranges(linemask)]))
+
+    intermediate = contvis + ".preaverage"
+    outputs = [vis for vis in (contvis, contvis_bestsens) if vis is not None]
+    for vis in [intermediate] + outputs:
+        rmtables(vis)
+        os.system('rm -rf ' + vis + '.flagversions')
+
+    assert split(vis=visfile,
+                 spw=",".join(map(str,spws)),
+                 field=field,
+                 outputvis=intermediate,
+                 width=preaverage,
+                 datacolumn=datacolumn), "Split failed!"
+
+    if contvis_bestsens is not None:
+        assert split(vis=intermediate,
+                     outputvis=contvis_bestsens,
+                     width=postaverage,
+                     datacolumn='data'), "Split Failed 2"
+
+    if linechannels:
+        flagdata(vis=intermediate, mode='manual', spw=",".join(linechannels),
+                 flagbackup=False)
+
+    assert split(vis=intermediate,
+                 outputvis=contvis,
+                 width=postaverage,
+                 datacolumn='data'), "Split failed!"
+
+    rmtables(intermediate)
+
+    for vis in outputs:
+        if not os.path.exists(vis):
+            raise IOError("Split failed for {0}".format(vis))
+
+
+def concat_continuum(vis, concatvis):
+    """
+    Merge the continuum measurement sets to ease bookkeeping
+    """
+    logprint("Merging continuum {0} into {1}".format(vis, concatvis))
+    concat(vis=vis, concatvis=concatvis,)
@@ -31,6 +31,51 @@ You can set the following environmental variables for this script:
         If this parameter is set, filter out the imaging targets and only split
         fields with this name (e.g., "W43-MM1", "W51-E", etc.).
         Metadata will still be collected for *all* available MSes.
+    METADATA_NPROC=<number>
+        The number of processes used to collect the metadata (see
+        ``harvest_metadata.py``).  The per-MS metadata are cached in
+        ``metadata_cache/``, so only new or modified MSes are inspected on
+        re-runs.
+    SPLIT_NPROC=<number>
+        The number of processes used to run the split and concat steps.
+        Defaults to 1 (serial).  Each step waits only for the steps it
+        depends on, and steps whose output MSes are already complete are
+        skipped.
+    SPLIT_MEMORY_GB=<number>
+        The total memory (GB) available to concurrent split steps.  Defaults
+        to the physical memory of the machine.
+    SPLIT_TASK_MEMORY_GB=<number>
+        The memory (GB) each split step is assumed to need.  Defaults to 4.
+    CONTINUUM_SPLIT_MODE=<flag|select|singlepass>
+        How the line channels are excluded from the cleanest continuum.
+        'flag' (the default) temporarily flags the line channels in the source
+        MS with flagdata/flagmanager, splits, and restores the flags; no other
+        split of the same MS can run meanwhile.  'select' instead passes only
+        the continuum channel ranges to split, leaving the source MS
+        untouched.  In 'select' mode, each range is trimmed to a whole number
+        of averaging bins so that no output channel averages across a line,
+        which drops the ranges shorter than the averaging width and up to
+        width-1 channels at the end of the others.  The fraction of the
+        continuum channels kept is logged for each window; if more than
+        CONTINUUM_SELECT_MAX_LOSS is dropped in any window, the line channels
+        are instead flagged in an intermediate MS, as in 'singlepass' mode.
+        'singlepass' reads the source MS once to produce both the cleanest
+        and the bsens continuum: it splits to an intermediate MS averaged by a
+        factor of each window's width, splits the bsens continuum from it,
+        then flags the (slightly widened) line channels in the intermediate MS
+        and splits the cleanest continuum.
+    CONTINUUM_PREAVERAGE_MAX=<number>
+        The largest pre-averaging factor used in 'singlepass' mode (and by
+        the intermediate MS of 'select' mode).  The
+        factor is the largest divisor of each window's width up to this
+        value.  Defaults to 8.
+    CONTINUUM_SELECT_MAX_LOSS=<number>
+        The largest fraction of a window's continuum channels that 'select'
+        mode may drop.  Defaults to 0.1.
+
+Once the splits are done, the frequency range and channel widths of the line
+MSes in ``to_image.json`` are collected in ``spectral_index.json`` (see
+``spectral_index.py``) for ``line_imaging.py``.
 
 
 cont.dat files
@@ -44,7 +89,6 @@ ORION.B9.cont.dat. Note that the names are case sensitive.
 import os
 import glob
 import json
-import numpy as np
 
 import sys
 
@@ -75,20 +119,14 @@ else:
 from getversion import git_date, git_version
 
 from taskinit import casalog
-from taskinit import msmdtool
-from taskinit import mstool, tbtool
-from tasks import split, flagmanager, flagdata, rmtables, concat
 
-from parse_contdotdat import parse_contdotdat, contchannels_to_linechannels
-
-msmd = msmdtool()
-ms = mstool()
-tb = tbtool()
-
-# band name : frequency range (GHz)
-bands = {'B3': (80, 110),
-         'B6': (210, 250),
-        }
+from harvest_metadata import harvest_metadata, bands
+from split_tools import (split_line_window, split_continuum,
+                         split_continuum_selected, split_continuum_bsens,
+                         split_continuum_singlepass, concat_continuum,
+                         ms_is_complete, init_worker)
+from task_graph import make_task, run_tasks, total_memory_gb
+from spectral_index import build_spectral_index
 
 
 def logprint(string):
@@ -97,150 +135,10 @@ def logprint(string):
 
 logprint("ALMAIMF_ROOTDIR directory set to {0}".format(os.getenv('ALMAIMF_ROOTDIR')))
 
-metadata = {b:{} for b in bands}
-contdat_files = {}
-
 science_goals = glob.glob("science_goal*")
 
-for sg in science_goals:
-    # walk only the science goals: walking other directories can be extremely
-    # inefficient
-    for dirpath, dirnames, filenames in os.walk(sg):
-        if dirpath.count(os.path.sep) >= 5:
-            # skip over things below the sci/gro/mou/<blah>/* level
-            continue
-        for fn in dirnames:
-            if fn[-10:] == ".split.cal":
-
-                logprint("Collecting metadata for {0} in {1}".format(fn, dirpath))
-
-                filename = os.path.join(dirpath, fn)
-                msmd.open(filename)
-
-                antnames = msmd.antennanames()
-                fieldnames = np.array(msmd.fieldnames())
-                field = fieldnames[msmd.fieldsforintent('OBSERVE_TARGET#ON_SOURCE')]
-                assert len(np.unique(field)) == 1,"ERROR: field={0} fieldnames={1}".format(field, fieldnames)
-                field = field[0]
-
-                frq0 = msmd.chanfreqs(0)
-                for bb,(lo, hi) in bands.items():
-                    try:
-                        if lo*1e9 < frq0 and hi*1e9 > frq0:
-                            band = bb
-                    except ValueError:
-                        if lo*1e9 < np.min(frq0) and hi*1e9 > np.max(frq0):
-                            band = bb
-
-
-                if any('PM' in nm for nm in antnames):
-                    if len(antnames) <= 4:
-                        with open(os.path.join(dirpath, "{0}_{1}_TP".format(field, band)), 'w') as fh:
-                            fh.write("{0}".format(antnames))
-                        logprint("Skipping total power MS {0}".format(fn))
-                        msmd.close()
-                        continue
-                    else:
-                        logprint("WARNING: MS {0} contains PM antennae but is apparently not a TP data set".format(fn))
-
-                try:
-                    summary = msmd.summary()
-                except RuntimeError:
-                    logprint("Skipping FAILED MS {0}".format(fn))
-                    msmd.close()
-                    continue
-
-                spws = msmd.spwsforfield(field)
-                targetspws = msmd.spwsforintent('OBSERVE_TARGET*')
-                # this is how DOSPLIT in scriptForPI decides to split
-                spws = [int(ss) for ss in spws if (ss in targetspws) and (msmd.nchan(ss) > 4)]
-
-                # muid is 1 level above calibrated
-                muid = dirpath.split("/")[-2]
-
-                frqs = [msmd.chanfreqs(spw) for spw in spws]
-                frqslims = [(frq.min(), frq.max()) for frq in frqs]
-
-                if field in metadata[band]:
-                    metadata[band][field]['path'].append(os.path.abspath(dirpath)),
-                    metadata[band][field]['vis'].append(fn)
-                    metadata[band][field]['spws'].append(spws)
-                    metadata[band][field]['freqs'].append(frqslims)
-                    metadata[band][field]['muid'].append(muid)
-                else:
-                    metadata[band][field] = {'path': [os.path.abspath(dirpath)],
-                                             'vis': [fn],
-                                             'spws': [spws],
-                                             'freqs': [frqslims],
-                                             'muid': [muid],
-                                            }
-
-                ran_findcont = False
-                pipescript = glob.glob("../script/*casa_pipescript.py")
-                if len(pipescript) > 0:
-                    for pscr in pipescript:
-                        with open(pscr, 'r') as fh:
-                            txt = fh.read()
-                        if 'findcont' in txt:
-                            ran_findcont = True
-                ran_findcont = "ran_findcont" if ran_findcont else "did_not_run_findcont"
-
-                tb.open(filename+"/ANTENNA")
-                positions = tb.getcol('POSITION')
-                tb.close()
-                baseline_lengths = (((positions[None,:,:]-positions.T[:,:,None])**2).sum(axis=1)**0.5)
-                max_bl = int(np.max(baseline_lengths))
-
-                lb_threshold = {'B3': 750,
-                                'B6': 780,}
-                array_config = ('7M' if max_bl < 100
-                                else '12Mshort' if max_bl < lb_threshold[band]
-                                else '12Mlong')
-
-                if 'muid_configs' in metadata[band][field]:
-                    metadata[band][field]['muid_configs'][array_config] = muid
-                else:
-                    metadata[band][field]['muid_configs'] = {array_config: muid}
-
-                contfile = os.path.join(os.getenv('ALMAIMF_ROOTDIR'),
-                                        "{field}.{band}.{array}.cont.dat".format(field=field, band=band, array=array_config.lower()))
-                if os.path.exists(contfile):
-                    logprint("##### Found manually-created cont.dat file {0}".format(contfile))
-                else:
-                    contfile = os.path.join(os.getenv('ALMAIMF_ROOTDIR'),
-                                            "{field}.{band}.cont.dat".format(field=field, band=band))
-                    if os.path.exists(contfile):
-                        logprint("##### Found manually-created cont.dat file {0}".format(contfile))
-                    else:
-                        contfile = os.path.join(dirpath, '../calibration/cont.dat')
-
-                if os.path.exists(contfile):
-                    contdatpath = os.path.realpath(contfile)
-                    contdat_files[field + band + muid] = contdatpath
-
-                    if 'cont.dat' in metadata[band][field]:
-                        metadata[band][field]['cont.dat'][max_bl] = contdatpath
-                    else:
-                        metadata[band][field]['cont.dat'] = {max_bl: contdatpath}
-                else:
-                    if 'cont.dat' in metadata[band][field]:
-                        if max_bl in metadata[band][field]['cont.dat']:
-                            logprint("*** Found DUPLICATE KEY={max_bl} in cont.dat metadata for band={band} field={field}"
-                                     .format(max_bl=max_bl, band=band, field=field))
-                        else:
-                            metadata[band][field]['cont.dat'][max_bl] = 'notfound_'+ ran_findcont
-                    else:
-                        metadata[band][field]['cont.dat'] = {max_bl: 'notfound_'+ ran_findcont}
-                    contdat_files[field + band + muid] = 'notfound_'+ ran_findcont
-
-                # touch the filename
-                with open(os.path.join(dirpath, "{0}_{1}_{2}".format(field, band, array_config)), 'w') as fh:
-                    fh.write("{0}".format(antnames))
-                logprint("Acquired metadata for {0} in {1}_{2}_{3} successfully"
-                         .format(fn, field, band, array_config))
-
-
-                msmd.close()
+# collect the metadata in parallel, reusing the cached records of unchanged MSes
+metadata, contdat_files = harvest_metadata(science_goals)
 
 with open('metadata.json', 'w') as fh:
     json.dump(metadata, fh)
@@ -262,7 +160,20 @@ else:
 
 logprint("Splitting fields {0}".format(fields))
 
+nproc = int(os.getenv('SPLIT_NPROC') or 1)
+task_memory = float(os.getenv('SPLIT_TASK_MEMORY_GB') or 4)
+memory_budget = float(os.getenv('SPLIT_MEMORY_GB') or total_memory_gb())
+continuum_split_mode = os.getenv('CONTINUUM_SPLIT_MODE') or 'flag'
+if continuum_split_mode not in ('flag', 'select', 'singlepass'):
+    raise ValueError("CONTINUUM_SPLIT_MODE must be 'flag', 'select', or "
+                     "'singlepass'")
+max_preaverage = int(os.getenv('CONTINUUM_PREAVERAGE_MAX') or 8)
+max_select_loss = float(os.getenv('CONTINUUM_SELECT_MAX_LOSS') or 0.1)
+
 to_image = {}
+tasks = []
+# the names of the line split tasks of each source MS
+line_tasks = {}
 
 for band in bands:
     to_image[band] = {}
@@ -295,31 +206,17 @@ for band in bands:
                                       .format(band=band, field=field,
                                               spw=newid, base_uid=base_uid))
 
-                if os.path.exists(outvis):
-                    logprint("Skipping {0} because it's done".format(outvis))
-                elif field not in fields:
+                if field not in fields:
                     logprint("Skipping {0} because it is not one of the "
                              "selected fields (but its metadata is being "
                              "collected in to_image.json)".format(outvis))
                 else:
-                    logprint("Splitting {0}'s spw {2} to {1}".format(vis,
-                                                                     outvis,
-                                                                     spws[newid]),)
-
-                    tb.open(invis)
-                    if 'CORRECTED_DATA' in tb.colnames():
-                        datacolumn='corrected'
-                    else:
-                        datacolumn='data'
-                    tb.close()
-                    assert split(vis=invis,
-                                 spw=spws[newid],
-                                 field=field,
-                                 outputvis=outvis,
-                                 # there is no corrected_data column because we're
-                                 # splitting from split MSes
-                                 datacolumn=datacolumn,
-                                ), "Split failed 3"
+                    line_tasks.setdefault(invis, []).append(outvis)
+                    tasks.append(make_task(outvis, split_line_window,
+                                           args=(invis, outvis, spws[newid],
+                                                 field),
+                                           outputs=[outvis],
+                                           memory=task_memory))
 
                 if outvis in to_image[band][field][newid]:
                     raise ValueError()
@@ -330,7 +227,7 @@ for band in bands:
 with open('to_image.json', 'w') as fh:
     json.dump(to_image, fh)
 
-logprint("Completed line ms splitting.  Moving on to continuum splitting")
+logprint("Completed line ms split setup.  Moving on to continuum split setup")
 
 cont_mses = []
 cont_mses_unconcat = []
@@ -384,9 +281,8 @@ for band in bands:
                 else:
                     logprint("No cont.dat file: Skipping - this file will not be included in the merged continuum.")
                     continue
-            cont_channel_selection = parse_contdotdat(contfile)
             mymd['cont.dat_file'] = contfile
-            contdat_files[field + band + muid] = contdatpath
+            contdat_files[field + band + muid] = os.path.realpath(contfile)
 
             visfile = os.path.join(path, vis)
             contvis = os.path.join(path, "continuum_"+vis+".cont")
@@ -394,128 +290,51 @@ for band in bands:
 
             cont_to_merge[band][field].append(contvis)
 
-            if os.path.exists(contvis) and os.path.exists(contvis_bestsens):
-                logprint("Skipping width determination for {0} = {1}:{2} because "
-                         "it's done (both for bsens & cont)".format(contvis, band, field),)
-            else:
-                logprint("Determining widths for {0} to {1}, {2}:{3}"
-                         .format(visfile, contvis, band, field),)
-
-                # determine target widths
-                msmd.open(visfile)
-                ms.open(visfile)
-                Synth_HPBW = 0.3 #Smallest synth HPBW among target sample in arcsec
-                # values interpolated by Roberto from https://science.nrao.edu/facilities/vla/docs/manuals/oss2016A/performance/fov/bw-smearing
-                PB_HPBW = 21. * (300. / bands[band][0]) # PB HPBW at lowest band freq
-                #targetwidth = 10e6 # 10 MHz
-                targetwidth = 0.25 * (Synth_HPBW / PB_HPBW) * bands[band][0] * 1e9 # 98% BW smearing criterion
-                widths = []
-                freqs = {}
-                logprint("Determining smoothing widths for continuum data.  "
-                         "PB_HPBW = {0}, targetwidth = {1}".format(PB_HPBW, targetwidth))
-                for spw in spws:
-                    chwid = np.abs(np.mean(msmd.chanwidths(spw)))
-                    wid = int(targetwidth/chwid)
-                    if wid <= 0:
-                        logprint("Failure at chwid = {0}, wid = {1}.  ".format(chwid, wid))
-                        raise ValueError("The channel width is greater than "
-                                         "the target line width for spw {0} "
-                                         "in ms {1}".format(spw, visfile))
-                    if wid > msmd.nchan(spw) / 2:
-                        # CASA *cannot* handle wid > nchan
-                        # This one also insists that there will be at least 2
-                        # output channels in all cases
-                        wid = int(msmd.nchan(spw) / 2)
-                    widths.append(wid)
-                    # these are TOPO freqs: freqs[spw] = msmd.chanfreqs(spw)
-                    try:
-                        freqs[spw] = ms.cvelfreqs(spwid=[spw], outframe='LSRK')
-                    except TypeError:
-                        freqs[spw] = ms.cvelfreqs(spwids=[spw], outframe='LSRK')
-
-                msmd.close()
-                ms.close()
-
-
-            if not os.path.exists(contvis) or not os.path.exists(contvis_bestsens):
-                tb.open(visfile)
-                if 'CORRECTED_DATA' in tb.colnames():
-                    datacolumn='corrected'
-                else:
-                    datacolumn='data'
-                tb.close()
-
-
-            if os.path.exists(contvis):
-                logprint("Continuum: Skipping {0} because it's done".format(contvis),)
-            elif field not in fields:
+            if field not in fields:
                 logprint("Skipping {0} because it is not one of the "
                          "selected fields (but its metadata is being "
                          "collected in continuum_mses.txt)".format(contvis))
+                continue
+
+            if continuum_split_mode == 'singlepass':
+                tasks.append(make_task(contvis, split_continuum_singlepass,
+                                       args=(visfile, contvis,
+                                             contvis_bestsens, spws, field,
+                                             band, contfile),
+                                       kwargs={'max_preaverage':
+                                               max_preaverage},
+                                       outputs=[contvis, contvis_bestsens],
+                                       memory=task_memory))
+                continue
+            elif continuum_split_mode == 'flag':
+                # the line-channel flags are applied to the source MS while
+                # the continuum is split, so nothing else may read from it in
+                # the meantime: the line splits must be done first, and the
+                # bsens split must wait until the flags are restored
+                tasks.append(make_task(contvis, split_continuum,
+                                       args=(visfile, contvis, spws, field,
+                                             band, contfile),
+                                       outputs=[contvis],
+                                       deps=line_tasks.get(visfile, []),
+                                       memory=task_memory))
+                bsens_deps = [contvis]
             else:
-                logprint("Flagging and splitting {0} to {1} for continuum"
-                         .format(visfile, contvis),)
-
-
-                linechannels = contchannels_to_linechannels(cont_channel_selection,
-                                                            freqs)
-
-
-                flagmanager(vis=visfile, mode='save',
-                            versionname='before_cont_flags')
-
-                # not clear why this is done in other imaging scripts, but it
-                # seems to achieve the wrong effect.
-                #initweights(vis=visfile, wtmode='weight', dowtsp=True)
-
-
-                flagdata(vis=visfile, mode='manual', spw=linechannels,
-                         flagbackup=False)
-
-
-                flagmanager(vis=visfile, mode='save',
-                            versionname='line_channel_flags')
-
-                rmtables(contvis)
-                os.system('rm -rf ' + contvis + '.flagversions')
-
-
-                # Average the channels within spws
-                # (assert here checks that this completes successfully)
-                assert split(vis=visfile,
-                             spw=",".join(map(str,spws)),
-                             field=field,
-                             outputvis=contvis,
-                             width=widths,
-                             datacolumn=datacolumn), "Split failed!"
-
-                if not os.path.exists(contvis):
-                    raise IOError("Split failed for {0}".format(contvis))
-
-                # If you flagged any line channels, restore the previous flags
-                flagmanager(vis=visfile, mode='restore',
-                            versionname='before_cont_flags')
-
-
-
-            if os.path.exists(contvis_bestsens):
-                logprint("Skipping {0} because it's done".format(contvis_bestsens),)
-            elif field not in fields:
-                logprint("Skipping {0} because it is not one of the "
-                         "selected fields (but its metadata is being "
-                         "collected in continuum_mses.txt)".format(contvis_bestsens))
-            else:
-                logprint("Splitting 'best-sensitivity' {0} to {1} for continuum"
-                         .format(visfile, contvis_bestsens),)
-
-                # Average the channels within spws for the "best sensitivity"
-                # continuum, in which nothing is flagged out
-                assert split(vis=visfile,
-                             spw=",".join(map(str,spws)),
-                             field=field,
-                             outputvis=contvis_bestsens,
-                             width=widths,
-                             datacolumn=datacolumn), "Split Failed 2"
+                # the source MS is only read, so there are no dependencies
+                tasks.append(make_task(contvis, split_continuum_selected,
+                                       args=(visfile, contvis, spws, field,
+                                             band, contfile),
+                                       kwargs={'max_loss': max_select_loss,
+                                               'max_preaverage':
+                                               max_preaverage},
+                                       outputs=[contvis],
+                                       memory=task_memory))
+                bsens_deps = []
+            tasks.append(make_task(contvis_bestsens, split_continuum_bsens,
+                                   args=(visfile, contvis_bestsens, spws,
+                                         field, band),
+                                   outputs=[contvis_bestsens],
+                                   deps=bsens_deps,
+                                   memory=task_memory))
 
 
         member_uid = path.split("member.")[-1].split("/")[0]
@@ -526,23 +345,6 @@ for band in bands:
                                                    muid=member_uid)
                                           )
 
-        # merge the continuum measurement sets to ease bookkeeping
-        if os.path.exists(merged_continuum_fn):
-            logprint("Skipping merged continuum {0} because it's done"
-                     .format(merged_continuum_fn),)
-        elif field not in fields:
-            logprint("Skipping {0} because it is not one of the "
-                     "selected fields (but its metadata is being "
-                     "collected in continuum_mses.txt)".format(merged_continuum_fn))
-        else:
-            logprint("Merging continuum for {0} {1} into {2}"
-                     .format(merged_continuum_fn, field, band),)
-
-            concat(vis=cont_to_merge[band][field],
-                   concatvis=merged_continuum_fn,)
-        cont_mses.append(merged_continuum_fn)
-
-
         # merge the best sensitivity continuum too
         merged_continuum_bsens_fn = os.path.join(
             path,
@@ -550,22 +352,49 @@ for band in bands:
             .format(field=field, band=band, muid=member_uid)
         )
 
-        if os.path.exists(merged_continuum_bsens_fn):
-            logprint("Skipping merged continuum bsens {0} because it's done"
-                     .format(merged_continuum_bsens_fn),)
+        # merge the continuum measurement sets to ease bookkeeping
+        if field not in fields:
+            logprint("Skipping {0} because it is not one of the "
+                     "selected fields (but its metadata is being "
+                     "collected in continuum_mses.txt)".format(merged_continuum_fn))
         else:
-            logprint("Merging bsens continuum for {0} {1} into {2}"
-                     .format(merged_continuum_bsens_fn, field, band),)
+            # the names of the tasks that produce each output MS
+            producers = {fn: task['name'] for task in tasks
+                         for fn in task['outputs']}
+            tasks.append(make_task(merged_continuum_fn, concat_continuum,
+                                   args=(cont_to_merge[band][field],
+                                         merged_continuum_fn),
+                                   outputs=[merged_continuum_fn],
+                                   deps=sorted(set(producers[x] for x in
+                                                   cont_to_merge[band][field]
+                                                   if x in producers)),
+                                   memory=task_memory))
 
             # Note this search-and-replace pattern: we use this instead
             # of separately storing the continuum bsens MS names
-            concat(vis=[x.replace(".cont", "_bsens.cont")
-                        for x in cont_to_merge[band][field]],
-                   concatvis=merged_continuum_bsens_fn,)
+            bsens_to_merge = [x.replace(".cont", "_bsens.cont")
+                              for x in cont_to_merge[band][field]]
+            tasks.append(make_task(merged_continuum_bsens_fn, concat_continuum,
+                                   args=(bsens_to_merge,
+                                         merged_continuum_bsens_fn),
+                                   outputs=[merged_continuum_bsens_fn],
+                                   deps=sorted(set(producers[x] for x in
+                                                   bsens_to_merge
+                                                   if x in producers)),
+                                   memory=task_memory))
+        cont_mses.append(merged_continuum_fn)
 
         # for debug purposes, we also track the split, unmerged MSes
         cont_mses_unconcat += cont_to_merge[band][field]
 
+logprint("Running {0} split and concat tasks with {1} processes"
+         .format(len(tasks), nproc))
+run_tasks(tasks, nproc=nproc, memory_budget=memory_budget,
+          is_complete=ms_is_complete, initializer=init_worker)
+
+logprint("Indexing the spectral setup of the line MSes")
+build_spectral_index(to_image)
+
 with open('continuum_mses.txt', 'w') as fh:
     for line in cont_mses:
         fh.write(line+'\n')
@@ -0,0 +1,243 @@
+"""
+A small dependency-aware task executor.
+
+Tasks are dictionaries created by ``make_task``.  Each task has a name, a
+function to call, the list of output files it produces, the names of the tasks
+it depends on, and an estimate of the memory (in GB) it needs.  ``run_tasks``
+skips tasks whose outputs already exist and are complete, runs the others in a
+process pool as soon as their dependencies are done and enough of the memory
+budget is free, and reports the wall time of each task.
+
+The functions run by the tasks must be importable module-level functions so
+that they can be sent to the worker processes.
+"""
+import os
+import time
+import multiprocessing
+
+from metadata_tools import logprint
+
+
+def make_task(name, func, args=(), kwargs=None, outputs=(), deps=(), memory=0):
+    """
+    Create a task
+
+    Parameters
+    ----------
+    name : str
+        A unique name for the task
+    func : function
+        The module-level function to call as ``func(*args, **kwargs)``
+    outputs : list
+        The files produced by the task.  If all of them are complete, the task
+        is skipped.  A task with no outputs is always run.
+    deps : list
+        The names of the tasks that must complete before this one starts
+    memory : float
+        The memory (GB) the task is expected to need
+    """
+    return {'name': name,
+            'func': func,
+            'args': tuple(args),
+            'kwargs': kwargs if kwargs is not None else {},
+            'outputs': list(outputs),
+            'deps': list(deps),
+            'memory': memory,
+           }
+
+
+def total_memory_gb():
+    """
+    The physical memory of this machine in GB
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.**3
+
+
+def _run_task(func, args, kwargs):
+    t0 = time.time()
+    value = func(*args, **kwargs)
+    return time.time() - t0, value
+
+
+def check_task_graph(tasks):
+    """
+    Check that the task names are unique, that all dependencies exist, and that
+    there are no cycles.
+    """
+    names = [task['name'] for task in tasks]
+    if len(set(names)) != len(names):
+        raise ValueError("Task names are not unique: {0}"
+                         .format(sorted(nm for nm in set(names)
+                                        if names.count(nm) > 1)))
+    bydep = {task['name']: task['deps'] for task in tasks}
+    for name, deps in bydep.items():
+        for dep in deps:
+            if dep not in bydep:
+                raise ValueError("Task {0} depends on unknown task {1}"
+                                 .format(name, dep))
+
+    # depth-first search for cycles
+    state = {}
+    def visit(name):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError("Dependency cycle involving task {0}".format(name))
+        state[name] = 'visiting'
+        for dep in bydep[name]:
+            visit(dep)
+        state[name] = 'done'
+    for name in names:
+        visit(name)
+
+
+def report_tasks(tasks, results):
+    """
+    Log the status and wall time of each task
+    """
+    logprint("Task summary (status, wall time):")
+    total = 0
+    for task in tasks:
+        result = results[task['name']]
+        walltime = result.get('walltime', 0)
+        total += walltime
+        logprint("    {0:10s} {1:10.1f}s  {2}".format(result['status'],
+                                                      walltime,
+                                                      task['name']))
+    logprint("Total task time {0:0.1f}s".format(total))
+
+
+def run_tasks(tasks, nproc=1, memory_budget=None, is_complete=os.path.exists,
+              initializer=None, poll_interval=1.0, raise_on_failure=True):
+    """
+    Run a set of tasks, respecting their dependencies.
+
+    Parameters
+    ----------
+    tasks : list
+        A list of tasks created by ``make_task``.  If nproc=1, the tasks are
+        run in list order as their dependencies allow.
+    nproc : int
+        The number of worker processes.  If 1, the tasks are run serially in
+        this process.
+    memory_budget : float or None
+        The total memory (GB) available to concurrently running tasks.  A task
+        is only started if its memory estimate fits in the remaining budget,
+        or if no other task is running.  Defaults to the physical memory.
+    is_complete : function
+        A function returning True if an output file exists and is complete
+    initializer : function or None
+        A function to call in each worker process at startup (e.g., to create
+        new CASA tools)
+    raise_on_failure : bool
+        Raise an exception at the end if any task failed or was blocked.  If
+        False, the caller must check the statuses.
+
+    Returns
+    -------
+    results : dict
+        A dictionary keyed by task name with 'status' ('done', 'skipped',
+        'failed', or 'blocked') and 'walltime' entries, and the return value
+        of the function as 'result' for the tasks that are done
+    """
+    check_task_graph(tasks)
+
+    if memory_budget is None:
+        memory_budget = total_memory_gb()
+
+    results = {}
+    pending = []
+    for task in tasks:
+        if task['outputs'] and all(is_complete(fn) for fn in task['outputs']):
+            logprint("Skipping task {0} because it's done".format(task['name']))
+            results[task['name']] = {'status': 'skipped', 'walltime': 0}
+        else:
+            pending.append(task)
+
+    def ready(task):
+        return all(results.get(dep, {}).get('status') in ('done', 'skipped')
+                   for dep in task['deps'])
+
+    def blocked(task):
+        return any(results.get(dep, {}).get('status') in ('failed', 'blocked')
+                   for dep in task['deps'])
+
+    if nproc <= 1:
+        while pending:
+            for task in pending:
+                if blocked(task) or ready(task):
+                    break
+            else:
+                raise ValueError("No task can be run; this should be impossible "
+                                 "for a graph without cycles.")
+            pending.remove(task)
+            if blocked(task):
+                logprint("Task {0} is blocked by a failed dependency".format(task['name']))
+                results[task['name']] = {'status': 'blocked', 'walltime': 0}
+                continue
+            logprint("Starting task {0}".format(task['name']))
+            try:
+                walltime, value = _run_task(task['func'], task['args'], task['kwargs'])
+            except Exception as ex:
+                logprint("Task {0} FAILED: {1}".format(task['name'], ex))
+                results[task['name']] = {'status': 'failed', 'walltime': 0,
+                                         'error': str(ex)}
+            else:
+                logprint("Completed task {0} in {1:0.1f}s".format(task['name'], walltime))
+                results[task['name']] = {'status': 'done', 'walltime': walltime,
+                                         'result': value}
+    else:
+        pool = multiprocessing.Pool(processes=nproc, initializer=initializer)
+        running = {}
+        try:
+            while pending or running:
+                for task in list(pending):
+                    if blocked(task):
+                        logprint("Task {0} is blocked by a failed dependency".format(task['name']))
+                        results[task['name']] = {'status': 'blocked', 'walltime': 0}
+                        pending.remove(task)
+                        continue
+                    if not ready(task) or len(running) >= nproc:
+                        continue
+                    memory_in_use = sum(tsk['memory'] for tsk, _ in running.values())
+                    if running and memory_in_use + task['memory'] > memory_budget:
+                        continue
+                    logprint("Starting task {0} ({1} running, {2:0.1f} GB in use)"
+                             .format(task['name'], len(running), memory_in_use))
+                    running[task['name']] = (task,
+                                             pool.apply_async(_run_task,
+                                                              (task['func'],
+                                                               task['args'],
+                                                               task['kwargs'])))
+                    pending.remove(task)
+
+                finished = [name for name, (task, res) in running.items()
+                            if res.ready()]
+                for name in finished:
+                    task, res = running.pop(name)
+                    try:
+                        walltime, value = res.get()
+                    except Exception as ex:
+                        logprint("Task {0} FAILED: {1}".format(name, ex))
+                        results[name] = {'status': 'failed', 'walltime': 0,
+                                         'error': str(ex)}
+                    else:
+                        logprint("Completed task {0} in {1:0.1f}s".format(name, walltime))
+                        results[name] = {'status': 'done', 'walltime': walltime,
+                                         'result': value}
+
+                if not finished:
+                    time.sleep(poll_interval)
+        finally:
+            pool.close()
+            pool.join()
+
+    report_tasks(tasks, results)
+
+    failed = [name for name, result in results.items()
+              if result['status'] in ('failed', 'blocked')]
+    if failed and raise_on_failure:
+        raise ValueError("The following tasks failed or were blocked: {0}"
+                         .format(failed))
+
+    return results
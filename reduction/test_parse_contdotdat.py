@@ -0,0 +1,206 @@
+"""
+Tests of the cont.dat parsing and the channel mapping of
+``parse_contdotdat.py`` against the implementations they replaced.
+
+Run with ``python -m pytest test_parse_contdotdat.py`` from this directory;
+CASA is not needed.
+"""
+import glob
+import os
+import string
+
+import numpy as np
+import pytest
+
+import parse_contdotdat
+from parse_contdotdat import (contchannels_to_linechannels,
+                              contchannels_to_contchannel_ranges,
+                              contchannel_mask, parse_contdotdat as parse,
+                              frequency_units)
+
+rootdir = os.path.dirname(os.path.abspath(__file__))
+
+
+# the implementations before the channel mapping was vectorized and the
+# cont.dat files were parsed into a structure; the quanta conversion is
+# replaced by the table of units
+def legacy_parse_contdotdat(filepath):
+    selections = []
+    with open(filepath, 'r') as fh:
+        for line in fh:
+            if "LSRK" in line:
+                selections.append(line.split()[0])
+    return ";".join(selections)
+
+
+def legacy_contchannel_mask(contsel, freq):
+    fmin, fmax = np.min(freq), np.max(freq)
+    selected = np.zeros_like(freq, dtype='bool')
+    for selstr in contsel.split(";"):
+        lo, hi = selstr.strip(string.ascii_letters).split("~")
+        unit = selstr.lstrip(string.punctuation + string.digits)
+        flo = float(lo) * frequency_units[unit]
+        fhi = float(hi) * frequency_units[unit]
+        if flo > fhi:
+            flo, fhi = fhi, flo
+        if fhi < fmax and flo > fmin:
+            selected |= (freq > flo) & (freq < fhi)
+    return selected
+
+
+def legacy_channel_ranges(mask):
+    ranges = []
+    start = None
+    for ii, value in enumerate(mask):
+        if value and start is None:
+            start = ii
+        elif not value and start is not None:
+            ranges.append((start, ii-1))
+            start = None
+    if start is not None:
+        ranges.append((start, len(mask)-1))
+    return ranges
+
+
+def legacy_contchannels_to_linechannels(contsel, freqslist):
+    new_sel = []
+    for spw, freq in freqslist.items():
+        invselected = ~legacy_contchannel_mask(contsel, freq)
+        chans = ([0] +
+                 np.where(invselected[1:] != invselected[:-1])[0].tolist() +
+                 [len(freq)-1])
+        new_sel.append("{0}:".format(spw) +
+                       ";".join(["{0}~{1}".format(lo, hi)
+                                 for lo, hi in zip(chans[::2], chans[1::2])]))
+    return ",".join(new_sel)
+
+
+def legacy_contchannels_to_contchannel_ranges(contsel, freqslist):
+    return dict((spw, legacy_channel_ranges(legacy_contchannel_mask(contsel, freq)))
+                for spw, freq in freqslist.items())
+
+
+@pytest.fixture(autouse=True)
+def contdat_cache_dir(tmpdir, monkeypatch):
+    # keep the parsed-file cache out of the source tree
+    monkeypatch.setenv('CONTDAT_CACHE_DIR', str(tmpdir.join('contdat_cache')))
+    parse_contdotdat._contdat_cache.clear()
+    parse_contdotdat._interval_cache.clear()
+
+
+def check_mapping(contsel, freqslist):
+    assert (contchannels_to_linechannels(contsel, freqslist) ==
+            legacy_contchannels_to_linechannels(contsel, freqslist))
+    assert (contchannels_to_contchannel_ranges(contsel, freqslist) ==
+            legacy_contchannels_to_contchannel_ranges(contsel, freqslist))
+    for freq in freqslist.values():
+        np.testing.assert_array_equal(contchannel_mask(contsel, freq),
+                                      legacy_contchannel_mask(contsel, freq))
+
+
+def random_selection(rng):
+    parts = []
+    for lo, width in zip(215. + rng.uniform(-0.5, 2.5, rng.randint(1, 30)),
+                         rng.uniform(0, 0.3, 30)):
+        hi = lo + width
+        if rng.rand() < 0.2:
+            # reversed range
+            lo, hi = hi, lo
+        if rng.rand() < 0.3:
+            parts.append("{0}~{1}MHz".format(round(lo*1e3, 3), round(hi*1e3, 3)))
+        else:
+            parts.append("{0}~{1}GHz".format(round(lo, 6), round(hi, 6)))
+    if rng.rand() < 0.1:
+        # duplicated range
+        parts.append(parts[0])
+    return parts
+
+
+def random_freqslist(rng, parts):
+    freqslist = {}
+    for spw in range(rng.randint(1, 5)):
+        nchan = rng.choice([1, 2, 7, 128, 3840])
+        step = rng.choice([-1, 1]) * rng.uniform(1e4, 1e6)
+        freq = (215 + rng.uniform(-0.2, 1.5))*1e9 + step*np.arange(nchan)
+        if rng.rand() < 0.3 and nchan > 3:
+            # a channel exactly at the edge of a range
+            lo = parts[0].split('~')[0]
+            freq[1] = float(lo) * (1e9 if parts[0].endswith('GHz') else 1e6)
+        freqslist[spw] = freq
+    return freqslist
+
+
+def test_channel_mapping_random():
+    rng = np.random.RandomState(1)
+    for trial in range(3000):
+        parts = random_selection(rng)
+        check_mapping(";".join(parts), random_freqslist(rng, parts))
+
+
+def test_channel_mapping_edge_cases():
+    # 100 channels of 1 MHz from 100 to 199 MHz
+    freq = 100e6 + 1e6*np.arange(100)
+    cases = ["110~120MHz",
+             # reversed
+             "120~110MHz",
+             # duplicated
+             "110~120MHz;110~120MHz",
+             # overlapping
+             "110~130MHz;125~140MHz",
+             # touching the edges of the window (not strictly inside, so
+             # not selected)
+             "100~120MHz", "150~199MHz", "100~199MHz",
+             # just inside the edges
+             "100.5~120MHz;150~198.5MHz",
+             # outside the window
+             "50~60MHz;300~400MHz",
+             # empty
+             "110~110MHz", "110.5~110.7MHz",
+             # ends exactly on channels
+             "110~111MHz",
+             # mixed units
+             "0.11~0.12GHz;130000~140000kHz;150000000~160000000Hz",
+            ]
+    for contsel in cases:
+        check_mapping(contsel, {0: freq, 1: freq[::-1]})
+
+
+def random_contdat(rng):
+    lines = []
+    for field in range(rng.randint(1, 3)):
+        lines.append("Field: FIELD{0}".format(field))
+        lines.append("")
+        if rng.rand() < 0.2:
+            # ranges before the first spectral window
+            lines.append("{0}~{1}GHz LSRK".format(215.1, 215.2))
+        for spw in rng.choice([16, 25, 27, 29, 31], rng.randint(1, 4),
+                              replace=False):
+            lines.append("SpectralWindow: {0}".format(spw))
+            for part in random_selection(rng):
+                lines.append("{0} {1}".format(part, 'TOPO' if rng.rand() < 0.2
+                                              else 'LSRK'))
+            lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def test_parse_contdotdat_random(tmpdir):
+    rng = np.random.RandomState(2)
+    for trial in range(3000):
+        filename = str(tmpdir.join('random{0}.cont.dat'.format(trial)))
+        with open(filename, 'w') as fh:
+            fh.write(random_contdat(rng))
+        assert parse(filename) == legacy_parse_contdotdat(filename)
+
+
+def test_parse_contdotdat_repository_files():
+    filenames = sorted(glob.glob(os.path.join(rootdir, '*.cont.dat')))
+    assert filenames
+    for filename in filenames:
+        contsel = parse(filename)
+        assert contsel == legacy_parse_contdotdat(filename)
+        # the intervals from the parsed structure are those of the string
+        parse_contdotdat._interval_cache.clear()
+        np.testing.assert_array_equal(
+            parse_contdotdat.frequency_intervals(contsel),
+            parse_contdotdat.contdotdat_intervals(
+                parse_contdotdat.read_contdotdat(filename)))
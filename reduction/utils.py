@@ -1,5 +1,79 @@
 import os
 
+def ms_mtime(vis):
+    """
+    Return the most recent modification time of a measurement set.
+
+    An MS is a directory of tables, so the mtime of the directory itself does
+    not change when the data are rewritten; we also check the table files at
+    the top level of the directory.
+    """
+    mtimes = [os.path.getmtime(vis)]
+    for fn in os.listdir(vis):
+        fullpath = os.path.join(vis, fn)
+        if os.path.isfile(fullpath):
+            mtimes.append(os.path.getmtime(fullpath))
+    return max(mtimes)
+
+def ms_geometry_mtime(vis):
+    """
+    Return the most recent modification time of the parts of a measurement
+    set that describe its geometry: the ANTENNA, FIELD and SPECTRAL_WINDOW
+    subtables.
+
+    Unlike ``ms_mtime``, this does not change when data columns are written,
+    added, or removed (e.g., by applycal, by clearcal adding a MODEL_DATA
+    column, or by delmod removing it), but it does change when the MS is
+    replaced, since split and concat write new subtables.  The MS directory
+    itself is only used if it has none of these subtables.
+    """
+    mtimes = [ms_mtime(os.path.join(vis, subtable))
+              for subtable in ('ANTENNA', 'FIELD', 'SPECTRAL_WINDOW')
+              if os.path.isdir(os.path.join(vis, subtable))]
+    if not mtimes:
+        return os.path.getmtime(vis)
+    return max(mtimes)
+
+def directory_size(path):
+    """
+    The total size in bytes of the files in a directory (e.g., an MS), or of a
+    single file
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            fullpath = os.path.join(dirpath, fn)
+            if not os.path.islink(fullpath):
+                total += os.path.getsize(fullpath)
+    return total
+
+def process_io_bytes():
+    """
+    The number of bytes this process has read from and written to storage,
+    from ``/proc/self/io``.  CASA tasks run inside the calling process, so
+    these include their I/O (but not that of MPI servers).  Returns None where
+    ``/proc/self/io`` is not available.
+    """
+    try:
+        with open('/proc/self/io', 'r') as fh:
+            counters = dict(line.split(':') for line in fh if ':' in line)
+    except (IOError, OSError):
+        return None
+    return {'read_bytes': int(counters['read_bytes']),
+            'write_bytes': int(counters['write_bytes'])}
+
+def io_bytes_since(start):
+    """
+    The bytes read and written since ``start`` (a result of
+    ``process_io_bytes``), or an empty dict if they cannot be measured
+    """
+    now = process_io_bytes()
+    if start is None or now is None:
+        return {}
+    return {key: now[key] - start[key] for key in now}
+
 def validate_mask_path(fname, rootdir='./'):
     '''Validate the mask file path
     '''